@@ -1,8 +1,10 @@
 import os
+import math
 from PIL import Image
 import numpy as np
 
 import torch
+import torch.nn.functional as F
 
 
 def cid2filename(cid, prefix):
@@ -49,11 +51,101 @@ def default_loader(path):
         return pil_loader(path)
 
 
+def draft_loader(path, size, box=None):
+    """
+    Loads an image decoded at reduced resolution. JPEG images are scaled down by the decoder
+    itself (by 1/2, 1/4 or 1/8, in the DCT domain) as far as the image, or the crop box, stays
+    at least of the given size, which is several times faster than decoding the full image.
+    Other formats are decoded at full resolution.
+
+    Arguments
+    ---------
+    path : image filename
+    size : (width, height) the image, or the crop box, is resized to afterwards
+    box  : optional (x1, y1, x2, y2) crop box in full resolution coordinates
+
+    Returns
+    -------
+    img : RGB PIL image
+    box : crop box in the coordinates of the decoded image, None if no box was given
+    """
+    try:
+        with open(path, 'rb') as f:
+            img = Image.open(f)
+            W, H = img.size
+            if box is not None:
+                r = max(size[0] / (box[2] - box[0]), size[1] / (box[3] - box[1]))
+            else:
+                r = max(size[0] / W, size[1] / H)
+            if r < 1:
+                img.draft('RGB', (int(np.ceil(W * r)), int(np.ceil(H * r))))
+            sx, sy = img.size[0] / W, img.size[1] / H
+            img = img.convert('RGB')
+    except:
+        return pil_loader(path), box
+
+    if box is not None:
+        box = (box[0] * sx, box[1] * sy, box[2] * sx, box[3] * sy)
+    return img, box
+
+
 def imresize(img, imsize):
     img.thumbnail((imsize, imsize), Image.ANTIALIAS)
     return img
 
 
+def thumbnail_size(size, imsize):
+    """
+    Size of an image after imresize, computed as Image.thumbnail does: the target size is
+    floored and the side scaled down is rounded to the closer aspect ratio (floor on ties)
+
+    Arguments
+    ---------
+    size   : (width, height) of the image
+    imsize : maximum size of longer image side, may be a float
+
+    Returns
+    -------
+    size : (width, height) of the resized image
+    """
+    w, h = size
+    x = y = math.floor(imsize)
+    if x >= w and y >= h:
+        return (w, h)
+
+    def round_aspect(number, key):
+        return max(min(math.floor(number), math.ceil(number), key=key), 1)
+
+    aspect = w / h
+    if x / y >= aspect:
+        x = round_aspect(y * aspect, key=lambda n: abs(aspect - n / y))
+    else:
+        y = round_aspect(x / aspect, key=lambda n: 0 if n == 0 else abs(aspect - x / n))
+    return (x, y)
+
+
+def impyramid(img, ms):
+    """
+    Builds a multi-scale pyramid of a transformed image
+
+    Arguments
+    ---------
+    img : C x H x W image tensor
+    ms  : list of scales, the same resampling as in the multi-scale extraction is used
+
+    Returns
+    -------
+    pyramid : list of C x H_s x W_s image tensors, one per scale
+    """
+    pyramid = []
+    for s in ms:
+        if s == 1:
+            pyramid.append(img)
+        else:
+            pyramid.append(F.interpolate(img.unsqueeze(0), scale_factor=s, mode='bilinear', align_corners=False).squeeze(0))
+    return pyramid
+
+
 def flip(x, dim):
     xsize = x.size()
     dim = x.dim() + dim if dim < 0 else dim
@@ -67,3 +159,31 @@ def collate_tuples(batch):
     if len(batch) == 1:
         return [batch[0][0]], [batch[0][1]], [batch[0][2]]
     return [batch[i][0] for i in range(len(batch))], [batch[i][1] for i in range(len(batch))], [batch[i][2] for i in range(len(batch))]
+
+
+def collate_padded(batch):
+    """
+    Collates images of possibly different sizes into one zero-padded batch
+
+    Arguments
+    ---------
+    batch : list of C x H_i x W_i image tensors,
+            or list of image pyramids (lists of tensors, see impyramid)
+
+    Returns
+    -------
+    input : #im x C x H x W tensor, images placed in the top-left corner
+    mask  : #im x 1 x H x W bool tensor, True for valid (non-padded) pixels
+    For image pyramids a list with one (input, mask) pair per scale is returned.
+    """
+    if isinstance(batch[0], (list, tuple)):
+        return [collate_padded([pyramid[s] for pyramid in batch]) for s in range(len(batch[0]))]
+
+    h = max([img.size(-2) for img in batch])
+    w = max([img.size(-1) for img in batch])
+    input = batch[0].new_zeros(len(batch), batch[0].size(0), h, w)
+    mask = torch.zeros(len(batch), 1, h, w, dtype=torch.bool)
+    for i, img in enumerate(batch):
+        input[i, :, :img.size(-2), :img.size(-1)] = img
+        mask[i, :, :img.size(-2), :img.size(-1)] = True
+    return input, mask
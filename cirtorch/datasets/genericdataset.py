@@ -1,10 +1,14 @@
 import os
+import math
 import pdb
 
+from PIL import Image
+
 import torch
 import torch.utils.data as data
+from torchvision import transforms
 
-from cirtorch.datasets.datahelpers import default_loader, imresize
+from cirtorch.datasets.datahelpers import default_loader, draft_loader, imresize, impyramid, thumbnail_size
 
 
 class ImagesFromList(data.Dataset):
@@ -19,12 +23,25 @@ class ImagesFromList(data.Dataset):
         transform (callable, optional): A function/transform that  takes in an PIL image
             and returns a transformed version. E.g, ``transforms.RandomCrop``
         loader (callable, optional): A function to load an image given its path.
+        ms (list, Default: None): Scales of an image pyramid built from the transformed image.
+            If given, a list with one image tensor per scale is returned instead of the image,
+            so the pyramid is built in the data loading workers
+        draft (bool, Default: False): Decode JPEG images at reduced resolution, just large enough
+            for imsize or for a fixed ``transforms.Resize`` leading the transform, and resample
+            only once: the fixed resize replaces the thumbnail, otherwise the thumbnail size is
+            resampled directly. Images are the same up to resampling differences. Only used
+            with the default loader
+        image_cache (ImageCache, Default: None): Cache of decoded images (see imagecache.py) the
+            images are read from instead of their files, at a size of at least imsize. Images
+            not in the cache are loaded from their files, and so are all images if bbxs are given:
+            a crop of the cached thumbnail would be resampled twice
 
      Attributes:
         images_fn (list): List of full image filename
     """
 
-    def __init__(self, root, images, imsize=None, bbxs=None, transform=None, loader=default_loader):
+    def __init__(self, root, images, imsize=None, bbxs=None, transform=None, loader=default_loader, ms=None,
+                 draft=False, image_cache=None):
 
         images_fn = [os.path.join(root,images[i]) for i in range(len(images))]
 
@@ -38,6 +55,12 @@ class ImagesFromList(data.Dataset):
         self.bbxs = bbxs
         self.transform = transform
         self.loader = loader
+        self.ms = ms
+        self.draft = draft
+        self.image_cache = image_cache
+
+        if image_cache is not None:
+            image_cache.check(imsize)
 
     def __getitem__(self, index):
         """
@@ -45,29 +68,103 @@ class ImagesFromList(data.Dataset):
             index (int): Index
 
         Returns:
-            image (PIL): Loaded image
+            image (PIL): Loaded image, or list of image tensors if ms is given
         """
         path = self.images_fn[index]
-        img = self.loader(path)
-        imfullsize = max(img.size)
-
-        if self.bbxs is not None:
-            img = img.crop(self.bbxs[index])
+        cached = self.cached(path)
+        if self.draft and self.loader is default_loader and not cached:
+            img = self.draft_load(index)
 
-        if self.imsize is not None:
-            if self.bbxs is not None:
-                img = imresize(img, self.imsize * max(img.size) / imfullsize)
+        else:
+            bbx = None if self.bbxs is None else self.bbxs[index]
+            if cached:
+                img, _ = self.image_cache.load(path)
             else:
-                img = imresize(img, self.imsize)
+                img = self.loader(path)
+            imfullsize = max(img.size)
+
+            if bbx is not None:
+                img = img.crop(bbx)
+
+            if self.imsize is not None:
+                if bbx is not None:
+                    img = imresize(img, self.imsize * max(img.size) / imfullsize)
+                else:
+                    img = imresize(img, self.imsize)
 
         if self.transform is not None:
             img = self.transform(img)
+
+        if self.ms is not None:
+            img = impyramid(img, self.ms)
         
         return img
 
     def __len__(self):
         return len(self.images_fn)
 
+    def draft_load(self, index):
+        """
+        Args:
+            index (int): Index
+
+        Returns:
+            image (PIL): Image decoded at reduced resolution, cropped and resized to image_size(index),
+                or left for the fixed resize of the transform
+        """
+        size = fixed_size(self.transform)
+        bbx = None if self.bbxs is None else self.bbxs[index]
+        if size is not None:
+            # the fixed resize of the transform is the only resample, no thumbnail before it
+            img, bbx = draft_loader(self.images_fn[index], (size[1], size[0]), box=bbx)
+            return img if bbx is None else img.crop(bbx)
+
+        target = self.image_size(index)
+        img, bbx = draft_loader(self.images_fn[index], target, box=bbx)
+        if bbx is not None:
+            img = img.crop(bbx)
+        if img.size != target:
+            img = img.resize(target, Image.ANTIALIAS)
+        return img
+
+    def cached(self, path):
+        """Whether the image at path is read from the image cache, never with bbxs"""
+        return self.image_cache is not None and self.bbxs is None and path in self.image_cache
+
+    def image_size(self, index):
+        """
+        Args:
+            index (int): Index
+
+        Returns:
+            size (tuple): (width, height) of the image at index as it enters the transform,
+                read from the image header or the image cache without decoding the image
+        """
+        path = self.images_fn[index]
+        if self.cached(path):
+            w, h = self.image_cache.size(path)
+        else:
+            try:
+                with open(path, 'rb') as f:
+                    w, h = Image.open(f).size
+            except:
+                # unreadable images are replaced by a black image in the loader
+                w, h = 14, 20
+        imfullsize = max(w, h)
+
+        if self.bbxs is not None:
+            # the crop box is rounded to pixels as in Image.crop
+            x1, y1, x2, y2 = self.bbxs[index]
+            w, h = round(x2) - round(x1), round(y2) - round(y1)
+
+        if self.imsize is not None:
+            if self.bbxs is not None:
+                w, h = thumbnail_size((w, h), self.imsize * max(w, h) / imfullsize)
+            else:
+                w, h = thumbnail_size((w, h), self.imsize)
+
+        return (int(w), int(h))
+
     def __repr__(self):
         fmt_str = 'Dataset ' + self.__class__.__name__ + '\n'
         fmt_str += '    Number of images: {}\n'.format(self.__len__())
@@ -76,6 +173,52 @@ class ImagesFromList(data.Dataset):
         fmt_str += '{0}{1}\n'.format(tmp, self.transform.__repr__().replace('\n', '\n' + ' ' * len(tmp)))
         return fmt_str
 
+def fixed_size(transform):
+    """Returns the (height, width) enforced by a leading ``transforms.Resize`` with a fixed size, or None"""
+    if isinstance(transform, transforms.Compose) and len(transform.transforms):
+        transform = transform.transforms[0]
+    if isinstance(transform, transforms.Resize) and not isinstance(transform.size, int) and len(transform.size) == 2:
+        return tuple(transform.size)
+    return None
+
+
+def bucket_batches(dataset, batch_size, exact=False, aspect_step=0.1, indices=None):
+    """Groups the images of an ImagesFromList dataset into batches of similar size
+        to be used as ``batch_sampler`` together with ``collate_padded``
+
+    Args:
+        dataset (ImagesFromList): Dataset the batches are drawn from
+        batch_size (int): Maximum number of images in a batch
+        exact (bool, Default: False): Put only images of exactly the same size into one batch,
+            ie no padding is ever needed. Otherwise images with similar aspect ratio are batched
+            together and the smaller ones are padded
+        aspect_step (float, Default: 0.1): Width of an aspect ratio bucket in log-space
+        indices (iterable, Default: None): Batch only these images, all images when None
+
+    Returns:
+        batches (list): List of lists of image indexes
+    """
+    size = fixed_size(dataset.transform)
+    buckets = {}
+    for i in (range(len(dataset)) if indices is None else indices):
+        if size is not None:
+            # every image is resized to the same size by the transform
+            s = size
+            key = s
+        else:
+            s = dataset.image_size(i)
+            key = s if exact else int(round(math.log(s[0] / s[1]) / aspect_step))
+        buckets.setdefault(key, []).append((s[0] * s[1], i))
+
+    batches = []
+    for key in sorted(buckets.keys()):
+        # sort by area inside a bucket, so the padding stays small
+        bucket = [i for _, i in sorted(buckets[key])]
+        batches.extend([bucket[j:j+batch_size] for j in range(0, len(bucket), batch_size)])
+
+    return batches
+
+
 class ImagesFromDataList(data.Dataset):
     """A generic data loader that loads images given as an array of pytorch tensors
         (Based on ImageFolder from pytorch)
@@ -0,0 +1,195 @@
+import numpy as np
+import torch
+import torch.utils.data as data
+from PIL import Image
+
+from cirtorch.datasets.datahelpers import default_loader, imresize
+from cirtorch.utils.store import StoreWriter, Store, is_store
+
+# maximum size of one shard file in bytes
+SHARD_SIZE = 1024**3
+
+
+class ImageCache(object):
+    """Decoded images stored as uint8 pixels in sharded memory mapped files, indexed by image path
+
+    The images are stored at the resolution they are used for training, ie after the thumbnail
+    to imsize, so loading an image is a copy out of the page cache instead of a JPEG decode.
+    Written by build_image_cache, used by ImagesFromList and TuplesDataset through their
+    image_cache argument. Shards are opened lazily, so the cache can be passed to data loading
+    workers, also with the spawn start method.
+
+    Args:
+        root (string): Directory of the cache
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.open()
+
+    def open(self):
+        self.store = Store(self.root)
+        self.imsize = self.store.meta['imsize']
+        self.index = {path: i for i, path in enumerate(self.store['images'])}
+        self.shard = self.store['shard']
+        self.offset = self.store['offset']
+        self.sizes = self.store['size']
+        self.fullsizes = self.store['fullsize']
+        self.shards = {}
+
+    def __getstate__(self):
+        return {'root': self.root}
+
+    def __setstate__(self, state):
+        self.root = state['root']
+        self.open()
+
+    def __contains__(self, path):
+        return path in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def size(self, path):
+        """(width, height) of the cached image"""
+        w, h = self.sizes[self.index[path]]
+        return (int(w), int(h))
+
+    def fullsize(self, path):
+        """(width, height) of the original image"""
+        w, h = self.fullsizes[self.index[path]]
+        return (int(w), int(h))
+
+    def array(self, path):
+        """H x W x 3 uint8 view of the cached image, in the memory mapped shard"""
+        i = self.index[path]
+        k = int(self.shard[i])
+        if k not in self.shards:
+            self.shards[k] = self.store['shard-{:05d}'.format(k)]
+        w, h = self.sizes[i]
+        start = int(self.offset[i])
+        return self.shards[k][start:start + h*w*3].reshape(h, w, 3)
+
+    def load(self, path, box=None):
+        """
+        Arguments
+        ---------
+        path : image path as given to build_image_cache
+        box  : optional (x1, y1, x2, y2) crop box in original image coordinates
+
+        Returns
+        -------
+        img : RGB PIL image at the cached resolution
+        box : crop box scaled to the cached image, None if no box was given
+        """
+        img = Image.fromarray(np.array(self.array(path)))
+        if box is not None:
+            fw, fh = self.fullsize(path)
+            sx, sy = img.size[0] / fw, img.size[1] / fh
+            box = (box[0] * sx, box[1] * sy, box[2] * sx, box[3] * sy)
+        return img, box
+
+    def check(self, imsize):
+        # images at a larger size than cached would be upsampled
+        if imsize is None or imsize > self.imsize:
+            raise ValueError('Unsupported image size for an image cache of size {}: {}!'.format(self.imsize, imsize))
+
+    def __repr__(self):
+        fmt_str = self.__class__.__name__ + '\n'
+        fmt_str += '    Root Location: {}\n'.format(self.root)
+        fmt_str += '    Number of images: {}\n'.format(len(self))
+        fmt_str += '    Image size: {}\n'.format(self.imsize)
+        return fmt_str
+
+
+class _DecodedImages(data.Dataset):
+    # images decoded and resized by the data loading workers, as uint8 arrays
+
+    def __init__(self, images, imsize, loader=default_loader):
+        self.images = images
+        self.imsize = imsize
+        self.loader = loader
+
+    def __getitem__(self, index):
+        img = self.loader(self.images[index])
+        fullsize = img.size
+        img = imresize(img, self.imsize)
+        return np.asarray(img, dtype=np.uint8), fullsize
+
+    def __len__(self):
+        return len(self.images)
+
+
+def _collate_list(batch):
+    return batch
+
+
+def build_image_cache(root, images, imsize, shard_size=SHARD_SIZE, num_workers=8, print_freq=1000):
+    """
+    Decodes images once and writes them at training resolution into an image cache
+
+    Every image is loaded with the default loader and resized with imresize to imsize, exactly
+    as ImagesFromList and TuplesDataset do, and its pixels are appended to the current shard.
+    A new shard is started when the current one exceeds shard_size bytes. The index (image path,
+    shard, offset, size and original size) is written with the manifest, after all shards.
+
+    Arguments
+    ---------
+    root       : directory of the cache
+    images     : list of image paths, the keys of the cache
+    imsize     : maximum size of longer image side
+    shard_size : maximum size of a shard file in bytes
+    num_workers: number of decoding workers
+
+    Returns
+    -------
+    cache : ImageCache
+    """
+    loader = torch.utils.data.DataLoader(
+        _DecodedImages(images, imsize), batch_size=16, shuffle=False, num_workers=num_workers,
+        collate_fn=_collate_list
+    )
+
+    shard, offset = np.zeros(len(images), dtype=np.int32), np.zeros(len(images), dtype=np.int64)
+    sizes, fullsizes = np.zeros((len(images), 2), dtype=np.int32), np.zeros((len(images), 2), dtype=np.int32)
+    with StoreWriter(root, meta={'imsize': imsize}) as writer:
+        k, n, current = -1, 0, None
+        for batch in loader:
+            for img, fullsize in batch:
+                if current is None or current.rows + img.size > shard_size:
+                    k += 1
+                    current = writer.stream('shard-{:05d}'.format(k), dtype='uint8')
+                shard[n], offset[n] = k, current.rows
+                sizes[n] = img.shape[1], img.shape[0]
+                fullsizes[n] = fullsize
+                current.append(img.reshape(-1))
+                n += 1
+                if n % print_freq == 0 or n == len(images):
+                    print('\r>>>> {}/{} done...'.format(n, len(images)), end='')
+        print('')
+
+        writer.add_strings('images', images)
+        writer.add('shard', shard)
+        writer.add('offset', offset)
+        writer.add('size', sizes)
+        writer.add('fullsize', fullsizes)
+
+    return ImageCache(root)
+
+
+def load_or_build_image_cache(root, images, imsize, shard_size=SHARD_SIZE, num_workers=8):
+    """
+    Opens the image cache at root if it holds all images at imsize, otherwise (re)builds it
+
+    Returns
+    -------
+    cache : ImageCache
+    """
+    if is_store(root):
+        cache = ImageCache(root)
+        if cache.imsize == imsize and all(path in cache for path in images):
+            print('>> Using image cache {} ({} images)'.format(root, len(cache)))
+            return cache
+
+    print('>> Building image cache {} of {} images at size {}...'.format(root, len(images), imsize))
+    return build_image_cache(root, images, imsize, shard_size=shard_size, num_workers=num_workers)
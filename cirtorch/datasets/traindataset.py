@@ -13,7 +13,10 @@ import random
 
 from cirtorch.datasets.datahelpers import default_loader, imresize, cid2filename
 from cirtorch.datasets.genericdataset import ImagesFromList
+from cirtorch.networks.imageretrievalnet import extract_vectors, ExtractionService
+from cirtorch.networks.featurecache import head_vectors
 from cirtorch.utils.general import get_data_root
+from cirtorch.utils.index import exact_search
 
 default_cities = {
     'train': ["zurich", "london", "boston", "melbourne", "amsterdam","helsinki",
@@ -29,6 +32,15 @@ default_cities_debug = {
     'test': ["miami"]
 }
 
+# pool images ranked per query and negative for hard negative mining, more are ranked if needed
+MINING_TOPK = 8
+
+
+def _full_rank(poolvecs, qvec):
+    # all pool images ranked for one query, when its top ranked images did not give enough negatives
+    return torch.argsort(torch.mv(poolvecs.t(), qvec), descending=True)
+
+
 class TuplesDataset(data.Dataset):
     """Data loader that loads training and validation tuples of 
         Radenovic etal ECCV16: CNN image retrieval learns from BoW
@@ -43,6 +55,8 @@ class TuplesDataset(data.Dataset):
         nnum (int, Default:5): Number of negatives for a query image in a training tuple
         qsize (int, Default:1000): Number of query images, ie number of (q,p,n1,...nN) tuples, to be processed in one epoch
         poolsize (int, Default:10000): Pool size for negative images re-mining
+        image_cache (ImageCache, Default: None): Cache of decoded images (see imagecache.py) the
+            tuples and the images for mining are read from, instead of decoding their files
 
      Attributes:
         images (list): List of full filenames for each image (qimages + dbimages)
@@ -59,7 +73,7 @@ class TuplesDataset(data.Dataset):
             ie new q-p pairs are picked and negative images are remined
     """
 
-    def __init__(self, name, mode='train', imsize=None, nnum=5, qsize=2000, poolsize=20000, transform=None, loader=default_loader, posDistThr=10, negDistThr=25, root_dir = 'data', cities = '', tuple_mining='default'):
+    def __init__(self, name, mode='train', imsize=None, nnum=5, qsize=2000, poolsize=20000, transform=None, loader=default_loader, posDistThr=10, negDistThr=25, root_dir = 'data', cities = '', tuple_mining='default', image_cache=None):
 
         if name.startswith('mapillary'):
             # Parameters  
@@ -304,8 +318,14 @@ class TuplesDataset(data.Dataset):
 
             self.transform = transform
             self.loader = loader
+            self.image_cache = image_cache
+            self.service = None
+            self.fmaps = None
             self.print_freq = 10
 
+            if image_cache is not None:
+                image_cache.check(imsize)
+
                     
         else:
             raise(RuntimeError("Unknown dataset name!"))
@@ -418,27 +438,66 @@ class TuplesDataset(data.Dataset):
         if self.__len__() == 0:
             raise(RuntimeError("List qidxs is empty. Run ``dataset.create_epoch_tuples(net)`` method to create subset for train/val!"))
 
-        output = []
+        paths = []
         # query image
-        output.append(self.loader(self.qImages[self.qidxs[index]]))
+        paths.append(self.qImages[self.qidxs[index]])
 
         # positive image
         pos_index = random.randint(0, len(self.dbImages[self.pidxs[index]])-1)
-        output.append(self.loader(self.dbImages[self.pidxs[index]][pos_index])) 
+        paths.append(self.dbImages[self.pidxs[index]][pos_index])
         # negative images
         for i in range(len(self.nidxs[index])):
-            output.append(self.loader(self.dbImages[self.nidxs[index][i]]))
+            paths.append(self.dbImages[self.nidxs[index][i]])
 
-        if self.imsize is not None:
-            output = [imresize(img, self.imsize) for img in output]
-        
-        if self.transform is not None:
-            output = [self.transform(output[i]).unsqueeze_(0) for i in range(len(output))]
+        if self.fmaps is not None:
+            # feature maps of the frozen backbone instead of images, see use_feature_maps
+            output = [self.fmaps[self.fmap_index[path]].unsqueeze_(0) for path in paths]
+
+        else:
+            output = [self.load(path) for path in paths]
+
+            if self.imsize is not None:
+                output = [imresize(img, self.imsize) for img in output]
+
+            if self.transform is not None:
+                output = [self.transform(output[i]).unsqueeze_(0) for i in range(len(output))]
 
         target = torch.Tensor([-1, 1] + [0]*len(self.nidxs[index]))
         distances = self.getGpsInformation(index, pos_index)
         return (output, target, distances)
 
+    def start_service(self, num_workers=8):
+        """
+        Starts persistent loader workers over all query and database images, used by the
+        extractions of every following create_epoch_tuples, see ExtractionService
+        """
+        self.service = ExtractionService(list(self.qImages) + list(self.dbImages), self.imsize, self.transform,
+                                         num_workers=num_workers, image_cache=self.image_cache)
+        return self.service
+
+    def use_feature_maps(self, fmaps):
+        """
+        Trains on cached feature maps (see featurecache.extract_feature_maps) of all query and
+        database images instead of the images, for training only the head of a network with a
+        frozen backbone. Tuples then hold 1 x C x h x w feature maps, to be passed through
+        ImageRetrievalNet.head, and the mining extracts descriptors with the head alone.
+        """
+        self.fmaps = fmaps
+        self.fmap_index = {path: i for i, path in enumerate(fmaps.images)}
+
+    def extract(self, net, images):
+        # descriptors for mining, with the head only on the feature maps when the backbone is frozen
+        if self.fmaps is not None:
+            return head_vectors(net, self.fmaps, device=self.device, indices=[self.fmap_index[path] for path in images])
+        return extract_vectors(net, images, self.imsize, self.transform, print_freq=self.print_freq, device=self.device,
+                               image_cache=self.image_cache, service=self.service)
+
+    def load(self, path):
+        # image from the image cache if it holds it, otherwise decoded from its file
+        if self.image_cache is not None and path in self.image_cache:
+            return self.image_cache.load(path)[0]
+        return self.loader(path)
+
     def getGpsInformation(self, index, pos_index):
         distances = []
         qid = self.qImages[self.qidxs[index]].split('/')[-1][:-4]
@@ -511,47 +570,25 @@ class TuplesDataset(data.Dataset):
         idxs2images = torch.randperm(len(self.ppool))[:self.poolsize]
 
         # prepare network
-        net.cuda()
+        net.to(self.device)
         net.eval()
 
         # no gradients computed, to reduce memory and increase speed
         with torch.no_grad():
 
-            print('>> Extracting descriptors for query images...')
-            opt = {'batch_size': 1, 'shuffle': False, 'num_workers': 8, 'pin_memory': True}
-            loader = torch.utils.data.DataLoader(
-                ImagesFromList(root='', images=[self.qImages[i] for i in self.qidxs], imsize=self.imsize, transform=self.transform),
-                **opt)
-
             # extract query vectors
-            qvecs = torch.zeros(net.meta['outputdim'], len(self.qidxs)).cuda()
-            for i, input in enumerate(loader):
-                qvecs[:, i] = net(input.cuda()).data.squeeze()
-                if (i+1) % self.print_freq == 0 or (i+1) == len(self.qidxs):
-                    print('\r>>>> {}/{} done...'.format(i+1, len(self.qidxs)), end='')
-
-            
-            # prepare negative pool data loader
-            print('>> Extracting descriptors for negative pool...')
-            opt = {'batch_size': 1, 'shuffle': False, 'num_workers': 8, 'pin_memory': True}
-            loader = torch.utils.data.DataLoader(
-                ImagesFromList(root='', images=[self.dbImages[i] for i in idxs2images], imsize=self.imsize, transform=self.transform),
-                **opt
-            )
+            print('>> Extracting descriptors for query images...')
+            qvecs = self.extract(net, [self.qImages[i] for i in self.qidxs]).to(self.device)
 
             # extract negative pool vectors
-            poolvecs = torch.zeros(net.meta['outputdim'], len(idxs2images)).cuda()
-            for i, input in enumerate(loader):
-                poolvecs[:, i] = net(input.cuda()).data.squeeze()
-                if (i+1) % self.print_freq == 0 or (i+1) == len(idxs2images):
-                    print('\r>>>> {}/{} done...'.format(i+1, len(idxs2images)), end='')
+            print('>> Extracting descriptors for negative pool...')
+            poolvecs = self.extract(net, [self.dbImages[i] for i in idxs2images]).to(self.device)
 
             print('>> Searching for hard negatives...')
-            # compute dot product scores and ranks on GPU
-            scores = torch.mm(poolvecs.t(), qvecs)
-            scores, ranks = torch.sort(scores, dim=0, descending=True)
-            avg_ndist = torch.tensor(0).float().cuda()  # for statistics
-            n_ndist = torch.tensor(0).float().cuda()  # for statistics
+            # top ranked pool images of every query, on device
+            _, ranks = exact_search(poolvecs, qvecs, MINING_TOPK * self.nnum)
+            avg_ndist = torch.tensor(0).float().to(self.device)  # for statistics
+            n_ndist = torch.tensor(0).float().to(self.device)  # for statistics
             # selection of negative examples
             self.nidxs = []
 
@@ -562,14 +599,17 @@ class TuplesDataset(data.Dataset):
                 r = 0
                 if self.mode == 'train':
                     clusters = self.clusters[idxs2qpool[q]]
+                rank = ranks[q]
                  
                 while len(nidxs) < self.nnum:
-                    potential = int(idxs2images[ranks[r, q]])
+                    if r == len(rank):
+                        rank = _full_rank(poolvecs, qvecs[:, q])
+                    potential = int(idxs2images[rank[r]])
                     # take at most one image from the same cluster
                     if (potential not in clusters) and (potential not in self.pidxs[q]):
                         nidxs.append(potential)
                         clusters = np.append(clusters, np.array(potential))
-                        avg_ndist += torch.pow(qvecs[:,q]-poolvecs[:,ranks[r, q]]+1e-6, 2).sum(dim=0).sqrt()
+                        avg_ndist += torch.pow(qvecs[:,q]-poolvecs[:,rank[r]]+1e-6, 2).sum(dim=0).sqrt()
                         n_ndist += 1
                     r += 1
                 self.nidxs.append(nidxs)
@@ -627,8 +667,8 @@ class TuplesDataset(data.Dataset):
             self.distances = []
 
             # Statistics
-            avg_ndist = torch.tensor(0).float().cuda()  # for statistics
-            n_ndist = torch.tensor(0).float().cuda()  # for statistics
+            avg_ndist = torch.tensor(0).float().to(self.device)  # for statistics
+            n_ndist = torch.tensor(0).float().to(self.device)  # for statistics
             for q in range(len(self.qidxs)):
                 nidxs = []
                 dist_to_query = []
@@ -682,59 +722,29 @@ class TuplesDataset(data.Dataset):
         idxs2images = torch.randperm(len(self.ppool))[:self.poolsize]
 
         # prepare network
-        net.cuda()
+        net.to(self.device)
         net.eval()
 
         # no gradients computed, to reduce memory and increase speed
         with torch.no_grad():
 
+            # extract query vectors
             print('>> Extracting descriptors for query images...')
-            opt = {'batch_size': 1, 'shuffle': False, 'num_workers': 8, 'pin_memory': True}
-            loader = torch.utils.data.DataLoader(
-                ImagesFromList(root='', images=[self.qImages[i] for i in self.qidxs], imsize=self.imsize, transform=self.transform),
-                **opt)
+            qvecs = self.extract(net, [self.qImages[i] for i in self.qidxs]).to(self.device)
 
-            # extract query vectors
-            qvecs = torch.zeros(net.meta['outputdim'], len(self.qidxs)).cuda()
-            for i, input in enumerate(loader):
-                qvecs[:, i] = net(input.cuda()).data.squeeze()
-                if (i+1) % self.print_freq == 0 or (i+1) == len(self.qidxs):
-                    print('\r>>>> {}/{} done...'.format(i+1, len(self.qidxs)), end='')
-            
+            # extract positive vectors
             print('>> Extracting descriptors for positive images...')
-            opt = {'batch_size': 1, 'shuffle': False, 'num_workers': 8, 'pin_memory': True}
-            loader = torch.utils.data.DataLoader(
-                ImagesFromList(root='', images=[self.dbImages[i[0]] for i in self.pidxs], imsize=self.imsize, transform=self.transform),
-                **opt)
-
-            # extract query vectors
-            pvecs = torch.zeros(net.meta['outputdim'], len(self.pidxs)).cuda()
-            for i, input in enumerate(loader):
-                pvecs[:, i] = net(input.cuda()).data.squeeze()
-                if (i+1) % self.print_freq == 0 or (i+1) == len(self.pidxs):
-                    print('\r>>>> {}/{} done...'.format(i+1, len(self.pidxs)), end='')
-            
-            # prepare negative pool data loader
-            print('>> Extracting descriptors for negative pool...')
-            opt = {'batch_size': 1, 'shuffle': False, 'num_workers': 8, 'pin_memory': True}
-            loader = torch.utils.data.DataLoader(
-                ImagesFromList(root='', images=[self.dbImages[i] for i in idxs2images], imsize=self.imsize, transform=self.transform),
-                **opt
-            )
+            pvecs = self.extract(net, [self.dbImages[i[0]] for i in self.pidxs]).to(self.device)
 
             # extract negative pool vectors
-            poolvecs = torch.zeros(net.meta['outputdim'], len(idxs2images)).cuda()
-            for i, input in enumerate(loader):
-                poolvecs[:, i] = net(input.cuda()).data.squeeze()
-                if (i+1) % self.print_freq == 0 or (i+1) == len(idxs2images):
-                    print('\r>>>> {}/{} done...'.format(i+1, len(idxs2images)), end='')
+            print('>> Extracting descriptors for negative pool...')
+            poolvecs = self.extract(net, [self.dbImages[i] for i in idxs2images]).to(self.device)
 
             print('>> Searching for semi hard negatives...')
-            # compute dot product scores and ranks on GPU
-            scores = torch.mm(poolvecs.t(), qvecs)
-            scores, ranks = torch.sort(scores, dim=0, descending=True)
-            avg_ndist = torch.tensor(0).float().cuda()  # for statistics
-            n_ndist = torch.tensor(0).float().cuda()  # for statistics
+            # top ranked pool images of every query, on device
+            _, ranks = exact_search(poolvecs, qvecs, MINING_TOPK * self.nnum)
+            avg_ndist = torch.tensor(0).float().to(self.device)  # for statistics
+            n_ndist = torch.tensor(0).float().to(self.device)  # for statistics
             # selection of negative examples
             self.nidxs = []
             for q in range(len(self.qidxs)):
@@ -745,9 +755,12 @@ class TuplesDataset(data.Dataset):
                 if self.mode == 'train':
                     clusters = self.clusters[idxs2qpool[q]]
                 pos_dist = torch.pow(qvecs[:,q]-pvecs[:,q]+1e-6, 2).sum(dim=0).sqrt()
+                rank = ranks[q]
                 while len(nidxs) < self.nnum:
-                    potential = int(idxs2images[ranks[r, q]])
-                    neg_dist = torch.pow(qvecs[:,q]-poolvecs[:,ranks[r, q]]+1e-6, 2).sum(dim=0).sqrt()
+                    if r == len(rank):
+                        rank = _full_rank(poolvecs, qvecs[:, q])
+                    potential = int(idxs2images[rank[r]])
+                    neg_dist = torch.pow(qvecs[:,q]-poolvecs[:,rank[r]]+1e-6, 2).sum(dim=0).sqrt()
                     # take at most one image from the same cluster
                     if (potential not in clusters) and ((potential not in self.pidxs[q]) and (neg_dist > pos_dist)):
                         nidxs.append(potential)
@@ -0,0 +1,61 @@
+import argparse
+import os
+import time
+
+from torchvision import transforms
+
+from cirtorch.datasets.genericdataset import ImagesFromList
+
+parser = argparse.ArgumentParser(description='PyTorch CNN Image Retrieval Decoding Benchmark')
+
+parser.add_argument('image_dir', metavar='IMAGE_DIR',
+                    help='folder with sample images used for the benchmark, eg a few hundred MSLS images')
+parser.add_argument('--image-size', '-imsize', default=1024, type=int, metavar='N',
+                    help='maximum size of longer image side (default: 1024)')
+parser.add_argument('--fixed-size', default='240,320', metavar='H,W',
+                    help="size of the transforms.Resize following the thumbnail as in the mapillary scripts," +
+                        " 'none' for no fixed resize (default: '240,320')")
+parser.add_argument('--max-images', default=500, type=int, metavar='N',
+                    help='maximum number of images taken from IMAGE_DIR (default: 500)')
+
+def decode(dataset):
+    # cpu time spent in decoding and transforming all images, in the current process
+    images = []
+    start = time.process_time()
+    for i in range(len(dataset)):
+        images.append(dataset[i])
+    return time.process_time() - start, images
+
+def main():
+    args = parser.parse_args()
+
+    images = sorted([os.path.join(args.image_dir, f) for f in os.listdir(args.image_dir)
+                     if f.lower().endswith(('.jpg', '.jpeg', '.png'))])[:args.max_images]
+    if len(images) == 0:
+        raise RuntimeError('No images found in {}!'.format(args.image_dir))
+
+    # transform as in the mapillary scripts, the normalization does not matter here
+    if args.fixed_size == 'none':
+        transform = transforms.ToTensor()
+    else:
+        size = tuple(int(s) for s in args.fixed_size.split(','))
+        transform = transforms.Compose([transforms.Resize(size, interpolation=2), transforms.ToTensor()])
+
+    results = []
+    for name, draft in [('full decode + thumbnail + resize', False), ('reduced-resolution decode', True)]:
+        dataset = ImagesFromList(root='', images=images, imsize=args.image_size, transform=transform, draft=draft)
+        # warm up the file system cache
+        decode(dataset)
+        elapsed, tensors = decode(dataset)
+        results.append((name, elapsed, tensors))
+        print('>> {}: {:.1f} images/s, {:.2f} ms cpu time per image'
+            .format(name, len(images) / elapsed, 1000 * elapsed / len(images)))
+
+    (_, t1, full), (_, t2, drafted) = results
+    same = [i for i in range(len(images)) if full[i].shape == drafted[i].shape]
+    diff = max([(full[i] - drafted[i]).abs().mean().item() for i in same] or [float('nan')])
+    print('>> Reduced-resolution decode: {:.2f}x speed-up, {}/{} images of the same size, max mean abs pixel difference {:.4f}'
+        .format(t1 / t2, len(same), len(images), diff))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+import argparse
+import os
+import time
+
+from torchvision import transforms
+
+from cirtorch.networks.imageretrievalnet import init_network, extract_vectors
+from cirtorch.networks.inference import get_device, prepare_network
+from cirtorch.utils.general import htime
+
+parser = argparse.ArgumentParser(description='PyTorch CNN Image Retrieval Extraction Benchmark')
+
+parser.add_argument('image_dir', metavar='IMAGE_DIR',
+                    help='folder with sample images used for the benchmark')
+parser.add_argument('--network-offtheshelf', '-noff', metavar='NETWORK', default='resnet50-gem',
+                    help="off-the-shelf network, in the format 'ARCHITECTURE-POOLING' or 'ARCHITECTURE-POOLING-{reg-lwhiten-whiten}'" +
+                        " (default: 'resnet50-gem')")
+parser.add_argument('--not-pretrained', dest='pretrained', action='store_false',
+                    help='use random weights instead of downloading pretrained ones')
+parser.add_argument('--image-size', '-imsize', default=1024, type=int, metavar='N',
+                    help='maximum size of longer image side (default: 1024)')
+parser.add_argument('--fixed-size', dest='fixed_size', action='store_true',
+                    help='resize every image to 240x320 as in the mapillary scripts')
+parser.add_argument('--max-images', default=500, type=int, metavar='N',
+                    help='maximum number of images taken from IMAGE_DIR (default: 500)')
+parser.add_argument('--batch-size', '-b', default=16, type=int, metavar='N',
+                    help='batch size of the batched extraction (default: 16)')
+parser.add_argument('--no-pad', dest='pad', action='store_false',
+                    help='batch only images of exactly the same size instead of padding similar ones')
+parser.add_argument('--multiscale', '-ms', metavar='MULTISCALE', default='[1]',
+                    help="scales used for extraction, examples: '[1]' | '[1, 1/2**(1/2), 1/2]' (default: '[1]')")
+
+parser.add_argument('--workers', '-j', default=8, type=int, metavar='N',
+                    help='number of data loading workers (default: 8)')
+
+# inference engine options
+parser.add_argument('--device', default=None, metavar='DEVICE',
+                    help="device used for the benchmark, 'cpu' or 'cuda' (default: cuda if available)")
+parser.add_argument('--threads', default=None, type=int, metavar='N',
+                    help='number of intra-op threads on cpu (default: all available cpus)')
+parser.add_argument('--interop-threads', default=None, type=int, metavar='N',
+                    help='number of inter-op threads on cpu (default: 1)')
+parser.add_argument('--channels-last', dest='channels_last', action='store_true',
+                    help='run the optimized configuration in channels-last memory layout')
+parser.add_argument('--fuse-bn', dest='fuse_bn', action='store_true',
+                    help='fold batch normalization into convolutions in the optimized configuration')
+
+# GPU ID
+parser.add_argument('--gpu-id', '-g', default='0', metavar='N',
+                    help="gpu id used for the benchmark (default: '0')")
+
+def main():
+    args = parser.parse_args()
+
+    # setting up the visible GPU
+    os.environ['CUDA_VISIBLE_DEVICES'] = args.gpu_id
+
+    images = sorted([os.path.join(args.image_dir, f) for f in os.listdir(args.image_dir)
+                     if f.lower().endswith(('.jpg', '.jpeg', '.png'))])[:args.max_images]
+    if len(images) == 0:
+        raise RuntimeError('No images found in {}!'.format(args.image_dir))
+
+    # loading off-the-shelf network
+    offtheshelf = args.network_offtheshelf.split('-')
+    net_params = {}
+    net_params['architecture'] = offtheshelf[0]
+    net_params['pooling'] = offtheshelf[1]
+    net_params['local_whitening'] = 'lwhiten' in offtheshelf[2:]
+    net_params['regional'] = 'reg' in offtheshelf[2:]
+    net_params['whitening'] = 'whiten' in offtheshelf[2:]
+    net_params['pretrained'] = args.pretrained
+    net = init_network(net_params)
+    print(">>>> loaded network: ")
+    print(net.meta_repr())
+
+    # set up the transform
+    normalize = transforms.Normalize(mean=net.meta['mean'], std=net.meta['std'])
+    if args.fixed_size:
+        transform = transforms.Compose([transforms.Resize((240, 320), interpolation=2), transforms.ToTensor(), normalize])
+    else:
+        transform = transforms.Compose([transforms.ToTensor(), normalize])
+
+    ms = list(eval(args.multiscale))
+    msp = net.pool.p.item() if len(ms) > 1 and net.meta['pooling'] == 'gem' else 1
+
+    # plain network and network prepared by the inference engine
+    device = get_device(args.device)
+    net = prepare_network(net, device=device, threads=args.threads, interop_threads=args.interop_threads)
+    optnet = prepare_network(net, device=device, threads=args.threads, interop_threads=args.interop_threads,
+                             channels_last=args.channels_last, fuse_bn=args.fuse_bn)
+
+    configs = [('batch size 1', net, 1),
+               ('batch size {}'.format(args.batch_size), net, args.batch_size)]
+    if args.channels_last or args.fuse_bn:
+        name = 'batch size {}{}{}'.format(args.batch_size, ' + channels-last' if args.channels_last else '',
+                                          ' + fused bn' if args.fuse_bn else '')
+        configs.append((name, optnet, args.batch_size))
+
+    results = []
+    for name, n, batch_size in configs:
+        # warm up workers, cudnn / mkldnn and allocator
+        extract_vectors(n, images[:2*batch_size], args.image_size, transform, ms=ms, msp=msp, batch_size=batch_size,
+                        pad=args.pad, device=device, num_workers=args.workers)
+
+        print('>> Extracting {} images on {} with {}...'.format(len(images), device, name))
+        start = time.time()
+        vecs = extract_vectors(n, images, args.image_size, transform, ms=ms, msp=msp, batch_size=batch_size,
+                               pad=args.pad, device=device, num_workers=args.workers)
+        elapsed = time.time() - start
+        results.append((name, vecs, elapsed))
+        print('>> {}: {:.2f} images/s (elapsed time: {})'.format(name, len(images) / elapsed, htime(elapsed)))
+
+    _, vecs1, t1 = results[0]
+    for name, vecs, t in results[1:]:
+        print('>> {} over batch size 1: {:.2f}x speed-up, max abs descriptor difference {:.2e}, min cosine similarity {:.6f}'
+            .format(name, t1 / t, (vecs1 - vecs).abs().max().item(), (vecs1 * vecs).sum(0).min().item()))
+
+    # multi-scale extraction compared to single-scale extraction of the fastest configuration
+    if len(ms) > 1:
+        name, n, batch_size = configs[-1]
+        print('>> Extracting {} images on {} with {}, single scale...'.format(len(images), device, name))
+        start = time.time()
+        extract_vectors(n, images, args.image_size, transform, batch_size=batch_size, pad=args.pad, device=device,
+                        num_workers=args.workers)
+        elapsed = time.time() - start
+        print('>> {}, single scale: {:.2f} images/s, multi-scale takes {:.2f}x the single-scale time'
+            .format(name, len(images) / elapsed, results[-1][2] / elapsed))
+
+if __name__ == '__main__':
+    main()
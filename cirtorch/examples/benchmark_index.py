@@ -0,0 +1,80 @@
+import argparse
+import os
+import time
+
+import numpy as np
+
+import torch
+
+from cirtorch.networks.inference import set_threads
+from cirtorch.utils.index import exact_search, index_factory, print_index_memory
+from cirtorch.utils.store import load_vectors
+
+parser = argparse.ArgumentParser(description='PyTorch CNN Image Retrieval Approximate Search Benchmark')
+
+parser.add_argument('descriptors', metavar='DESCRIPTORS_DIR',
+                    help="directory with the descriptor stores 'db' and 'query', eg written by" +
+                        " test_mapillary --descriptors DESCRIPTORS_DIR")
+parser.add_argument('--indexes', metavar='INDEXES', default='pq64,opq-pq64,ivf256-pq32,ivf1024-pq32,bin512',
+                    help="comma separated list of indexes, in the format 'pqM' | 'opq-pqM' | 'ivfNLIST-pqM' | 'binNBITS'" +
+                        " (default: 'pq64,opq-pq64,ivf256-pq32,ivf1024-pq32,bin512')")
+parser.add_argument('--nprobe', metavar='NPROBE', default='1,2,4,8,16,32,64',
+                    help="comma separated list of numbers of visited inverted lists of the 'ivf' indexes" +
+                        " (default: '1,2,4,8,16,32,64')")
+parser.add_argument('--shortlist', metavar='SHORTLIST', default='100,1000,10000',
+                    help="comma separated list of numbers of candidates re-ranked per query by the 'bin' indexes" +
+                        " (default: '100,1000,10000')")
+parser.add_argument('--topk', default=10, type=int, metavar='N',
+                    help='number of nearest neighbours compared with the exact search (default: 10)')
+parser.add_argument('--threads', default=None, type=int, metavar='N',
+                    help='number of intra-op threads (default: all available cpus)')
+
+def timed(search, nq):
+    # milliseconds per query, best of two runs
+    elapsed = []
+    for _ in range(2):
+        start = time.time()
+        result = search()
+        elapsed.append(time.time() - start)
+    return 1000 * min(elapsed) / nq, result
+
+def main():
+    args = parser.parse_args()
+    k = args.topk
+
+    threads, _ = set_threads(args.threads)
+    print('>> Running on cpu with {} threads'.format(threads))
+
+    vecs = torch.from_numpy(np.array(load_vectors(os.path.join(args.descriptors, 'db')), dtype=np.float32).T)
+    qvecs = torch.from_numpy(np.array(load_vectors(os.path.join(args.descriptors, 'query')), dtype=np.float32).T)
+    nq = qvecs.shape[1]
+    print('>> {} database and {} query descriptors of dimension {}'.format(vecs.shape[1], nq, vecs.shape[0]))
+
+    # exact search, the ground truth neighbours
+    latency, (_, exact) = timed(lambda: exact_search(vecs, qvecs, k), nq)
+    exact = exact.numpy()
+    print('>> exact: {:.3f} ms per query, {:.1f} MB of descriptors'.format(latency, vecs.numel() * 4 / 1024**2))
+
+    for spec in args.indexes.split(','):
+        start = time.time()
+        index = index_factory(spec, vecs.shape[0]).train(vecs)
+        index.add(vecs)
+        print('>> {}: built in {:.1f} s'.format(spec, time.time() - start))
+        print_index_memory(spec, index)
+
+        # visited inverted lists or re-ranked candidates, all codes are scored by the other indexes
+        if hasattr(index, 'nlist'):
+            settings = [('nprobe', int(n)) for n in args.nprobe.split(',')]
+        elif hasattr(index, 'vecs'):
+            settings = [('shortlist', int(n)) for n in args.shortlist.split(',')]
+        else:
+            settings = [('nprobe', 1)]
+        for name, value in settings:
+            latency, (_, ranks) = timed(lambda: index.search(qvecs, k, **{name: value}), nq)
+            recall = np.mean([len(np.intersect1d(ranks[i], exact[i])) / k for i in range(nq)])
+            recall1 = np.mean(ranks[:, 0] == exact[:, 0])
+            print('>>>> {} {:5d}: {:.3f} ms per query, recall@{} {:.3f}, 1-recall@1 {:.3f}'
+                .format(name, value, latency, k, recall, recall1))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,216 @@
+import argparse
+import os
+import time
+
+import numpy as np
+
+import torch
+from torch.utils.model_zoo import load_url
+from torchvision import transforms
+
+from cirtorch.networks.imageretrievalnet import init_network, extract_vectors
+from cirtorch.networks.inference import set_threads
+from cirtorch.networks.quantization import quantize_network, model_size
+from cirtorch.datasets.traindataset import TuplesDataset
+from cirtorch.utils.evaluate import mapk, recall
+from cirtorch.utils.index import exact_search
+from cirtorch.utils.general import get_data_root, htime
+
+PRETRAINED = {
+    'retrievalSfM120k-vgg16-gem'        : 'http://cmp.felk.cvut.cz/cnnimageretrieval/data/networks/retrieval-SfM-120k/retrievalSfM120k-vgg16-gem-b4dcdc6.pth',
+    'retrievalSfM120k-resnet101-gem'    : 'http://cmp.felk.cvut.cz/cnnimageretrieval/data/networks/retrieval-SfM-120k/retrievalSfM120k-resnet101-gem-b80fb85.pth',
+    # new networks with whitening learned end-to-end
+    'rSfM120k-tl-resnet50-gem-w'        : 'http://cmp.felk.cvut.cz/cnnimageretrieval/data/networks/retrieval-SfM-120k/rSfM120k-tl-resnet50-gem-w-97bf910.pth',
+    'rSfM120k-tl-resnet101-gem-w'       : 'http://cmp.felk.cvut.cz/cnnimageretrieval/data/networks/retrieval-SfM-120k/rSfM120k-tl-resnet101-gem-w-a155e54.pth',
+    'rSfM120k-tl-resnet152-gem-w'       : 'http://cmp.felk.cvut.cz/cnnimageretrieval/data/networks/retrieval-SfM-120k/rSfM120k-tl-resnet152-gem-w-f39cada.pth',
+    'gl18-tl-resnet50-gem-w'            : 'http://cmp.felk.cvut.cz/cnnimageretrieval/data/networks/gl18/gl18-tl-resnet50-gem-w-83fdc30.pth',
+    'gl18-tl-resnet101-gem-w'           : 'http://cmp.felk.cvut.cz/cnnimageretrieval/data/networks/gl18/gl18-tl-resnet101-gem-w-a4d43db.pth',
+    'gl18-tl-resnet152-gem-w'           : 'http://cmp.felk.cvut.cz/cnnimageretrieval/data/networks/gl18/gl18-tl-resnet152-gem-w-21278d5.pth',
+}
+
+parser = argparse.ArgumentParser(description='PyTorch CNN Image Retrieval int8 Quantization Report')
+
+# network
+group = parser.add_mutually_exclusive_group(required=True)
+group.add_argument('--network-path', '-npath', metavar='NETWORK',
+                    help="pretrained network or network path (destination where network is saved)")
+group.add_argument('--network-offtheshelf', '-noff', metavar='NETWORK',
+                    help="off-the-shelf network, in the format 'ARCHITECTURE-POOLING' or 'ARCHITECTURE-POOLING-{reg-lwhiten-whiten}'," +
+                        " examples: 'resnet101-gem' | 'resnet101-gem-reg' | 'resnet101-gem-whiten' | 'resnet101-gem-lwhiten' | 'resnet101-gem-reg-whiten'")
+
+# report options
+parser.add_argument('--image-size', default=1024, type=int, metavar='N',
+                    help='maximum size of longer image side used for testing (default: 1024)')
+parser.add_argument('--calibration-images', default=500, type=int, metavar='N',
+                    help='number of MSLS training database images used to calibrate the activations (default: 500)')
+parser.add_argument('--calibration-cities', default='', metavar='CITIES',
+                    help="comma separated MSLS training cities the calibration images are sampled from (default: all)")
+parser.add_argument('--latency-images', default=100, type=int, metavar='N',
+                    help='number of query images used to measure the latency of a single image (default: 100)')
+parser.add_argument('--backend', default=None, metavar='ENGINE',
+                    help="quantized engine, 'fbgemm' | 'qnnpack' (default: the torch default)")
+parser.add_argument('--save', metavar='FILE', default=None,
+                    help='save the quantized network (torch.save of the whole module) to FILE (default: None)')
+
+parser.add_argument('--batch-size', '-b', default=1, type=int, metavar='N',
+                    help='number of images extracted together (default: 1)')
+parser.add_argument('--workers', '-j', default=8, type=int, metavar='N',
+                    help='number of data loading workers (default: 8)')
+parser.add_argument('--threads', default=None, type=int, metavar='N',
+                    help='number of intra-op threads (default: all available cpus)')
+
+def main():
+    args = parser.parse_args()
+    imsize = args.image_size
+
+    # quantized networks run on cpu, the float network is compared on cpu as well
+    device = torch.device('cpu')
+    threads, _ = set_threads(args.threads)
+    print('>> Running on cpu with {} threads'.format(threads))
+
+    # loading network from path
+    if args.network_path is not None:
+
+        print(">> Loading network:\n>>>> '{}'".format(args.network_path))
+        if args.network_path in PRETRAINED:
+            # pretrained networks (downloaded automatically)
+            state = load_url(PRETRAINED[args.network_path], model_dir=os.path.join(get_data_root(), 'networks'))
+        else:
+            # fine-tuned network from path
+            state = torch.load(args.network_path, map_location=device)
+
+        # parsing net params from meta
+        # architecture, pooling, mean, std required
+        # the rest has default values, in case that is doesnt exist
+        net_params = {}
+        net_params['architecture'] = state['meta']['architecture']
+        net_params['pooling'] = state['meta']['pooling']
+        net_params['local_whitening'] = state['meta'].get('local_whitening', False)
+        net_params['regional'] = state['meta'].get('regional', False)
+        net_params['whitening'] = state['meta'].get('whitening', False)
+        net_params['mean'] = state['meta']['mean']
+        net_params['std'] = state['meta']['std']
+        net_params['pretrained'] = False
+
+        # load network
+        net = init_network(net_params)
+        net.load_state_dict(state['state_dict'])
+
+        print(">>>> loaded network: ")
+        print(net.meta_repr())
+
+    # loading offtheshelf network
+    elif args.network_offtheshelf is not None:
+
+        # parse off-the-shelf parameters
+        offtheshelf = args.network_offtheshelf.split('-')
+        net_params = {}
+        net_params['architecture'] = offtheshelf[0]
+        net_params['pooling'] = offtheshelf[1]
+        net_params['local_whitening'] = 'lwhiten' in offtheshelf[2:]
+        net_params['regional'] = 'reg' in offtheshelf[2:]
+        net_params['whitening'] = 'whiten' in offtheshelf[2:]
+        net_params['pretrained'] = True
+
+        # load off-the-shelf network
+        print(">> Loading off-the-shelf network:\n>>>> '{}'".format(args.network_offtheshelf))
+        net = init_network(net_params)
+        print(">>>> loaded network: ")
+        print(net.meta_repr())
+
+    net.eval()
+
+    # set up the transform
+    resize = transforms.Resize((240,320), interpolation=2)
+    normalize = transforms.Normalize(
+        mean=net.meta['mean'],
+        std=net.meta['std']
+    )
+    transform = transforms.Compose([
+        resize,
+        transforms.ToTensor(),
+        normalize
+    ])
+
+    # calibration images, a random sample of the MSLS training database
+    train_dataset = TuplesDataset(
+        name='mapillary',
+        mode='train',
+        imsize=imsize,
+        nnum=0,
+        transform=transform,
+        posDistThr=25,
+        negDistThr=25,
+        cities=args.calibration_cities
+    )
+    ncalibration = min(args.calibration_images, len(train_dataset.dbImages))
+    calibration = list(np.random.RandomState(0).choice(train_dataset.dbImages, ncalibration, replace=False))
+
+    start = time.time()
+    qnet = quantize_network(net, calibration, imsize, transform, backend=args.backend,
+                            batch_size=args.batch_size, num_workers=args.workers)
+    print('>> Quantized network in {}'.format(htime(time.time()-start)))
+    if args.save is not None:
+        torch.save(qnet, args.save)
+        print('>> Saved quantized network to {}'.format(args.save))
+
+    # evaluation on the MSLS test split, as in test_mapillary
+    test_dataset = TuplesDataset(
+        name='mapillary',
+        mode='test',
+        imsize=imsize,
+        transform=transform,
+        posDistThr=25,
+        negDistThr=25
+    )
+    qidxs, pidxs = test_dataset.get_loaders()
+    qimages = [test_dataset.qImages[i] for i in qidxs]
+
+    ks = [1, 5, 10]
+    results = []
+    for name, n in [('fp32', net), ('int8', qnet)]:
+        # latency of a single image, after warming up
+        latency_images = qimages[:args.latency_images]
+        extract_vectors(n, latency_images[:2], imsize, transform, device=device, num_workers=0)
+        start = time.time()
+        extract_vectors(n, latency_images, imsize, transform, print_freq=len(latency_images)+1, device=device,
+                        num_workers=0)
+        latency = (time.time() - start) / len(latency_images)
+
+        print('>> {}: Extracting Database Images...'.format(name))
+        start = time.time()
+        poolvecs = extract_vectors(n, test_dataset.dbImages, imsize, transform, batch_size=args.batch_size,
+                                   device=device, num_workers=args.workers)
+        print('>> {}: Extracting Query Images...'.format(name))
+        qvecs = extract_vectors(n, qimages, imsize, transform, batch_size=args.batch_size, device=device,
+                                num_workers=args.workers)
+        elapsed = time.time() - start
+
+        _, ranks = exact_search(poolvecs, qvecs, max(ks))
+        ranks = ranks.numpy()
+
+        results.append({
+            'name': name,
+            'recall': recall(ranks, pidxs, ks),
+            'map': mapk(ranks, pidxs, 5),
+            'latency': latency,
+            'throughput': (len(test_dataset.dbImages) + len(qimages)) / elapsed,
+            'size': model_size(n),
+            'qvecs': qvecs,
+        })
+
+    # report
+    print('>> Quantization report (cpu, {} threads, engine {}):'.format(threads, qnet.meta['quantized']))
+    print('>>>> {:<6} {:>10} {:>10} {:>10} {:>8} {:>14} {:>10} {:>10}'.format(
+        'model', 'recall@1', 'recall@5', 'recall@10', 'mAP@5', 'latency [ms]', 'images/s', 'size [MB]'))
+    for r in results:
+        print('>>>> {:<6} {:>10.4f} {:>10.4f} {:>10.4f} {:>8.4f} {:>14.1f} {:>10.2f} {:>10.1f}'.format(
+            r['name'], r['recall'][0], r['recall'][1], r['recall'][2], r['map'], 1000 * r['latency'],
+            r['throughput'], r['size'] / 1024**2))
+    fp32, int8 = results
+    print('>> int8 over fp32: {:.2f}x latency speed-up, {:.2f}x throughput, {:.2f}x smaller, min cosine similarity of query descriptors {:.6f}'
+        .format(fp32['latency'] / int8['latency'], int8['throughput'] / fp32['throughput'], fp32['size'] / int8['size'],
+                (fp32['qvecs'] * int8['qvecs']).sum(0).min().item()))
+
+if __name__ == '__main__':
+    main()
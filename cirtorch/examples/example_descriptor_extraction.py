@@ -75,6 +75,21 @@ def main():
     vec = whitenapply(vec.reshape(-1,1), whiten_ms['m'], whiten_ms['P']).reshape(-1)
     print(vec)
     print("\n")
+
+
+    print("use the same network with the learned whitening folded into it, reduced to 512 dimensions")
+    # single-scale extraction, whitened descriptors come straight out of the network
+    net.fold_whitening(whiten_ss, dimensions=512)
+    vec = extract_ss(net, transform(imresize(img, input_resol)).unsqueeze(0).cuda())
+    vec = vec.data.cpu().numpy()
+    print(vec)
+
+    # multi-scale extraction, the whitening is applied to the multi-scale descriptor
+    net.fold_whitening(whiten_ms, dimensions=512)
+    vec = extract_ms(net, transform(imresize(img, input_resol)).unsqueeze(0).cuda(), ms = scales, msp = net.pool.p.item())
+    vec = vec.data.cpu().numpy()
+    print(vec)
+    print("\n")
     
 
     print("use pre-trained (on ImageNet) network with appended mac pooling")
@@ -0,0 +1,143 @@
+import argparse
+import os
+import time
+
+import torch
+from torch.utils.model_zoo import load_url
+
+from cirtorch.networks.imageretrievalnet import init_network
+from cirtorch.networks.export import export_network, load_network, validate_export
+from cirtorch.utils.general import get_data_root, htime
+
+PRETRAINED = {
+    'retrievalSfM120k-vgg16-gem'        : 'http://cmp.felk.cvut.cz/cnnimageretrieval/data/networks/retrieval-SfM-120k/retrievalSfM120k-vgg16-gem-b4dcdc6.pth',
+    'retrievalSfM120k-resnet101-gem'    : 'http://cmp.felk.cvut.cz/cnnimageretrieval/data/networks/retrieval-SfM-120k/retrievalSfM120k-resnet101-gem-b80fb85.pth',
+    # new networks with whitening learned end-to-end
+    'rSfM120k-tl-resnet50-gem-w'        : 'http://cmp.felk.cvut.cz/cnnimageretrieval/data/networks/retrieval-SfM-120k/rSfM120k-tl-resnet50-gem-w-97bf910.pth',
+    'rSfM120k-tl-resnet101-gem-w'       : 'http://cmp.felk.cvut.cz/cnnimageretrieval/data/networks/retrieval-SfM-120k/rSfM120k-tl-resnet101-gem-w-a155e54.pth',
+    'rSfM120k-tl-resnet152-gem-w'       : 'http://cmp.felk.cvut.cz/cnnimageretrieval/data/networks/retrieval-SfM-120k/rSfM120k-tl-resnet152-gem-w-f39cada.pth',
+    'gl18-tl-resnet50-gem-w'            : 'http://cmp.felk.cvut.cz/cnnimageretrieval/data/networks/gl18/gl18-tl-resnet50-gem-w-83fdc30.pth',
+    'gl18-tl-resnet101-gem-w'           : 'http://cmp.felk.cvut.cz/cnnimageretrieval/data/networks/gl18/gl18-tl-resnet101-gem-w-a4d43db.pth',
+    'gl18-tl-resnet152-gem-w'           : 'http://cmp.felk.cvut.cz/cnnimageretrieval/data/networks/gl18/gl18-tl-resnet152-gem-w-21278d5.pth',
+}
+
+parser = argparse.ArgumentParser(description='PyTorch CNN Image Retrieval Network Export')
+
+# network
+group = parser.add_mutually_exclusive_group(required=True)
+group.add_argument('--network-path', '-npath', metavar='NETWORK',
+                    help="pretrained network or network path (destination where network is saved)")
+group.add_argument('--network-offtheshelf', '-noff', metavar='NETWORK',
+                    help="off-the-shelf network, in the format 'ARCHITECTURE-POOLING' or 'ARCHITECTURE-POOLING-{reg-lwhiten-whiten}'," +
+                        " examples: 'resnet101-gem' | 'resnet101-gem-reg' | 'resnet101-gem-whiten' | 'resnet101-gem-lwhiten' | 'resnet101-gem-reg-whiten'")
+
+# export options
+parser.add_argument('output', metavar='FILE',
+                    help="exported graph, TorchScript for '.pt' files, ONNX for '.onnx' files")
+parser.add_argument('--input-size', default='240,320', metavar='H,W',
+                    help="size of the example input used for tracing, R-MAC graphs only accept this size (default: '240,320')")
+parser.add_argument('--whitening', '-w', metavar='DATASET', default=None,
+                    help="append the learned whitening meta['Lw'][DATASET]['ss'] of the network (default: None)")
+parser.add_argument('--dimensions', default=None, type=int, metavar='N',
+                    help='number of learned whitening dimensions kept (default: all)')
+parser.add_argument('--opset-version', default=11, type=int, metavar='N',
+                    help='ONNX opset version (default: 11)')
+parser.add_argument('--tolerance', default=1e-4, type=float, metavar='TOL',
+                    help='maximum absolute descriptor difference to eager mode accepted (default: 1e-4)')
+
+def main():
+    args = parser.parse_args()
+    input_size = tuple(int(s) for s in args.input_size.split(','))
+
+    start = time.time()
+
+    # loading network from path
+    if args.network_path is not None:
+
+        print(">> Loading network:\n>>>> '{}'".format(args.network_path))
+        if args.network_path in PRETRAINED:
+            # pretrained networks (downloaded automatically)
+            state = load_url(PRETRAINED[args.network_path], model_dir=os.path.join(get_data_root(), 'networks'))
+        else:
+            # fine-tuned network from path
+            state = torch.load(args.network_path, map_location='cpu')
+
+        # parsing net params from meta
+        # architecture, pooling, mean, std required
+        # the rest has default values, in case that is doesnt exist
+        net_params = {}
+        net_params['architecture'] = state['meta']['architecture']
+        net_params['pooling'] = state['meta']['pooling']
+        net_params['local_whitening'] = state['meta'].get('local_whitening', False)
+        net_params['regional'] = state['meta'].get('regional', False)
+        net_params['whitening'] = state['meta'].get('whitening', False)
+        net_params['mean'] = state['meta']['mean']
+        net_params['std'] = state['meta']['std']
+        net_params['pretrained'] = False
+
+        # load network
+        net = init_network(net_params)
+        net.load_state_dict(state['state_dict'])
+
+        # if whitening is precomputed
+        if 'Lw' in state['meta']:
+            net.meta['Lw'] = state['meta']['Lw']
+
+        print(">>>> loaded network: ")
+        print(net.meta_repr())
+
+    # loading offtheshelf network
+    elif args.network_offtheshelf is not None:
+
+        # parse off-the-shelf parameters
+        offtheshelf = args.network_offtheshelf.split('-')
+        net_params = {}
+        net_params['architecture'] = offtheshelf[0]
+        net_params['pooling'] = offtheshelf[1]
+        net_params['local_whitening'] = 'lwhiten' in offtheshelf[2:]
+        net_params['regional'] = 'reg' in offtheshelf[2:]
+        net_params['whitening'] = 'whiten' in offtheshelf[2:]
+        net_params['pretrained'] = True
+
+        # load off-the-shelf network
+        print(">> Loading off-the-shelf network:\n>>>> '{}'".format(args.network_offtheshelf))
+        net = init_network(net_params)
+        print(">>>> loaded network: ")
+        print(net.meta_repr())
+
+    net.eval()
+    eager_time = time.time() - start
+
+    Lw = None
+    if args.whitening is not None:
+        if args.whitening not in net.meta.get('Lw', {}):
+            raise ValueError('Unsupported or unknown whitening: {}!'.format(args.whitening))
+        Lw = net.meta['Lw'][args.whitening]['ss']
+
+    # export
+    format = 'onnx' if args.output.endswith('.onnx') else 'torchscript'
+    print('>> Exporting {} graph to {}...'.format(format, args.output))
+    meta = export_network(net, args.output, input_size=input_size, Lw=Lw, dimensions=args.dimensions,
+                          format=format, opset_version=args.opset_version)
+
+    # cold start of the exported graph
+    start = time.time()
+    exported, meta = load_network(args.output)
+    print('>> Cold start: {} for init_network and weights, {} for the exported graph'
+        .format(htime(eager_time), htime(time.time() - start)))
+
+    # numerical validation against eager mode, on other batch sizes and input sizes than used for tracing
+    torch.manual_seed(0)
+    inputs = [torch.randn(2, 3, input_size[0], input_size[1])]
+    if meta['dynamic_size']:
+        inputs.append(torch.randn(3, 3, input_size[0] + 32, input_size[1] - 64))
+    diff = validate_export(net, exported, inputs, Lw=Lw, dimensions=args.dimensions)
+    print('>> Max abs descriptor difference to eager mode: {:.2e}'.format(diff))
+    if diff > args.tolerance:
+        raise RuntimeError('Exported graph differs from eager mode by {:.2e} > {:.2e}!'.format(diff, args.tolerance))
+
+    print('>> Exported {}-dimensional descriptors, input {}'.format(
+        meta['outputdim'], 'of any size' if meta['dynamic_size'] else 'of size {}x{}'.format(*meta['input_size'])))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,179 @@
+import argparse
+import os
+import time
+import functools
+
+import torch
+from torch.utils.model_zoo import load_url
+from torchvision import transforms
+
+from cirtorch.networks.imageretrievalnet import init_network
+from cirtorch.networks.featurecache import load_or_extract_feature_maps, sweep_heads
+from cirtorch.datasets.traindataset import TuplesDataset
+from cirtorch.utils.evaluate import mapk, recall
+from cirtorch.utils.index import exact_search
+from cirtorch.utils.general import get_data_root, htime
+
+PRETRAINED = {
+    'retrievalSfM120k-vgg16-gem'        : 'http://cmp.felk.cvut.cz/cnnimageretrieval/data/networks/retrieval-SfM-120k/retrievalSfM120k-vgg16-gem-b4dcdc6.pth',
+    'retrievalSfM120k-resnet101-gem'    : 'http://cmp.felk.cvut.cz/cnnimageretrieval/data/networks/retrieval-SfM-120k/retrievalSfM120k-resnet101-gem-b80fb85.pth',
+    # new networks with whitening learned end-to-end
+    'rSfM120k-tl-resnet50-gem-w'        : 'http://cmp.felk.cvut.cz/cnnimageretrieval/data/networks/retrieval-SfM-120k/rSfM120k-tl-resnet50-gem-w-97bf910.pth',
+    'rSfM120k-tl-resnet101-gem-w'       : 'http://cmp.felk.cvut.cz/cnnimageretrieval/data/networks/retrieval-SfM-120k/rSfM120k-tl-resnet101-gem-w-a155e54.pth',
+    'rSfM120k-tl-resnet152-gem-w'       : 'http://cmp.felk.cvut.cz/cnnimageretrieval/data/networks/retrieval-SfM-120k/rSfM120k-tl-resnet152-gem-w-f39cada.pth',
+    'gl18-tl-resnet50-gem-w'            : 'http://cmp.felk.cvut.cz/cnnimageretrieval/data/networks/gl18/gl18-tl-resnet50-gem-w-83fdc30.pth',
+    'gl18-tl-resnet101-gem-w'           : 'http://cmp.felk.cvut.cz/cnnimageretrieval/data/networks/gl18/gl18-tl-resnet101-gem-w-a4d43db.pth',
+    'gl18-tl-resnet152-gem-w'           : 'http://cmp.felk.cvut.cz/cnnimageretrieval/data/networks/gl18/gl18-tl-resnet152-gem-w-21278d5.pth',
+}
+
+parser = argparse.ArgumentParser(description='PyTorch CNN Image Retrieval Head Sweep on Cached Feature Maps')
+
+# network
+group = parser.add_mutually_exclusive_group(required=True)
+group.add_argument('--network-path', '-npath', metavar='NETWORK',
+                    help="pretrained network or network path (destination where network is saved)")
+group.add_argument('--network-offtheshelf', '-noff', metavar='NETWORK',
+                    help="off-the-shelf network, in the format 'ARCHITECTURE-POOLING' or 'ARCHITECTURE-POOLING-{reg-lwhiten-whiten}'," +
+                        " examples: 'resnet101-gem' | 'resnet101-gem-reg' | 'resnet101-gem-whiten' | 'resnet101-gem-lwhiten' | 'resnet101-gem-reg-whiten'")
+
+# sweep options
+parser.add_argument('features', metavar='FEATURES_DIR',
+                    help='directory of the feature map store, the feature maps are extracted into it once')
+parser.add_argument('--heads', default='mac,spoc,gem,gemmp,rmac,mac-reg,gem-reg,gem-lwhiten,gem-whiten',
+                    help="comma separated heads on top of the features of the network, in the format" +
+                        " 'POOLING' or 'POOLING-{reg-lwhiten-whiten}', with pretrained whitening where available," +
+                        " the head of the network itself is always evaluated (default: 'mac,spoc,gem,gemmp,rmac,mac-reg,gem-reg,gem-lwhiten,gem-whiten')")
+parser.add_argument('--image-size', default=1024, type=int, metavar='N',
+                    help='maximum size of longer image side (default: 1024)')
+parser.add_argument('--processes', default=None, type=int, metavar='N',
+                    help='number of processes the heads are evaluated in (default: one per head, at most one per cpu)')
+parser.add_argument('--dtype', metavar='DTYPE', default='float16', choices=['float32', 'float16'],
+                    help="data type of the stored feature maps: 'float32' | 'float16' (default: 'float16')")
+parser.add_argument('--batch-size', '-b', default=16, type=int, metavar='N',
+                    help='number of images extracted together (default: 16)')
+parser.add_argument('--workers', '-j', default=8, type=int, metavar='N',
+                    help='number of data loading workers (default: 8)')
+
+def evaluate(ndb, pidxs, ks, name, vecs):
+    # the first ndb descriptors are the database, the others the queries
+    _, ranks = exact_search(vecs[:, :ndb], vecs[:, ndb:], max(ks + [5]))
+    ranks = ranks.numpy()
+    return recall(ranks, pidxs, ks), mapk(ranks, pidxs, 5)
+
+def main():
+    args = parser.parse_args()
+    imsize = args.image_size
+
+    # loading network from path
+    if args.network_path is not None:
+
+        print(">> Loading network:\n>>>> '{}'".format(args.network_path))
+        if args.network_path in PRETRAINED:
+            # pretrained networks (downloaded automatically)
+            state = load_url(PRETRAINED[args.network_path], model_dir=os.path.join(get_data_root(), 'networks'))
+        else:
+            # fine-tuned network from path
+            state = torch.load(args.network_path, map_location='cpu')
+
+        # parsing net params from meta
+        # architecture, pooling, mean, std required
+        # the rest has default values, in case that is doesnt exist
+        net_params = {}
+        net_params['architecture'] = state['meta']['architecture']
+        net_params['pooling'] = state['meta']['pooling']
+        net_params['local_whitening'] = state['meta'].get('local_whitening', False)
+        net_params['regional'] = state['meta'].get('regional', False)
+        net_params['whitening'] = state['meta'].get('whitening', False)
+        net_params['mean'] = state['meta']['mean']
+        net_params['std'] = state['meta']['std']
+        net_params['pretrained'] = False
+
+        # load network
+        net = init_network(net_params)
+        net.load_state_dict(state['state_dict'])
+
+        # if whitening is precomputed
+        if 'Lw' in state['meta']:
+            net.meta['Lw'] = state['meta']['Lw']
+
+        print(">>>> loaded network: ")
+        print(net.meta_repr())
+
+    # loading offtheshelf network
+    elif args.network_offtheshelf is not None:
+
+        # parse off-the-shelf parameters
+        offtheshelf = args.network_offtheshelf.split('-')
+        net_params = {}
+        net_params['architecture'] = offtheshelf[0]
+        net_params['pooling'] = offtheshelf[1]
+        net_params['local_whitening'] = 'lwhiten' in offtheshelf[2:]
+        net_params['regional'] = 'reg' in offtheshelf[2:]
+        net_params['whitening'] = 'whiten' in offtheshelf[2:]
+        net_params['pretrained'] = True
+
+        # load off-the-shelf network
+        print(">> Loading off-the-shelf network:\n>>>> '{}'".format(args.network_offtheshelf))
+        net = init_network(net_params)
+        print(">>>> loaded network: ")
+        print(net.meta_repr())
+
+    net.eval()
+
+    # heads on top of the same features, built with the parameters of the network
+    heads = {'network': net}
+    for head in args.heads.split(','):
+        params = head.split('-')
+        net_params = {
+            'architecture': net.meta['architecture'],
+            'pooling': params[0],
+            'local_whitening': 'lwhiten' in params[1:],
+            'regional': 'reg' in params[1:],
+            'whitening': 'whiten' in params[1:],
+            'mean': net.meta['mean'],
+            'std': net.meta['std'],
+            'pretrained': True,
+        }
+        heads[head] = init_network(net_params)
+
+    # set up the transform, as in test_mapillary
+    resize = transforms.Resize((240,320), interpolation=2)
+    normalize = transforms.Normalize(
+        mean=net.meta['mean'],
+        std=net.meta['std']
+    )
+    transform = transforms.Compose([
+        resize,
+        transforms.ToTensor(),
+        normalize
+    ])
+    test_dataset = TuplesDataset(
+        name='mapillary',
+        mode='test',
+        imsize=imsize,
+        transform=transform,
+        posDistThr=25,
+        negDistThr=25
+    )
+    qidxs, pidxs = test_dataset.get_loaders()
+    images = list(test_dataset.dbImages) + [test_dataset.qImages[i] for i in qidxs]
+
+    # the backbone runs once, on the first run only
+    start = time.time()
+    load_or_extract_feature_maps(args.features, net, images, imsize, transform, batch_size=args.batch_size,
+                                 num_workers=args.workers, dtype=args.dtype)
+    print('>> Feature maps ready in {}'.format(htime(time.time()-start)))
+
+    # every head only runs pooling and whitening on the cached feature maps
+    start = time.time()
+    ks = [1, 5, 10]
+    results = sweep_heads(heads, args.features, functools.partial(evaluate, len(test_dataset.dbImages), pidxs, ks),
+                          processes=args.processes)
+    print('>> Evaluated {} heads in {}'.format(len(heads), htime(time.time()-start)))
+
+    print('>>>> {:<24} {:>10} {:>10} {:>10} {:>8}'.format('head', 'recall@1', 'recall@5', 'recall@10', 'mAP@5'))
+    for name, (rec, mean_ap) in results.items():
+        print('>>>> {:<24} {:>10.4f} {:>10.4f} {:>10.4f} {:>8.4f}'.format(name, rec[0], rec[1], rec[2], mean_ap))
+
+if __name__ == '__main__':
+    main()
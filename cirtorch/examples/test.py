@@ -16,6 +16,7 @@ from cirtorch.datasets.testdataset import configdataset
 from cirtorch.utils.download import download_train, download_test
 from cirtorch.utils.whiten import whitenlearn, whitenapply
 from cirtorch.utils.evaluate import compute_map_and_print
+from cirtorch.utils.index import exact_search
 from cirtorch.utils.general import get_data_root, htime
 
 PRETRAINED = {
@@ -57,6 +58,9 @@ parser.add_argument('--whitening', '-w', metavar='WHITENING', default=None, choi
                     help="dataset used to learn whitening for testing: " + 
                         " | ".join(whitening_names) + 
                         " (default: None)")
+parser.add_argument('--topk', default=None, type=int, metavar='N',
+                    help='number of database images ranked per query, positives ranked lower count as not retrieved' +
+                        ' (default: all images)')
 
 # GPU ID
 parser.add_argument('--gpu-id', '-g', default='0', metavar='N',
@@ -245,8 +249,8 @@ def main():
         qvecs = qvecs.numpy()
 
         # search, rank, and print
-        scores = np.dot(vecs.T, qvecs)
-        ranks = np.argsort(-scores, axis=0)
+        _, ranks = exact_search(vecs, qvecs, args.topk or vecs.shape[1])
+        ranks = ranks.T
         #TODO: Recall og mapK
         compute_map_and_print(dataset, ranks, cfg['gnd'])
     
@@ -256,8 +260,8 @@ def main():
             qvecs_lw = whitenapply(qvecs, Lw['m'], Lw['P'])
 
             # search, rank, and print
-            scores = np.dot(vecs_lw.T, qvecs_lw)
-            ranks = np.argsort(-scores, axis=0)
+            _, ranks = exact_search(vecs_lw, qvecs_lw, args.topk or vecs_lw.shape[1])
+            ranks = ranks.T
             compute_map_and_print(dataset + ' + whiten', ranks, cfg['gnd'])
         
         print('>> {}: elapsed time: {}'.format(dataset, htime(time.time()-start)))
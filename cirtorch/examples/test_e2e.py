@@ -14,6 +14,9 @@ from cirtorch.networks.imageretrievalnet import init_network, extract_vectors
 from cirtorch.datasets.testdataset import configdataset
 from cirtorch.utils.download import download_train, download_test
 from cirtorch.utils.evaluate import compute_map_and_print
+from cirtorch.utils.index import exact_search, load_or_build_index, descriptors_key, print_index_memory
+from cirtorch.utils.store import extraction_settings
+from cirtorch.utils.rerank import query_expansion, Diffusion
 from cirtorch.utils.general import get_data_root, htime
 
 PRETRAINED = {
@@ -43,6 +46,31 @@ parser.add_argument('--multiscale', '-ms', metavar='MULTISCALE', default='[1]',
                     help="use multiscale vectors for testing, " + 
                     " examples: '[1]' | '[1, 1/2**(1/2), 1/2]' | '[1, 2**(1/2), 1/2**(1/2)]' (default: '[1]')")
 
+# approximate nearest neighbour search
+parser.add_argument('--index', metavar='INDEX', default=None,
+                    help="search the database with an approximate index instead of brute force, in the format" +
+                        " 'pqM' | 'opq-pqM' | 'ivfNLIST-pqM' | 'binNBITS', examples: 'opq-pq64' | 'ivf64-pq32' | 'bin512'" +
+                        " (default: None)")
+parser.add_argument('--index-dir', metavar='DIR', default=None,
+                    help='directory of the indexes, read from it if they were built for the same network and images,' +
+                        ' the database images are then not extracted, otherwise built and written to it (default: None)')
+parser.add_argument('--nprobe', default=8, type=int, metavar='N',
+                    help='number of inverted lists visited per query (default: 8)')
+parser.add_argument('--topk', default=None, type=int, metavar='N',
+                    help='number of database images ranked per query, positives ranked lower count as not retrieved' +
+                        ' (default: all images, 1000 with --index)')
+
+# re-ranking
+parser.add_argument('--qe', default=None, type=int, metavar='N',
+                    help='expand every query with its N top ranked database images and search again (default: None)')
+parser.add_argument('--qe-alpha', default=0, type=float, metavar='ALPHA',
+                    help='weight exponent of alpha query expansion, 0 for average query expansion (default: 0)')
+parser.add_argument('--diffusion', default=None, type=int, metavar='K',
+                    help='re-rank by diffusion on the K nearest neighbour graph of the database (default: None)')
+parser.add_argument('--graph-dir', metavar='DIR', default=None,
+                    help='directory of the nearest neighbour graphs, read from it if they were computed from the same' +
+                        ' descriptors, otherwise computed and written to it (default: None)')
+
 # GPU ID
 parser.add_argument('--gpu-id', '-g', default='0', metavar='N',
                     help="gpu id used for testing (default: '0')")
@@ -54,6 +82,8 @@ def main():
     for dataset in args.datasets.split(','):
         if dataset not in datasets_names:
             raise ValueError('Unsupported or unknown dataset: {}!'.format(dataset))
+    if (args.qe is not None or args.diffusion is not None) and args.index is not None:
+        raise ValueError('Unsupported re-ranking with --index {}, it needs the database descriptors!'.format(args.index))
 
     # check if test dataset are downloaded
     # and download if they are not
@@ -122,20 +152,37 @@ def main():
         
         # extract database and query vectors
         print('>> {}: database images...'.format(dataset))
-        vecs = extract_vectors(net, images, args.image_size, transform, ms=ms)
+        extract_db = lambda: extract_vectors(net, images, args.image_size, transform, ms=ms).numpy()
+        if args.index is not None:
+            # approximate index, searched off its codes, the database is only extracted to build it
+            key = descriptors_key(net, images, **extraction_settings(args.image_size, transform, ms=ms))
+            index = load_or_build_index(args.index_dir and os.path.join(args.index_dir, dataset), args.index,
+                                        extract_db, key=key)
+            print_index_memory(dataset, index)
+        else:
+            vecs = extract_db()
         print('>> {}: query images...'.format(dataset))
         qvecs = extract_vectors(net, qimages, args.image_size, transform, bbxs=bbxs, ms=ms)
         
         print('>> {}: Evaluating...'.format(dataset))
 
         # convert to numpy
-        vecs = vecs.numpy()
         qvecs = qvecs.numpy()
 
         # search, rank, and print
-        scores = np.dot(vecs.T, qvecs)
-        ranks = np.argsort(-scores, axis=0)
-        compute_map_and_print(dataset, ranks, cfg['gnd'])
+        if args.index is not None:
+            _, ranks = index.search(qvecs, args.topk or 1000, nprobe=args.nprobe)
+        else:
+            _, ranks = exact_search(vecs, qvecs, args.topk or vecs.shape[1])
+
+        # re-rank
+        if args.qe is not None:
+            qvecs = query_expansion(vecs, qvecs, ranks, args.qe, alpha=args.qe_alpha)
+            _, ranks = exact_search(vecs, qvecs, args.topk or vecs.shape[1])
+        if args.diffusion is not None:
+            diffusion = Diffusion(vecs, k=args.diffusion, root=args.graph_dir and os.path.join(args.graph_dir, dataset))
+            _, ranks = diffusion.search(qvecs, args.topk or vecs.shape[1])
+        compute_map_and_print(dataset, ranks.T, cfg['gnd'])
         
         print('>> {}: elapsed time: {}'.format(dataset, htime(time.time()-start)))
 
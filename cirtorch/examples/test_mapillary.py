@@ -11,6 +11,8 @@ from torch.utils.model_zoo import load_url
 from torchvision import transforms
 
 from cirtorch.networks.imageretrievalnet import init_network, extract_vectors
+from cirtorch.networks.inference import get_device, prepare_network
+from cirtorch.networks.sharding import extract_sharded
 from cirtorch.datasets.datahelpers import cid2filename
 from cirtorch.datasets.traindataset import TuplesDataset
 from cirtorch.datasets.testdataset import configdataset
@@ -18,6 +20,10 @@ from cirtorch.datasets.genericdataset import ImagesFromList
 from cirtorch.utils.download import download_train, download_test
 from cirtorch.utils.whiten import whitenlearn, whitenapply
 from cirtorch.utils.evaluate import mapk, recall
+from cirtorch.utils.cache import DescriptorCache
+from cirtorch.utils.store import load_or_extract_vectors, extraction_settings
+from cirtorch.utils.index import exact_search, load_or_build_index, descriptors_key, print_index_memory, GeoIndex
+from cirtorch.utils.rerank import query_expansion, Diffusion
 from cirtorch.utils.general import get_data_root, htime
 
 PRETRAINED = {
@@ -59,9 +65,81 @@ parser.add_argument('--whitening', '-w', metavar='WHITENING', default=None, choi
                     help="dataset used to learn whitening for testing: " + 
                         " | ".join(whitening_names) + 
                         " (default: None)")
+parser.add_argument('--fold-whitening', metavar='DATASET', default=None,
+                    help="fold the learned whitening meta['Lw'][DATASET] of the network into its forward pass (default: None)")
+parser.add_argument('--whitening-dimensions', default=None, type=int, metavar='N',
+                    help='number of dimensions kept of the folded learned whitening (default: all)')
 parser.add_argument('--generate-plot', default=False, type=bool, metavar='PLOT',
                     help='Generates a plot over embedding distance and geographical distance')
 
+parser.add_argument('--batch-size', '-b', default=1, type=int, metavar='N',
+                    help='number of images extracted together (default: 1)')
+parser.add_argument('--workers', '-j', default=8, type=int, metavar='N',
+                    help='number of data loading workers (default: 8)')
+parser.add_argument('--draft-decode', dest='draft', action='store_true',
+                    help='decode JPEG images at reduced resolution, just large enough for the resize (faster data loading)')
+parser.add_argument('--shards', default=1, type=int, metavar='N',
+                    help='extract the database images in N shards, one process each, resumable after a crash (default: 1)')
+parser.add_argument('--shard-dir', metavar='DIR', default=None,
+                    help='directory of the shard checkpoints (default: DATA_ROOT/shards/DATASET)')
+
+# inference engine options
+parser.add_argument('--device', default=None, metavar='DEVICE',
+                    help="device used for testing, 'cpu' or 'cuda' (default: cuda if available)")
+parser.add_argument('--threads', default=None, type=int, metavar='N',
+                    help='number of intra-op threads on cpu (default: all available cpus)')
+parser.add_argument('--interop-threads', default=None, type=int, metavar='N',
+                    help='number of inter-op threads on cpu (default: 1)')
+parser.add_argument('--channels-last', dest='channels_last', action='store_true',
+                    help='run the network in channels-last memory layout')
+parser.add_argument('--fuse-bn', dest='fuse_bn', action='store_true',
+                    help='fold batch normalization into the convolutions of the network')
+
+# descriptor cache
+parser.add_argument('--cache-dir', metavar='DIR', default=None,
+                    help='directory of the on-disk descriptor cache, disabled if not given (default: None)')
+parser.add_argument('--cache-size', default=10, type=float, metavar='GB',
+                    help='maximum size of the descriptor cache in GB (default: 10)')
+
+# binary descriptor store
+parser.add_argument('--descriptors', metavar='DIR', default=None,
+                    help='directory of the binary descriptor stores, descriptors are read from it if they were stored' +
+                        ' for the same network and images, otherwise extracted and written to it (default: None)')
+parser.add_argument('--descriptors-dtype', metavar='DTYPE', default='float32', choices=['float32', 'float16'],
+                    help="data type of the stored descriptors: 'float32' | 'float16' (default: 'float32')")
+
+# approximate nearest neighbour search
+parser.add_argument('--index', metavar='INDEX', default=None,
+                    help="search the database with an approximate index instead of brute force, in the format" +
+                        " 'pqM' | 'opq-pqM' | 'ivfNLIST-pqM' | 'binNBITS', examples: 'opq-pq64' | 'ivf1024-pq32' | 'bin512'" +
+                        " (default: None)")
+parser.add_argument('--index-dir', metavar='DIR', default=None,
+                    help='directory of the index, read from it if it was built for the same network and images,' +
+                        ' the database descriptors are then not needed, otherwise built and written to it (default: None)')
+parser.add_argument('--nprobe', default=8, type=int, metavar='N',
+                    help='number of inverted lists visited per query (default: 8)')
+parser.add_argument('--topk', default=100, type=int, metavar='N',
+                    help='number of database images retrieved per query (default: 100)')
+
+# geo-constrained search
+parser.add_argument('--geo-radius', default=None, type=float, metavar='METERS',
+                    help='search only the database images within this radius of the location prior of every query,' +
+                        ' its gps position (default: None, the whole database)')
+parser.add_argument('--geo-noise', default=0, type=float, metavar='METERS',
+                    help='standard deviation of gaussian noise added to the location priors, simulating a coarse' +
+                        ' gps position (default: 0)')
+
+# re-ranking
+parser.add_argument('--qe', default=None, type=int, metavar='N',
+                    help='expand every query with its N top ranked database images and search again (default: None)')
+parser.add_argument('--qe-alpha', default=0, type=float, metavar='ALPHA',
+                    help='weight exponent of alpha query expansion, 0 for average query expansion (default: 0)')
+parser.add_argument('--diffusion', default=None, type=int, metavar='K',
+                    help='re-rank by diffusion on the K nearest neighbour graph of the database (default: None)')
+parser.add_argument('--graph-dir', metavar='DIR', default=None,
+                    help='directory of the nearest neighbour graphs, read from it if they were computed from the same' +
+                        ' descriptors, otherwise computed and written to it (default: None)')
+
 # GPU ID
 parser.add_argument('--gpu-id', '-g', default='0', metavar='N',
                     help="gpu id used for testing (default: '0')")
@@ -74,6 +152,10 @@ def main():
     for dataset in args.datasets.split(','):
         if dataset not in datasets_names:
             raise ValueError('Unsupported or unknown dataset: {}!'.format(dataset))
+    if args.geo_radius is not None and args.index is not None:
+        raise ValueError('Unsupported search: --geo-radius with --index {}!'.format(args.index))
+    if (args.qe is not None or args.diffusion is not None) and args.index is not None:
+        raise ValueError('Unsupported re-ranking with --index {}, it needs the database descriptors!'.format(args.index))
 
     # setting up the visible GPU
     os.environ['CUDA_VISIBLE_DEVICES'] = args.gpu_id
@@ -142,9 +224,22 @@ def main():
     else:
         msp = 1
 
-    # moving network to gpu and eval mode
-    net.cuda()
-    net.eval()
+    # learned whitening folded into the network, descriptors come whitened out of the forward pass
+    if args.fold_whitening is not None:
+        if args.fold_whitening not in net.meta.get('Lw', {}):
+            raise ValueError('Unsupported or unknown whitening: {}!'.format(args.fold_whitening))
+        Lw = net.meta['Lw'][args.fold_whitening]['ms' if len(ms) > 1 else 'ss']
+        net.fold_whitening(Lw, dimensions=args.whitening_dimensions)
+        print(">> Folded learned whitening '{}', {} dimensions".format(args.fold_whitening, net.meta['outputdim']))
+
+    # moving network to device and eval mode
+    device = get_device(args.device)
+    net = prepare_network(net, device=device, threads=args.threads, interop_threads=args.interop_threads,
+                          channels_last=args.channels_last, fuse_bn=args.fuse_bn)
+
+    # descriptor cache, only descriptors of new or changed images are extracted
+    cache = DescriptorCache(args.cache_dir, max_size=int(args.cache_size * 1024**3)) if args.cache_dir else None
+
     # set up the transform
     resize = transforms.Resize((240,320), interpolation=2)
     normalize = transforms.Normalize(
@@ -168,8 +263,6 @@ def main():
     )
     qidxs, pidxs = test_dataset.get_loaders()
 
-    opt = {'batch_size': 1, 'shuffle': False, 'num_workers': 8, 'pin_memory': True}
-
     # evaluate on test datasets
     datasets = datasets_names
     for dataset in datasets: 
@@ -177,34 +270,74 @@ def main():
 
         print('>> {}: Extracting...'.format(dataset))
         
-        # Step 1: Extract Database Images - dbLoader
+        # Step 1: Extract Database Images
         print('>> {}: Extracting Database Images...'.format(dataset))
-        dbLoader = torch.utils.data.DataLoader(
-            ImagesFromList(root='', images=[test_dataset.dbImages[i] for i in range(len(test_dataset.dbImages))], imsize=imsize, transform=transform),
-            **opt)        
-        poolvecs = torch.zeros(net.meta['outputdim'], len(test_dataset.dbImages)).cuda()
-        for i, input in enumerate(dbLoader):
-            poolvecs[:, i] = net(input.cuda()).data.squeeze()
-
-        # Step 2: Extract Query Images - qLoader
-        print('>> {}: Extracting Query Images...'.format(dataset))
-        qLoader = torch.utils.data.DataLoader(
-                ImagesFromList(root='', images=[test_dataset.qImages[i] for i in qidxs], imsize=imsize, transform=transform),
-                **opt)
+        if args.shards > 1:
+            # one process per shard, a killed run resumes from the shard checkpoints
+            shard_dir = args.shard_dir or os.path.join(get_data_root(), 'shards', dataset)
+            extract_db = lambda: extract_sharded(net, test_dataset.dbImages, imsize, transform, shard_dir, args.shards,
+                                                 ms=ms, msp=msp, batch_size=args.batch_size,
+                                                 devices=None if args.device is None else [str(device)],
+                                                 threads=args.threads, num_workers=args.workers, draft=args.draft)
+        else:
+            extract_db = lambda: extract_vectors(net, test_dataset.dbImages, imsize, transform, ms=ms, msp=msp,
+                                                 batch_size=args.batch_size, device=device, num_workers=args.workers,
+                                                 cache=cache, draft=args.draft)
+        settings = extraction_settings(imsize, transform, ms=ms, msp=msp, draft=args.draft)
+        load_db = lambda: load_or_extract_vectors(
+            args.descriptors and os.path.join(args.descriptors, 'db'), net, test_dataset.dbImages, extract_db,
+            dtype=args.descriptors_dtype, settings=settings).to(device)
+        if args.index is not None:
+            # approximate index, searched off its codes, the descriptors are only loaded to build it
+            dtype = args.descriptors_dtype if args.descriptors else 'float32'
+            key = descriptors_key(net, test_dataset.dbImages, **dict(settings, dtype=dtype))
+            index = load_or_build_index(args.index_dir and os.path.join(args.index_dir, dataset), args.index, load_db,
+                                        key=key)
+            print_index_memory(dataset, index)
+        else:
+            poolvecs = load_db()
 
-        qvecs = torch.zeros(net.meta['outputdim'], len(qidxs)).cuda()
-        for i, input in enumerate(qLoader):
-            qvecs[:, i] = net(input.cuda()).data.squeeze()
+        # Step 2: Extract Query Images
+        print('>> {}: Extracting Query Images...'.format(dataset))
+        qimages = [test_dataset.qImages[i] for i in qidxs]
+        qvecs = load_or_extract_vectors(
+            args.descriptors and os.path.join(args.descriptors, 'query'), net, qimages,
+            lambda: extract_vectors(net, qimages, imsize, transform, ms=ms, msp=msp,
+                                    batch_size=args.batch_size, device=device, num_workers=args.workers, cache=cache,
+                                    draft=args.draft),
+            dtype=args.descriptors_dtype, settings=settings).to(device)
 
-        # Step 3: Ranks 
-        scores = torch.mm(poolvecs.t(), qvecs)
-        scores, ranks = torch.sort(scores, dim=0, descending=True) # Euclidan distance is 1 - Score 
-        
-        ranks = ranks.cpu().numpy()
-        ranks = np.transpose(ranks)
+        # Step 3: Ranks, top k database images of every query
+        if args.geo_radius is not None:
+            # only the database images around the location prior of every query are scored
+            geo = GeoIndex([test_dataset.gpsInfo[image.split('/')[-1][:-4]] for image in test_dataset.dbImages])
+            priors = np.array([test_dataset.gpsInfo[image.split('/')[-1][:-4]] for image in qimages])
+            if args.geo_noise > 0:
+                priors += np.random.RandomState(0).normal(scale=args.geo_noise, size=priors.shape)
+            candidates = geo.candidates(priors, args.geo_radius)
+            print('>> {}: {:.1f} candidates per query within {} m of the location prior, of {} images'.format(
+                dataset, np.mean([len(c) for c in candidates]), args.geo_radius, geo.ntotal))
+            scores, ranks = geo.search(poolvecs, qvecs, args.topk, priors, args.geo_radius)
+        elif args.index is not None:
+            # ranks of -1 when fewer images were visited
+            scores, ranks = index.search(qvecs, args.topk, nprobe=args.nprobe)
+        else:
+            scores, ranks = exact_search(poolvecs, qvecs, args.topk) # Euclidan distance is 1 - Score 
+            ranks = ranks.cpu().numpy()
+            scores = scores.cpu().numpy()
 
-        scores = scores.cpu().numpy()
-        scores = np.transpose(scores)
+        # Step 4: Re-ranking
+        if args.qe is not None:
+            qvecs = torch.from_numpy(query_expansion(poolvecs, qvecs, ranks, args.qe, alpha=args.qe_alpha)).to(device)
+            if args.geo_radius is not None:
+                scores, ranks = geo.search(poolvecs, qvecs, args.topk, priors, args.geo_radius)
+            else:
+                scores, ranks = exact_search(poolvecs.cpu().numpy(), qvecs.cpu().numpy(), args.topk)
+        if args.diffusion is not None:
+            diffusion = Diffusion(poolvecs.cpu().numpy(), k=args.diffusion,
+                                  root=args.graph_dir and os.path.join(args.graph_dir, dataset))
+            scores, ranks = diffusion.search(qvecs, args.topk,
+                                             candidates=candidates if args.geo_radius is not None else None)
 
         if args.generate_plot:
             print('>>> {}: Generating Plot'.format(dataset))
@@ -216,13 +349,14 @@ def main():
                 points = ranks[qidx,:k]
                 q = test_dataset.qImages[qidx].split('/')[-1][:-4]
                 qcoor = gpsinfo[q]
-                ps = [test_dataset.dbImages[i].split('/')[-1][:-4] for i in points]
+                # ranks of -1 (no result, eg of an index) get NaN distances
+                ps = [test_dataset.dbImages[i].split('/')[-1][:-4] if i >= 0 else None for i in points]
                 for i in range(len(ps)):
-                    ps[i] = distance(qcoor, gpsinfo[ps[i]])
+                    ps[i] = distance(qcoor, gpsinfo[ps[i]]) if ps[i] is not None else np.nan
                 #print(gpsinfo[q], gpsinfo[ps[0]])i
                 #embeddingdistances[qidx] = np.array(scores[qidx,:k])
                 ps = np.array(ps)
-                embed = np.array(scores[qidx,:k])
+                embed = np.where(points >= 0, np.array(scores[qidx,:k]), np.nan)
                 gpsdistances[qidx,:] = ps
                 embeddingdistances[qidx,:] = embed
                 #print(q, ps, embed)
@@ -23,11 +23,15 @@ from cirtorch.networks.imageretrievalnet import init_network, extract_vectors
 from cirtorch.layers.loss import ContrastiveLoss, TripletLoss, LinearWeightedContrastiveLoss, LinearOverWeightedContrastiveLoss, RegressionContrastiveLoss, LogTobitLoss, LearntLogTobitLoss, ContrastiveLossVariant, GeneralizedContrastiveLoss, GeneralizedMSELoss
 from cirtorch.datasets.datahelpers import collate_tuples, cid2filename
 from cirtorch.datasets.traindataset import TuplesDataset
+from cirtorch.datasets.imagecache import load_or_build_image_cache
+from cirtorch.networks.featurecache import load_or_extract_feature_maps
 from cirtorch.datasets.testdataset import configdataset
 from cirtorch.utils.download import download_train, download_test
 from cirtorch.utils.whiten import whitenlearn, whitenapply
 from cirtorch.utils.evaluate import compute_map_and_print, mapk, recall
+from cirtorch.utils.index import exact_search
 from cirtorch.utils.general import get_data_root, htime
+from cirtorch.utils.cache import DescriptorCache
 from torch.utils.tensorboard import SummaryWriter
 from cirtorch.datasets.genericdataset import ImagesFromList
 
@@ -64,6 +68,16 @@ parser.add_argument('--test-whiten', metavar='DATASET', default='', choices=test
                         ' (default: None)')
 parser.add_argument('--test-freq', default=20, type=int, metavar='N', 
                     help='run test evaluation every N epochs (default: 1)')
+parser.add_argument('--cache-dir', metavar='DIR', default=None,
+                    help='directory of the on-disk descriptor cache used for testing, disabled if not given (default: None)')
+parser.add_argument('--cache-size', default=10, type=float, metavar='GB',
+                    help='maximum size of the descriptor cache in GB (default: 10)')
+parser.add_argument('--frozen-features', metavar='DIR', default=None,
+                    help='freeze the backbone and train only the head (local whitening, pooling, whitening) on feature maps' +
+                        ' of all training, validation and test images, extracted into DIR once (default: None)')
+parser.add_argument('--image-cache', metavar='DIR', default=None,
+                    help='directory of the uint8 cache of the training and validation images at --image-size,' +
+                        ' built once and read instead of the JPEG files in every epoch (default: None)')
 
 parser.add_argument('--cities', metavar='CITIES', default='', help='city mode')
 parser.add_argument('--tuple-mining', metavar='TUPLES', default='default', help='tuple mining')
@@ -135,8 +149,11 @@ parser.add_argument('--resume', default='', type=str, metavar='FILENAME',
 
 min_loss = float('inf')
 
+# test dataset, created by the first test and kept with its extraction workers
+test_dataset = None
+
 def main():
-    global args, min_loss, writer, global_epoch
+    global args, min_loss, writer, global_epoch, image_cache
     global_epoch = 0
     args = parser.parse_args()
 
@@ -162,6 +179,8 @@ def main():
         directory += "_whiten"
     if not args.pretrained:
         directory += "_notpretrained"
+    if args.frozen_features:
+        directory += "_frozen"
     directory += "_{}_m{:.2f}".format(args.loss, args.loss_margin)
     directory += "_{}_lr{:.1e}_wd{:.1e}".format(args.optimizer, args.lr, args.weight_decay)
     directory += "_nnum{}_qsize{}_psize{}".format(args.neg_num, args.query_size, args.pool_size)
@@ -235,7 +254,9 @@ def main():
     # parameters split into features, pool, whitening 
     # IMPORTANT: no weight decay for pooling parameter p in GeM or regional-GeM
     parameters = []
-    # add feature parameters
+    # add feature parameters, a frozen backbone gets no gradients and is left unchanged by the optimizer
+    if args.frozen_features:
+        model.features.requires_grad_(False)
     parameters.append({'params': model.features.parameters()})
     # add local whitening if exists
     if model.lwhiten is not None:
@@ -346,6 +367,27 @@ def main():
             drop_last=True, collate_fn=collate_tuples
         )
 
+    # images decoded once at training resolution, read from memory mapped shards afterwards
+    image_cache = None
+    if args.image_cache is not None:
+        datasets = [train_dataset] + ([val_dataset] if args.val else [])
+        images = list(dict.fromkeys([im for d in datasets for im in list(d.qImages) + list(d.dbImages)]))
+        image_cache = load_or_build_image_cache(args.image_cache, images, imsize, num_workers=args.workers)
+        for d in datasets:
+            d.image_cache = image_cache
+
+    if args.frozen_features:
+        # backbone activations of all images, computed once, training and mining run on the head alone
+        for name, d in [('train', train_dataset)] + ([('val', val_dataset)] if args.val else []):
+            d.use_feature_maps(load_or_extract_feature_maps(
+                os.path.join(args.frozen_features, name), model, list(d.qImages) + list(d.dbImages), imsize, transform,
+                batch_size=args.batch_size, num_workers=args.workers))
+    else:
+        # persistent loader workers for the extractions of tuple mining, started once for the whole run
+        train_dataset.start_service(args.workers)
+        if args.val:
+            val_dataset.start_service(args.workers)
+
     # evaluate the network before starting
     #test(args.test_datasets, model)
 
@@ -468,7 +510,7 @@ def train(train_loader, model, criterion, optimizer, epoch):
             output = torch.zeros(model.meta['outputdim'], ni).cuda()
             for imi in range(ni):
                 # compute output vector for image imi
-                output[:, imi] = model(input[q][imi].cuda()).squeeze()
+                output[:, imi] = forward(model, input[q][imi].cuda()).squeeze()
 
             # reducing memory consumption:
             # compute loss for this query tuple only
@@ -518,6 +560,12 @@ def train(train_loader, model, criterion, optimizer, epoch):
     return losses.avg
 
 
+def forward(model, x):
+    # the input are feature maps when the backbone is frozen, see --frozen-features
+    if args.frozen_features:
+        return model.head(x)
+    return model(x)
+
 def validate(val_loader, model, criterion, epoch):
     batch_time = AverageMeter()
     losses = AverageMeter()
@@ -539,7 +587,7 @@ def validate(val_loader, model, criterion, epoch):
         output = torch.zeros(model.meta['outputdim'], nq*ni).cuda()
         for q in range(nq):
             for imi in range(ni):
-                output[:, q*ni + imi] = model(input[q][imi].cuda()).squeeze()
+                output[:, q*ni + imi] = forward(model, input[q][imi].cuda()).squeeze()
             
         # no need to reduce memory consumption (no backward pass):
         # compute loss for the full batch
@@ -577,34 +625,49 @@ def test(datasets, net):
     # moving network to gpu and eval mode
     net.cuda()
     net.eval()
-    # set up the transform
-    resize = transforms.Resize((240,320), interpolation=2)
-    normalize = transforms.Normalize(
-        mean=net.meta['mean'],
-        std=net.meta['std']
-    )
-    transform = transforms.Compose([
-        resize,
-        transforms.ToTensor(),
-        normalize
-    ])
-    imsize = args.image_size
-    test_dataset = TuplesDataset(
-        name=args.training_dataset,
-        mode='val', # Test on validation set during training
-        imsize=imsize,
-        nnum=args.neg_num,
-        qsize=args.query_size,
-        poolsize=args.pool_size,
-        transform=transform,
-        posDistThr=posDistThr,
-        negDistThr=negDistThr,
-        root_dir = 'data',
-        cities=''
-    )
+
+    # the test dataset and its extraction workers are created once and kept for all tests
+    global test_dataset
+    if test_dataset is None:
+        # set up the transform
+        resize = transforms.Resize((240,320), interpolation=2)
+        normalize = transforms.Normalize(
+            mean=net.meta['mean'],
+            std=net.meta['std']
+        )
+        transform = transforms.Compose([
+            resize,
+            transforms.ToTensor(),
+            normalize
+        ])
+        imsize = args.image_size
+        test_dataset = TuplesDataset(
+            name=args.training_dataset,
+            mode='val', # Test on validation set during training
+            imsize=imsize,
+            nnum=args.neg_num,
+            qsize=args.query_size,
+            poolsize=args.pool_size,
+            transform=transform,
+            posDistThr=posDistThr,
+            negDistThr=negDistThr,
+            root_dir = 'data',
+            cities=''
+        )
+        test_dataset.image_cache = image_cache
+        if args.frozen_features:
+            qidxs, _ = test_dataset.get_loaders()
+            test_dataset.use_feature_maps(load_or_extract_feature_maps(
+                os.path.join(args.frozen_features, 'test'), net,
+                list(test_dataset.dbImages) + [test_dataset.qImages[i] for i in qidxs], test_dataset.imsize,
+                test_dataset.transform, batch_size=args.batch_size, num_workers=args.workers))
+        else:
+            test_dataset.start_service(args.workers)
+    imsize, transform = test_dataset.imsize, test_dataset.transform
     qidxs, pidxs = test_dataset.get_loaders()
 
-    opt = {'batch_size': 1, 'shuffle': False, 'num_workers': 8, 'pin_memory': True}
+    # descriptor cache, only descriptors of new or changed images are extracted
+    cache = DescriptorCache(args.cache_dir, max_size=int(args.cache_size * 1024**3)) if args.cache_dir else None
 
     # evaluate on test datasets
     datasets = args.test_datasets.split(',')
@@ -613,33 +676,26 @@ def test(datasets, net):
 
         print('>> {}: Extracting...'.format(dataset))
         
-        # Step 1: Extract Database Images - dbLoader
+        # Step 1: Extract Database Images
         print('>> {}: Extracting Database Images...'.format(dataset))
-        dbLoader = torch.utils.data.DataLoader(
-            ImagesFromList(root='', images=[test_dataset.dbImages[i] for i in range(len(test_dataset.dbImages))], imsize=imsize, transform=transform),
-            **opt)        
-        poolvecs = torch.zeros(net.meta['outputdim'], len(test_dataset.dbImages)).cuda()
-        for i, input in enumerate(dbLoader):
-            poolvecs[:, i] = net(input.cuda()).data.squeeze()
-
-        # Step 2: Extract Query Images - qLoader
-        print('>> {}: Extracting Query Images...'.format(dataset))
-        qLoader = torch.utils.data.DataLoader(
-                ImagesFromList(root='', images=[test_dataset.qImages[i] for i in qidxs], imsize=imsize, transform=transform),
-                **opt)
+        if args.frozen_features:
+            poolvecs = test_dataset.extract(net, test_dataset.dbImages).cuda()
+        else:
+            poolvecs = extract_vectors(net, test_dataset.dbImages, imsize, transform, cache=cache,
+                                       service=test_dataset.service).cuda()
 
-        qvecs = torch.zeros(net.meta['outputdim'], len(qidxs)).cuda()
-        for i, input in enumerate(qLoader):
-            qvecs[:, i] = net(input.cuda()).data.squeeze()
+        # Step 2: Extract Query Images
+        print('>> {}: Extracting Query Images...'.format(dataset))
+        if args.frozen_features:
+            qvecs = test_dataset.extract(net, [test_dataset.qImages[i] for i in qidxs]).cuda()
+        else:
+            qvecs = extract_vectors(net, [test_dataset.qImages[i] for i in qidxs], imsize, transform, cache=cache,
+                                    service=test_dataset.service).cuda()
 
-        # Step 3: Ranks 
-        scores = torch.mm(poolvecs.t(), qvecs)
-        scores, ranks = torch.sort(scores, dim=0, descending=True) #Dim1? 
+        # Step 3: Ranks, the first 20 database images of every query are evaluated and plotted
+        scores, ranks = exact_search(poolvecs, qvecs, 20)
         ranks = ranks.cpu().numpy()
-        ranks = np.transpose(ranks)
-
         scores = scores.cpu().numpy()
-        scores = np.transpose(scores)
 
         print('>> {}: Computing Recall and Map'.format(dataset))
         k = 5
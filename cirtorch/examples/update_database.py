@@ -0,0 +1,185 @@
+import argparse
+import os
+import time
+
+import numpy as np
+
+import torch
+from torch.utils.model_zoo import load_url
+from torchvision import transforms
+
+from cirtorch.networks.imageretrievalnet import init_network, extract_vectors
+from cirtorch.networks.inference import get_device, prepare_network
+from cirtorch.utils.database import Database, DRIFT_THRESHOLD
+from cirtorch.utils.store import extraction_settings
+from cirtorch.utils.cache import network_hash
+from cirtorch.utils.general import get_data_root, htime
+
+PRETRAINED = {
+    'retrievalSfM120k-vgg16-gem'        : 'http://cmp.felk.cvut.cz/cnnimageretrieval/data/networks/retrieval-SfM-120k/retrievalSfM120k-vgg16-gem-b4dcdc6.pth',
+    'retrievalSfM120k-resnet101-gem'    : 'http://cmp.felk.cvut.cz/cnnimageretrieval/data/networks/retrieval-SfM-120k/retrievalSfM120k-resnet101-gem-b80fb85.pth',
+    # new networks with whitening learned end-to-end
+    'rSfM120k-tl-resnet50-gem-w'        : 'http://cmp.felk.cvut.cz/cnnimageretrieval/data/networks/retrieval-SfM-120k/rSfM120k-tl-resnet50-gem-w-97bf910.pth',
+    'rSfM120k-tl-resnet101-gem-w'       : 'http://cmp.felk.cvut.cz/cnnimageretrieval/data/networks/retrieval-SfM-120k/rSfM120k-tl-resnet101-gem-w-a155e54.pth',
+    'rSfM120k-tl-resnet152-gem-w'       : 'http://cmp.felk.cvut.cz/cnnimageretrieval/data/networks/retrieval-SfM-120k/rSfM120k-tl-resnet152-gem-w-f39cada.pth',
+    'gl18-tl-resnet50-gem-w'            : 'http://cmp.felk.cvut.cz/cnnimageretrieval/data/networks/gl18/gl18-tl-resnet50-gem-w-83fdc30.pth',
+    'gl18-tl-resnet101-gem-w'           : 'http://cmp.felk.cvut.cz/cnnimageretrieval/data/networks/gl18/gl18-tl-resnet101-gem-w-a4d43db.pth',
+    'gl18-tl-resnet152-gem-w'           : 'http://cmp.felk.cvut.cz/cnnimageretrieval/data/networks/gl18/gl18-tl-resnet152-gem-w-21278d5.pth',
+}
+
+parser = argparse.ArgumentParser(description='PyTorch CNN Image Retrieval Database Update')
+
+parser.add_argument('database', metavar='DATABASE_DIR',
+                    help='directory of the database, created if it does not exist')
+
+# updates
+parser.add_argument('--add', metavar='FILE', default=None,
+                    help="text file of the images to add, one 'PATH' or 'PATH,EASTING,NORTHING' per line (default: None)")
+parser.add_argument('--remove', metavar='FILE', default=None,
+                    help='text file of the ids of the images to remove, one per line (default: None)')
+parser.add_argument('--index', metavar='INDEX', default='ivf1024-pq32',
+                    help="index of a new database, in the format 'pqM' | 'opq-pqM' | 'ivfNLIST-pqM' | 'binNBITS'" +
+                        " (default: 'ivf1024-pq32')")
+parser.add_argument('--drift', default=DRIFT_THRESHOLD, type=float, metavar='DRIFT',
+                    help='relative increase of the quantization error of the added images that triggers' +
+                        ' re-clustering (default: {})'.format(DRIFT_THRESHOLD))
+parser.add_argument('--recluster', dest='recluster', action='store_true',
+                    help='re-cluster the index after the updates, whatever its drift')
+
+# network, the same as for the images already in the database
+group = parser.add_mutually_exclusive_group()
+group.add_argument('--network-path', '-npath', metavar='NETWORK',
+                    help="pretrained network or network path (destination where network is saved)")
+group.add_argument('--network-offtheshelf', '-noff', metavar='NETWORK',
+                    help="off-the-shelf network, in the format 'ARCHITECTURE-POOLING' or 'ARCHITECTURE-POOLING-{reg-lwhiten-whiten}'," +
+                        " examples: 'resnet101-gem' | 'resnet101-gem-reg' | 'resnet101-gem-whiten' | 'resnet101-gem-lwhiten' | 'resnet101-gem-reg-whiten'")
+parser.add_argument('--image-size', default=1024, type=int, metavar='N',
+                    help='maximum size of longer image side used for extraction (default: 1024)')
+parser.add_argument('--multiscale', '-ms', metavar='MULTISCALE', default='[1]',
+                    help="use multiscale vectors, " +
+                    " examples: '[1]' | '[1, 1/2**(1/2), 1/2]' | '[1, 2**(1/2), 1/2**(1/2)]' (default: '[1]')")
+parser.add_argument('--batch-size', '-b', default=1, type=int, metavar='N',
+                    help='number of images extracted together (default: 1)')
+parser.add_argument('--workers', '-j', default=8, type=int, metavar='N',
+                    help='number of data loading workers (default: 8)')
+parser.add_argument('--device', default=None, metavar='DEVICE',
+                    help="device used for extraction, 'cpu' or 'cuda' (default: cuda if available)")
+parser.add_argument('--threads', default=None, type=int, metavar='N',
+                    help='number of intra-op threads on cpu (default: all available cpus)')
+
+def load_network(args):
+    # loading network from path
+    if args.network_path is not None:
+
+        print(">> Loading network:\n>>>> '{}'".format(args.network_path))
+        if args.network_path in PRETRAINED:
+            # pretrained networks (downloaded automatically)
+            state = load_url(PRETRAINED[args.network_path], model_dir=os.path.join(get_data_root(), 'networks'))
+        else:
+            # fine-tuned network from path
+            state = torch.load(args.network_path)
+
+        # parsing net params from meta
+        # architecture, pooling, mean, std required
+        # the rest has default values, in case that is doesnt exist
+        net_params = {}
+        net_params['architecture'] = state['meta']['architecture']
+        net_params['pooling'] = state['meta']['pooling']
+        net_params['local_whitening'] = state['meta'].get('local_whitening', False)
+        net_params['regional'] = state['meta'].get('regional', False)
+        net_params['whitening'] = state['meta'].get('whitening', False)
+        net_params['mean'] = state['meta']['mean']
+        net_params['std'] = state['meta']['std']
+        net_params['pretrained'] = False
+
+        # load network
+        net = init_network(net_params)
+        net.load_state_dict(state['state_dict'])
+
+    # loading offtheshelf network
+    elif args.network_offtheshelf is not None:
+
+        # parse off-the-shelf parameters
+        offtheshelf = args.network_offtheshelf.split('-')
+        net_params = {}
+        net_params['architecture'] = offtheshelf[0]
+        net_params['pooling'] = offtheshelf[1]
+        net_params['local_whitening'] = 'lwhiten' in offtheshelf[2:]
+        net_params['regional'] = 'reg' in offtheshelf[2:]
+        net_params['whitening'] = 'whiten' in offtheshelf[2:]
+        net_params['pretrained'] = True
+
+        # load off-the-shelf network
+        print(">> Loading off-the-shelf network:\n>>>> '{}'".format(args.network_offtheshelf))
+        net = init_network(net_params)
+
+    else:
+        raise RuntimeError('A network is needed to add images: --network-path or --network-offtheshelf!')
+
+    print(">>>> loaded network: ")
+    print(net.meta_repr())
+    return net
+
+def main():
+    args = parser.parse_args()
+    start = time.time()
+
+    db = Database(args.database, spec=args.index, drift=args.drift)
+
+    # Step 1: Remove images
+    if args.remove is not None:
+        with open(args.remove) as f:
+            ids = [int(line) for line in f if line.strip()]
+        print('>> Removed {} of {} images'.format(db.remove(ids), len(ids)))
+
+    # Step 2: Add images, only they are extracted
+    if args.add is not None:
+        images, coordinates = [], []
+        with open(args.add) as f:
+            for line in f:
+                fields = line.strip().split(',')
+                if not fields[0]:
+                    continue
+                images.append(fields[0])
+                coordinates.append([float(c) for c in fields[1:3]] if len(fields) >= 3 else [np.nan, np.nan])
+
+        net = load_network(args)
+        ms = list(eval(args.multiscale))
+        if len(ms)>1 and net.meta['pooling'] == 'gem' and not net.meta['regional'] and not net.meta['whitening']:
+            msp = net.pool.p.item()
+        else:
+            msp = 1
+        device = get_device(args.device)
+        net = prepare_network(net, device=device, threads=args.threads)
+
+        # set up the transform, the same as for the queries in test_mapillary
+        resize = transforms.Resize((240,320), interpolation=2)
+        normalize = transforms.Normalize(
+            mean=net.meta['mean'],
+            std=net.meta['std']
+        )
+        transform = transforms.Compose([
+            resize,
+            transforms.ToTensor(),
+            normalize
+        ])
+
+        # images extracted with another network or other settings are rejected before extraction
+        settings = dict(extraction_settings(args.image_size, transform, ms=ms, msp=msp), network_hash=network_hash(net))
+        db.check_settings(settings)
+
+        print('>> Extracting {} images...'.format(len(images)))
+        vecs = extract_vectors(net, images, args.image_size, transform, ms=ms, msp=msp,
+                               batch_size=args.batch_size, device=device, num_workers=args.workers)
+        ids = db.add(images, coordinates=coordinates, vecs=vecs, settings=settings)
+        print('>> Added {} images, ids {}...{}'.format(len(ids), ids[0], ids[-1]))
+
+    # Step 3: Re-cluster on request
+    if args.recluster:
+        db.recluster()
+
+    print(db)
+    print('>> elapsed time: {}'.format(htime(time.time()-start)))
+
+if __name__ == '__main__':
+    main()
@@ -6,13 +6,19 @@ from torchvision import transforms
 import matplotlib.pyplot as plt
 import numpy as np
 
-from cirtorch.networks.imageretrievalnet import init_network, extract_vectors
+from cirtorch.networks.imageretrievalnet import init_network, iter_vectors
 from cirtorch.datasets.datahelpers import imresize, default_loader
 from cirtorch.datasets.traindataset import TuplesDataset
 from cirtorch.datasets.genericdataset import ImagesFromList
+from cirtorch.utils.cache import DescriptorCache
+from cirtorch.utils.store import StoreWriter
 
 network_path = 'data/exp_outputs1/mapillary_resnet50_gem_contrastive_m0.70_adam_lr1.0e-06_wd1.0e-06_nnum5_qsize2000_psize20000_bsize5_uevery5_imsize1024/model_epoch480.pth.tar'
 multiscale = '[1]'
+cache_dir = 'data/cache'
+cache_size = 10 * 1024**3
+store_dir = 'data/dataset'
+store_dtype = 'float32'  # or 'float16' to halve the size of the descriptors
 def load_placereg_net():
     # loading network from path
     if network_path is not None:
@@ -87,43 +93,28 @@ train_dataset = TuplesDataset(
 
 
 qidxs, pidxs = train_dataset.get_loaders()
-opt = {'batch_size': 1, 'shuffle': False, 'num_workers': 8, 'pin_memory': True}
 
-dbLoader = torch.utils.data.DataLoader(
-            ImagesFromList(root='', images=[train_dataset.dbImages[i] for i in range(len(train_dataset.dbImages))], imsize=imsize, transform=transform),
-            **opt)        
-
-poolvecs = torch.zeros(net.meta['outputdim'], len(train_dataset.dbImages)).cuda()
-for i, input in enumerate(dbLoader):
-    poolvecs[:, i] = net(input.cuda()).data.squeeze()
-
-qLoader = torch.utils.data.DataLoader(
-            ImagesFromList(root='', images=[train_dataset.qImages[i] for i in qidxs], imsize=imsize, transform=transform),
-                **opt)
-
-qvecs = torch.zeros(net.meta['outputdim'], len(qidxs)).cuda()
-for i, input in enumerate(qLoader):
-    qvecs[:, i] = net(input.cuda()).data.squeeze()
-
-poolvecs = poolvecs.cpu().detach().numpy() 
-np.savetxt('data/dataset/poolvecs.txt', poolvecs, delimiter=',')
-
-qvecs = qvecs.cpu().detach().numpy() 
-np.savetxt('data/dataset/qvecs.txt', qvecs, delimiter=',')
-
-np.savetxt('data/dataset/qpool.txt', train_dataset.qpool, delimiter=',')
-
-ppool = np.zeros((len(train_dataset.ppool), 100)) - 1
-for i, p in enumerate(train_dataset.ppool):
-    ppool[i, 0:np.shape(p)[0]] = p
-
-np.savetxt('data/dataset/ppool.txt', ppool, delimiter=',')
-
-np.savetxt('data/dataset/qImages.txt', train_dataset.qImages, delimiter=',', fmt="%s")
-np.savetxt('data/dataset/dbImages.txt', train_dataset.dbImages, delimiter=',', fmt="%s")
+# descriptor cache, only descriptors of new or changed images are extracted
+cache = DescriptorCache(cache_dir, max_size=cache_size)
 
 qcoordinates = np.array([train_dataset.gpsInfo[q[-26:-4]] for q in train_dataset.qImages])
-np.savetxt('data/dataset/qcoordinates.txt', qcoordinates, delimiter=',')
-
 dbcoordinates = np.array([train_dataset.gpsInfo[q[-26:-4]] for q in train_dataset.dbImages])
-np.savetxt('data/dataset/dbcoordinates.txt', dbcoordinates, delimiter=',')
+
+# binary descriptor store, read it back with cirtorch.utils.store.Store(store_dir)
+with StoreWriter(store_dir, meta=net.meta) as writer:
+    # descriptors one row per image, N x D, streamed to disk chunk by chunk
+    stream = writer.stream('poolvecs', shape=(net.meta['outputdim'],), dtype=store_dtype)
+    for _, vecs in iter_vectors(net, train_dataset.dbImages, imsize, transform, cache=cache):
+        stream.append(vecs.t().numpy())
+
+    stream = writer.stream('qvecs', shape=(net.meta['outputdim'],), dtype=store_dtype)
+    for _, vecs in iter_vectors(net, [train_dataset.qImages[i] for i in qidxs], imsize, transform, cache=cache):
+        stream.append(vecs.t().numpy())
+
+    writer.add('qidxs', np.asarray(qidxs, dtype=np.int64))
+    writer.add('qpool', np.asarray(train_dataset.qpool, dtype=np.int64))
+    writer.add_ragged('ppool', train_dataset.ppool)
+    writer.add_strings('qImages', train_dataset.qImages)
+    writer.add_strings('dbImages', train_dataset.dbImages)
+    writer.add('qcoordinates', qcoordinates)
+    writer.add('dbcoordinates', dbcoordinates)
@@ -1,5 +1,6 @@
 import math
 import pdb
+import functools
 
 import torch
 import torch.nn.functional as F
@@ -10,19 +11,48 @@ import numpy as np
 # pooling
 # --------------------------------------
 
-def mac(x):
+def mac(x, mask=None):
+    if mask is not None:
+        # padded positions can never be the maximum
+        return x.masked_fill(~mask, float('-inf')).flatten(-2).max(dim=-1, keepdim=True)[0].unsqueeze(-1)
     return F.max_pool2d(x, (x.size(-2), x.size(-1)))
     # return F.adaptive_max_pool2d(x, (1,1)) # alternative
 
 
-def spoc(x):
+def spoc(x, mask=None):
+    if mask is not None:
+        return masked_avg_pool2d(x, mask)
     return F.avg_pool2d(x, (x.size(-2), x.size(-1)))
     # return F.adaptive_avg_pool2d(x, (1,1)) # alternative
 
-def gem(x, p=3, eps=1e-6):
+def gem(x, p=3, eps=1e-6, mask=None):
+    if mask is not None:
+        return masked_avg_pool2d(x.clamp(min=eps).pow(p), mask).pow(1./p)
     return F.avg_pool2d(x.clamp(min=eps).pow(p), (x.size(-2), x.size(-1))).pow(1./p)
     # return F.lp_pool2d(F.threshold(x, eps, eps), p, (x.size(-2), x.size(-1))) # alternative
 
+def masked_avg_pool2d(x, mask):
+    # average over the valid (non-padded) positions only
+    mask = mask.to(x.dtype)
+    return (x * mask).sum(dim=(-2, -1), keepdim=True) / mask.sum(dim=(-2, -1), keepdim=True)
+
+def feature_mask(mask, size):
+    """
+    Resamples a validity mask of the padded input images to the feature map resolution.
+
+    Arguments
+    ---------
+    mask : bool tensor of size #im x 1 x H x W, True for the valid (non-padded) pixels
+    size : (h, w) size of the feature map
+
+    Returns
+    -------
+    mask : bool tensor of size #im x 1 x h x w
+    """
+    if mask.size(-2) == size[0] and mask.size(-1) == size[1]:
+        return mask
+    return F.interpolate(mask.float(), size=size, mode='nearest') > 0
+
 
 def rmac(x, L=3, eps=1e-6):
     ovr = 0.4 # desired overlap of neighboring regions
@@ -45,7 +75,8 @@ def rmac(x, L=3, eps=1e-6):
     elif H > W:
         Hd = idx.item() + 1
 
-    v = F.max_pool2d(x, (x.size(-2), x.size(-1)))
+    # adaptive pooling keeps the kernel size out of traced graphs (see networks/export.py), the maximum is the same
+    v = F.adaptive_max_pool2d(x, (1,1))
     v = v / (torch.norm(v, p=2, dim=1, keepdim=True) + eps).expand_as(v)
 
     for l in range(1, L+1):
@@ -69,20 +100,25 @@ def rmac(x, L=3, eps=1e-6):
                     continue
                 R = x[:,:,(int(i_)+torch.Tensor(range(wl)).long()).tolist(),:]
                 R = R[:,:,:,(int(j_)+torch.Tensor(range(wl)).long()).tolist()]
-                vt = F.max_pool2d(R, (R.size(-2), R.size(-1)))
+                vt = F.adaptive_max_pool2d(R, (1,1))
                 vt = vt / (torch.norm(vt, p=2, dim=1, keepdim=True) + eps).expand_as(vt)
                 v += vt
 
     return v
 
 
-def roipool(x, rpool, L=3, eps=1e-6):
+@functools.lru_cache(maxsize=None)
+def roipool_regions(H, W, L=3):
+    """
+    Region grid of roipool for a feature map of size H x W, computed once per size.
+
+    Returns
+    -------
+    regions : tuple of (i, j, wl), top left corner and side of the square regions
+    """
     ovr = 0.4 # desired overlap of neighboring regions
     steps = torch.Tensor([2, 3, 4, 5, 6, 7]) # possible regions for the long dimension
 
-    W = x.size(3)
-    H = x.size(2)
-
     w = min(W, H)
     w2 = math.floor(w/2.0 - 1)
 
@@ -97,9 +133,7 @@ def roipool(x, rpool, L=3, eps=1e-6):
     elif H > W:
         Hd = idx.item() + 1
 
-    vecs = []
-    vecs.append(rpool(x).unsqueeze(1))
-
+    regions = []
     for l in range(1, L+1):
         wl = math.floor(2*w/(l+1))
         wl2 = math.floor(wl/2 - 1)
@@ -119,7 +153,17 @@ def roipool(x, rpool, L=3, eps=1e-6):
             for j_ in cenW.tolist():
                 if wl == 0:
                     continue
-                vecs.append(rpool(x.narrow(2,i_,wl).narrow(3,j_,wl)).unsqueeze(1))
+                regions.append((i_, j_, wl))
+
+    return tuple(regions)
+
+
+def roipool(x, rpool, L=3, eps=1e-6):
+    vecs = []
+    vecs.append(rpool(x).unsqueeze(1))
+
+    for i_, j_, wl in roipool_regions(x.size(2), x.size(3), L):
+        vecs.append(rpool(x.narrow(2,i_,wl).narrow(3,j_,wl)).unsqueeze(1))
 
     return torch.cat(vecs, dim=1)
 
@@ -14,8 +14,8 @@ class MAC(nn.Module):
     def __init__(self):
         super(MAC,self).__init__()
 
-    def forward(self, x):
-        return LF.mac(x)
+    def forward(self, x, mask=None):
+        return LF.mac(x, mask=mask)
         
     def __repr__(self):
         return self.__class__.__name__ + '()'
@@ -26,8 +26,8 @@ class SPoC(nn.Module):
     def __init__(self):
         super(SPoC,self).__init__()
 
-    def forward(self, x):
-        return LF.spoc(x)
+    def forward(self, x, mask=None):
+        return LF.spoc(x, mask=mask)
         
     def __repr__(self):
         return self.__class__.__name__ + '()'
@@ -40,8 +40,8 @@ class GeM(nn.Module):
         self.p = Parameter(torch.ones(1)*p)
         self.eps = eps
 
-    def forward(self, x):
-        return LF.gem(x, p=self.p, eps=self.eps)
+    def forward(self, x, mask=None):
+        return LF.gem(x, p=self.p, eps=self.eps, mask=mask)
         
     def __repr__(self):
         return self.__class__.__name__ + '(' + 'p=' + '{:.4f}'.format(self.p.data.tolist()[0]) + ', ' + 'eps=' + str(self.eps) + ')'
@@ -54,8 +54,8 @@ class GeMmp(nn.Module):
         self.mp = mp
         self.eps = eps
 
-    def forward(self, x):
-        return LF.gem(x, p=self.p.unsqueeze(-1).unsqueeze(-1), eps=self.eps)
+    def forward(self, x, mask=None):
+        return LF.gem(x, p=self.p.unsqueeze(-1).unsqueeze(-1), eps=self.eps, mask=mask)
         
     def __repr__(self):
         return self.__class__.__name__ + '(' + 'p=' + '[{}]'.format(self.mp) + ', ' + 'eps=' + str(self.eps) + ')'
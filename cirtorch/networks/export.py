@@ -0,0 +1,196 @@
+import os
+import copy
+import json
+import inspect
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from cirtorch.layers.pooling import MAC, SPoC, GeM, GeMmp, Rpool
+from cirtorch.utils.store import json_meta
+from cirtorch.utils.whiten import whitenapply
+
+# name of the network meta inside exported files
+META_FILE = 'meta.json'
+
+# poolings with a graph that does not depend on the input size,
+# R-MAC regions are computed in python and therefore fixed to the size used for export
+DYNAMIC_SIZE_POOLING = ['mac', 'spoc', 'gem', 'gemmp']
+
+
+class GlobalPool(nn.Module):
+    """MAC, SPoC, GeM or GeMmp with adaptive pooling, whose graph does not depend on the input size
+
+    The pooling layers of the network pass the feature map size as kernel size, which
+    tracing turns into a constant. Descriptors are the same up to float rounding.
+    """
+
+    def __init__(self, pool):
+        super(GlobalPool, self).__init__()
+        self.max = isinstance(pool, MAC)
+        self.mp = isinstance(pool, GeMmp)
+        self.p = getattr(pool, 'p', None)
+        self.eps = getattr(pool, 'eps', None)
+
+    def forward(self, x):
+        if self.max:
+            return F.adaptive_max_pool2d(x, 1)
+        if self.p is None:
+            return F.adaptive_avg_pool2d(x, 1)
+        p = self.p.unsqueeze(-1).unsqueeze(-1) if self.mp else self.p
+        return F.adaptive_avg_pool2d(x.clamp(min=self.eps).pow(p), 1).pow(1./p)
+
+
+class ExportNet(nn.Module):
+    """ImageRetrievalNet, optionally with the learned whitening folded in, as one traceable module
+
+    Args:
+        net (ImageRetrievalNet): Network to be exported, modified in place
+        Lw (dict, Default: None): Learned whitening {'m': D x 1, 'P': D x D}, eg net.meta['Lw'][dataset]['ss']
+        dimensions (int, Default: None): Number of whitened dimensions kept, all when None
+    """
+
+    def __init__(self, net, Lw=None, dimensions=None):
+        super(ExportNet, self).__init__()
+        if isinstance(net.pool, (MAC, SPoC, GeM, GeMmp)):
+            net.pool = GlobalPool(net.pool)
+        elif isinstance(net.pool, Rpool):
+            net.pool.rpool = GlobalPool(net.pool.rpool)
+        if Lw is not None:
+            net.fold_whitening(Lw, dimensions=dimensions)
+        self.net = net
+
+    def forward(self, x):
+        return self.net(x)
+
+
+def export_meta(net, input_size):
+    """Network meta stored with the exported graph, everything needed to use it without init_network"""
+    meta = json_meta(net.meta)
+    meta['learned_whitening'] = net.lw is not None
+    meta['input_size'] = list(input_size)
+    meta['dynamic_size'] = net.meta['pooling'] in DYNAMIC_SIZE_POOLING and not net.meta['regional']
+    return meta
+
+
+def export_network(net, filename, input_size=(240, 320), Lw=None, dimensions=None, format='torchscript',
+                   opset_version=11):
+    """
+    Exports an ImageRetrievalNet as a frozen, self-contained graph.
+
+    The graph holds features, local whitening, pooling, normalization and whitening, and
+    optionally the learned whitening Lw (see ImageRetrievalNet.fold_whitening), with all
+    weights as constants. It is loaded with
+    load_network, without building the torchvision architecture. The input is a batch of
+    normalized images N x 3 x H x W, the output the D x N descriptors as from the network.
+    Graphs with MAC, SPoC, GeM and GeMmp pooling accept any input size, R-MAC and regional
+    graphs only the size used for export (the regions are fixed when tracing).
+
+    Arguments
+    ---------
+    net           : ImageRetrievalNet, left untouched
+    filename      : output file, TorchScript (.pt) or ONNX (.onnx)
+    input_size    : (H, W) size of the example input used for tracing
+    Lw            : learned whitening {'m', 'P'}, eg net.meta['Lw'][dataset]['ss'], not applied when None
+    dimensions    : number of whitened dimensions kept, all when None
+    format        : 'torchscript' or 'onnx'
+    opset_version : ONNX opset
+
+    Returns
+    -------
+    meta : network meta stored with the graph
+    """
+    model = ExportNet(copy.deepcopy(net).cpu(), Lw=Lw, dimensions=dimensions).eval()
+    meta = export_meta(model.net, input_size)
+    example = torch.randn(1, 3, input_size[0], input_size[1])
+
+    if format == 'torchscript':
+        with torch.no_grad():
+            graph = torch.jit.trace(model, example)
+        if hasattr(torch.jit, 'freeze'):
+            # parameters become constants, conv-bn folding and other inference optimizations
+            graph = torch.jit.freeze(graph)
+        torch.jit.save(graph, filename, _extra_files={META_FILE: json.dumps(meta)})
+
+    elif format == 'onnx':
+        kwargs = {}
+        if 'dynamo' in inspect.signature(torch.onnx.export).parameters:
+            # the traced exporter supports the python control flow of the pooling layers
+            kwargs['dynamo'] = False
+        dynamic_axes = {0: 'batch', 2: 'height', 3: 'width'} if meta['dynamic_size'] else {0: 'batch'}
+        torch.onnx.export(model, example, filename, input_names=['images'], output_names=['descriptors'],
+                          dynamic_axes={'images': dynamic_axes, 'descriptors': {1: 'batch'}},
+                          opset_version=opset_version, do_constant_folding=True, **kwargs)
+        try:
+            import onnx
+        except ImportError:
+            print('>> {}: onnx not installed, meta not stored in {}'.format(os.path.basename(__file__), filename))
+        else:
+            graph = onnx.load(filename)
+            entry = graph.metadata_props.add()
+            entry.key, entry.value = META_FILE, json.dumps(meta)
+            onnx.save(graph, filename)
+
+    else:
+        raise ValueError('Unsupported export format: {}!'.format(format))
+
+    return meta
+
+
+class OnnxNet(object):
+    """ONNX Runtime session with the call signature of the exported TorchScript graph"""
+
+    def __init__(self, filename):
+        import onnxruntime
+        self.session = onnxruntime.InferenceSession(filename, providers=['CPUExecutionProvider'])
+
+    def __call__(self, x):
+        return torch.from_numpy(self.session.run(None, {'images': x.cpu().numpy()})[0])
+
+
+def load_network(filename, map_location='cpu'):
+    """
+    Loads a graph written by export_network
+
+    Returns
+    -------
+    net  : callable mapping N x 3 x H x W images to D x N descriptors
+    meta : network meta (architecture, pooling, mean, std, outputdim, input_size, ...)
+    """
+    if filename.endswith('.onnx'):
+        import onnx
+        meta = {p.key: p.value for p in onnx.load(filename).metadata_props}
+        return OnnxNet(filename), json.loads(meta.get(META_FILE, '{}'))
+
+    extra_files = {META_FILE: ''}
+    net = torch.jit.load(filename, map_location=map_location, _extra_files=extra_files)
+    return net, json.loads(extra_files[META_FILE])
+
+
+def validate_export(net, exported, inputs, Lw=None, dimensions=None):
+    """
+    Compares the descriptors of an exported graph with the eager network followed by whitenapply
+
+    Arguments
+    ---------
+    net        : ImageRetrievalNet the graph was exported from
+    exported   : graph returned by load_network
+    inputs     : list of N x 3 x H x W image batches
+    Lw         : learned whitening the graph was exported with
+    dimensions : number of whitened dimensions the graph was exported with
+
+    Returns
+    -------
+    diff : maximum absolute difference of the descriptors over all inputs
+    """
+    net = copy.deepcopy(net).cpu().eval()
+    diff = 0.
+    with torch.no_grad():
+        for x in inputs:
+            vecs = net(x).numpy()
+            if Lw is not None:
+                vecs = whitenapply(vecs, Lw['m'], Lw['P'], dimensions=dimensions)
+            diff = max(diff, np.abs(vecs - exported(x).numpy()).max())
+    return float(diff)
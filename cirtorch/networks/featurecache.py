@@ -0,0 +1,204 @@
+import os
+import copy
+import json
+import hashlib
+
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+
+from cirtorch.networks.imageretrievalnet import ImageRetrievalNet, OUTPUT_DIM, _iter_items, _collect_ragged
+from cirtorch.networks.inference import get_device, cpu_count, set_threads
+from cirtorch.utils.cache import network_hash
+from cirtorch.utils.store import Store, is_store
+
+# --------------------------------------
+# feature map extraction
+# --------------------------------------
+
+def extract_fmaps(net, pyramid):
+    """
+    Feature maps of a batch of images of the same size
+
+    Returns
+    -------
+    items : list with one (h*w x C feature map, 1 x 2 (h, w) shape) pair per image
+    """
+    o = net.features(pyramid[0].contiguous(memory_format=net.memory_format)) # #im x C x h x w
+    shape = torch.tensor([list(o.shape[-2:])], dtype=torch.int32)
+    return [(f, shape) for f in o.flatten(2).permute(0,2,1).cpu()]
+
+
+def _settings(image_size, transform, bbxs):
+    bbxs = None if bbxs is None else hashlib.sha256(json.dumps([[float(c) for c in b] for b in bbxs]).encode()).hexdigest()
+    return {'imsize': image_size, 'transform': repr(transform), 'bbxs': bbxs}
+
+
+def extract_feature_maps(net, images, image_size, transform, root, bbxs=None, print_freq=10, batch_size=1,
+                         device=None, num_workers=8, dtype='float16', chunk_size=1024):
+    """
+    Extracts the final convolutional feature maps (net.features) of every image into a feature map store.
+
+    The feature maps do not depend on the head of the network (local whitening, pooling,
+    whitening), so every head can be evaluated from the store later on, see head_vectors.
+    Images of the same size are extracted together in batches of batch_size. The maps are
+    streamed into a descriptor store at root (cirtorch.utils.store), one h*w x C block of
+    rows per image in dtype, with the hash of the feature weights and the extraction settings
+    in its meta.
+
+    Returns
+    -------
+    fmaps : FeatureMaps, memory mapped from the store at root
+    """
+    items = _iter_items(net, images, image_size, transform, extract_fmaps, bbxs=bbxs, ms=[1], print_freq=print_freq,
+                        batch_size=batch_size, device=device, num_workers=num_workers, chunk_size=chunk_size)
+    meta = dict(net.meta, features_hash=network_hash(net.features), settings=_settings(image_size, transform, bbxs))
+    _collect_ragged(items, ['fmaps', 'shapes'], [OUTPUT_DIM[net.meta['architecture']], 2], [dtype, 'int32'],
+                    images, meta, root=root)
+    return FeatureMaps(root)
+
+
+def load_or_extract_feature_maps(root, net, images, image_size, transform, bbxs=None, **kwargs):
+    """
+    Opens the feature map store at root if it was written for the same images, feature weights
+    and settings, otherwise extracts the feature maps into it (see extract_feature_maps)
+
+    Returns
+    -------
+    fmaps : FeatureMaps
+    """
+    if is_store(root):
+        fmaps = FeatureMaps(root)
+        if (fmaps.meta.get('features_hash') == network_hash(net.features)
+                and fmaps.meta.get('settings') == _settings(image_size, transform, bbxs)
+                and np.array_equal(fmaps.images, np.array(list(images), dtype=np.str_))):
+            print('>> Using feature maps from {}'.format(root))
+            return fmaps
+
+    print('>> Extracting feature maps into {}...'.format(root))
+    return extract_feature_maps(net, images, image_size, transform, root, bbxs=bbxs, **kwargs)
+
+
+class FeatureMaps(object):
+    """Feature maps of a set of images, read from a store written by extract_feature_maps
+
+    Args:
+        root (string): Directory of the store
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.store = Store(root)
+        self.fmaps = self.store['fmaps']
+        self.shapes = self.store['shapes'].data
+        self.images = self.store['images']
+
+    @property
+    def meta(self):
+        return self.store.meta
+
+    def __len__(self):
+        return len(self.fmaps)
+
+    def __getitem__(self, index):
+        """C x h x w float tensor of image index"""
+        h, w = self.shapes[index]
+        return torch.from_numpy(np.array(self.fmaps[index], dtype=np.float32)).t().reshape(-1, h, w)
+
+    def batches(self, batch_size, indices=None):
+        """
+        Yields
+        ------
+        idxs  : positions in indices (all images when None) of the images of the batch
+        batch : #im x C x h x w float tensor of feature maps of the same size
+        """
+        indices = range(len(self)) if indices is None else indices
+        buckets = {}
+        for j, i in enumerate(indices):
+            buckets.setdefault(tuple(self.shapes[i]), []).append(j)
+        for bucket in buckets.values():
+            for k in range(0, len(bucket), batch_size):
+                idxs = bucket[k:k+batch_size]
+                yield idxs, torch.stack([self[indices[j]] for j in idxs])
+
+    def __repr__(self):
+        fmt_str = self.__class__.__name__ + '\n'
+        fmt_str += '    Root Location: {}\n'.format(self.root)
+        fmt_str += '    Number of images: {}\n'.format(len(self))
+        fmt_str += '    Architecture: {}\n'.format(self.meta.get('architecture'))
+        return fmt_str
+
+# --------------------------------------
+# heads
+# --------------------------------------
+
+def head_network(net):
+    """ImageRetrievalNet with the head (local whitening, pooling, whitening) of net and without features"""
+    head = ImageRetrievalNet([], net.lwhiten, net.pool, net.whiten, dict(net.meta))
+    head.lw = net.lw
+    return head
+
+
+def head_vectors(net, fmaps, batch_size=64, device=None, indices=None):
+    """
+    Descriptors of cached feature maps, computed by the head of net (see ImageRetrievalNet.head)
+
+    Arguments
+    ---------
+    net        : ImageRetrievalNet or head_network, its features are not used
+    fmaps      : FeatureMaps
+    batch_size : number of feature maps of the same size processed together
+    indices    : images the descriptors are computed for, all when None
+
+    Returns
+    -------
+    vecs : D x N tensor of descriptors, one column per image (of indices)
+    """
+    device = get_device(device)
+    net.to(device)
+    net.eval()
+
+    indices = range(len(fmaps)) if indices is None else indices
+    vecs = torch.zeros(net.meta['outputdim'], len(indices))
+    with torch.no_grad():
+        for idxs, batch in fmaps.batches(batch_size, indices=indices):
+            vecs[:, idxs] = net.head(batch.to(device)).cpu()
+    return vecs
+
+
+def _sweep_head(name, head, root, evaluate, batch_size, device):
+    vecs = head_vectors(head, FeatureMaps(root), batch_size=batch_size, device=device)
+    return evaluate(name, vecs)
+
+
+def sweep_heads(heads, root, evaluate, processes=None, batch_size=64, device='cpu'):
+    """
+    Evaluates many heads on the same cached feature maps, in parallel processes
+
+    Every process memory maps the feature map store, so the maps are read from disk once and
+    shared through the page cache. Only the heads (without the features) are sent to the
+    processes, and the cpus are split evenly between them.
+
+    Arguments
+    ---------
+    heads     : dict name -> ImageRetrievalNet (or head_network) whose head is evaluated
+    root      : directory of the feature map store
+    evaluate  : picklable function (name, D x N descriptors) -> result, eg a module level function
+    processes : number of processes, min(#heads, #cpus) when None, 1 runs everything in this process
+
+    Returns
+    -------
+    results : dict name -> result of evaluate, in the order of heads
+    """
+    if processes is None:
+        processes = min(len(heads), cpu_count())
+    jobs = [(name, copy.deepcopy(head_network(net)).cpu(), root, evaluate, batch_size, device) for name, net in heads.items()]
+
+    if processes <= 1:
+        results = [_sweep_head(*job) for job in jobs]
+    else:
+        threads = max(1, cpu_count() // processes)
+        with mp.get_context('spawn').Pool(processes, initializer=set_threads, initargs=(threads,)) as pool:
+            results = pool.starmap(_sweep_head, jobs)
+
+    return dict(zip(heads.keys(), results))
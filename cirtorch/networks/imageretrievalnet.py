@@ -1,16 +1,23 @@
 import os
 import pdb
+import inspect
+import collections
 
+import numpy as np
 import torch
 import torch.nn as nn
 import torch.utils.model_zoo as model_zoo
 
 import torchvision
 
+import cirtorch.layers.functional as LF
 from cirtorch.layers.pooling import MAC, SPoC, GeM, GeMmp, RMAC, Rpool
 from cirtorch.layers.normalization import L2N, PowerLaw
-from cirtorch.datasets.genericdataset import ImagesFromList
+from cirtorch.datasets.genericdataset import ImagesFromList, bucket_batches
+from cirtorch.datasets.datahelpers import collate_padded
+from cirtorch.networks.inference import get_device
 from cirtorch.utils.general import get_data_root
+from cirtorch.utils.store import RaggedArray, StoreWriter, Store
 
 # for some models, we have imported features (convolutions) from caffe because the image retrieval performance is higher for them
 FEATURES = {
@@ -36,6 +43,9 @@ POOLING = {
     'rmac'  : RMAC,
 }
 
+# global pooling layers that can ignore the padded part of a batch of images of different size
+MASKED_POOLING = ['mac', 'spoc', 'gem', 'gemmp']
+
 # TODO: pre-compute for: resnet50-gem-r, resnet50-mac-r, vgg16-mac-r, alexnet-mac-r
 # pre-computed regional whitening, for most commonly used architectures and pooling methods
 R_WHITENING = {
@@ -94,11 +104,18 @@ class ImageRetrievalNet(nn.Module):
         self.whiten = whiten
         self.norm = L2N()
         self.meta = meta
+        # learned whitening folded into the forward pass, see fold_whitening
+        self.lw = None
+        # memory layout the input is converted to, see inference.prepare_network
+        self.memory_format = torch.contiguous_format
     
-    def forward(self, x):
+    def forward(self, x, mask=None, lw=True):
         # x -> features
-        o = self.features(x)
+        o = self.features(x.contiguous(memory_format=self.memory_format))
+        return self.head(o, mask=mask, lw=lw)
 
+    def head(self, o, mask=None, lw=True):
+        """Descriptors (D x N) of the feature maps o (N x C x h x w), ie forward without the features"""
         # TODO: properly test (with pre-l2norm and/or post-l2norm)
         # if lwhiten exist: features -> local whiten
         if self.lwhiten is not None:
@@ -110,15 +127,51 @@ class ImageRetrievalNet(nn.Module):
             # o = self.norm(o)
 
         # features -> pool -> norm
-        o = self.norm(self.pool(o)).squeeze(-1).squeeze(-1)
+        # if mask exist: padded positions are excluded from pooling
+        if mask is not None:
+            o = self.pool(o, mask=LF.feature_mask(mask, o.shape[-2:]))
+        else:
+            o = self.pool(o)
+        o = self.norm(o).squeeze(-1).squeeze(-1)
 
         # if whiten exist: pooled features -> whiten -> norm
         if self.whiten is not None:
             o = self.norm(self.whiten(o))
 
+        # if learned whitening is folded: pooled features -> learned whiten -> norm
+        # (skipped for the single scales of multi-scale extraction, see extract_pyramid)
+        if self.lw is not None and lw:
+            o = self.norm(self.lw(o))
+
         # permute so that it is Dx1 column vector per image (DxN if many images)
         return o.permute(1,0)
 
+    def fold_whitening(self, Lw, dimensions=None):
+        """
+        Folds a learned whitening into the network as one linear layer followed by L2N.
+
+        Descriptors come whitened out of the forward pass, the same as
+        whitenapply(net(x), Lw['m'], Lw['P'], dimensions), without the extra copy and
+        matmul in numpy. Keeping only the first dimensions of P gives reduced descriptors,
+        meta['outputdim'] is updated accordingly. Use Lw learned for single-scale ('ss')
+        or multi-scale ('ms') descriptors, whichever is extracted. Meant for inference,
+        a folded network is not trained further.
+
+        Args:
+            Lw (dict): Learned whitening {'m': D x 1, 'P': D x D}, eg meta['Lw'][dataset]['ss']
+            dimensions (int, Default: None): Number of whitened dimensions kept, all when None
+        """
+        P = torch.as_tensor(np.asarray(Lw['P'])[:dimensions], dtype=torch.float32)
+        m = torch.as_tensor(np.asarray(Lw['m']), dtype=torch.float32).view(-1)
+
+        # P (x - m) = P x - P m
+        lw = nn.Linear(P.size(1), P.size(0), bias=True)
+        lw.weight.data.copy_(P)
+        lw.bias.data.copy_(-torch.mv(P, m))
+        self.lw = lw.to(next(self.parameters()).device)
+        self.meta['outputdim'] = P.size(0)
+        return self
+
     def __repr__(self):
         tmpstr = super(ImageRetrievalNet, self).__repr__()[:-1]
         tmpstr += self.meta_repr()
@@ -275,118 +328,500 @@ def init_network(params):
     return net
 
 
-def extract_vectors(net, images, image_size, transform, bbxs=None, ms=[1], msp=1, print_freq=10):
-    # moving network to gpu and eval mode
-    net.cuda()
-    net.eval()
+def extract_vectors(net, images, image_size, transform, bbxs=None, ms=[1], msp=1, print_freq=10, batch_size=1, pad=True,
+                    device=None, num_workers=8, cache=None, draft=False, image_cache=None, service=None):
+    """
+    Extracts one global descriptor per image.
 
-    # creating dataset loader
-    loader = torch.utils.data.DataLoader(
-        ImagesFromList(root='', images=images, imsize=image_size, bbxs=bbxs, transform=transform),
-        batch_size=1, shuffle=False, num_workers=8, pin_memory=True
-    )
+    With batch_size > 1, images are grouped into buckets of similar aspect ratio and size,
+    padded within a batch, and the padding is masked out in the pooling layer. Descriptors
+    are identical to the batch-of-one extraction whenever a batch holds images of the same
+    size (eg when the transform resizes to a fixed size). For padded images the convolutions
+    still see the padding close to the image border, so descriptors differ slightly; use
+    pad=False to only batch images of exactly the same size. Networks whose pooling cannot be
+    masked (regional pooling, R-MAC) never pad.
 
-    # extracting vectors
-    with torch.no_grad():
-        vecs = torch.zeros(net.meta['outputdim'], len(images))
-        for i, input in enumerate(loader):
-            input = input.cuda()
+    For multi-scale extraction the image pyramid is built in the data loading workers, every
+    scale of a batch is extracted with one forward pass and the scales are aggregated on device.
 
-            if len(ms) == 1 and ms[0] == 1:
-                vecs[:, i] = extract_ss(net, input)
-            else:
-                vecs[:, i] = extract_ms(net, input, ms, msp)
+    The network runs on device (cuda if available when None), see inference.prepare_network
+    for tuning the network for cpu inference.
 
-            if (i+1) % print_freq == 0 or (i+1) == len(images):
-                print('\r>>>> {}/{} done...'.format((i+1), len(images)), end='')
-        print('')
+    With a cache (cirtorch.utils.cache.DescriptorCache) only the descriptors that are not
+    cached yet for this network and these settings are extracted, and then added to the cache.
 
-    return vecs
+    With draft, JPEG images are decoded at reduced resolution and resampled once, see
+    ImagesFromList; descriptors differ slightly from the full resolution decode. With an
+    image_cache (cirtorch.datasets.imagecache.ImageCache) the cached images are used instead
+    of decoding their files, except with bbxs, query crops are always decoded from their files.
 
-def extract_ss(net, input):
-    return net(input).cpu().data.squeeze()
+    With a service (ExtractionService) the images are loaded by its persistent workers
+    instead of starting new ones, the images must be part of the images of the service.
 
-def extract_ms(net, input, ms, msp):
-    
-    v = torch.zeros(net.meta['outputdim'])
-    
-    for s in ms: 
-        if s == 1:
-            input_t = input.clone()
-        else:    
-            input_t = nn.functional.interpolate(input, scale_factor=s, mode='bilinear', align_corners=False)
-        v += net(input_t).pow(msp).cpu().data.squeeze()
-        
-    v /= len(ms)
-    v = v.pow(1./msp)
-    v /= v.norm()
+    See iter_vectors for extracting large image lists with constant memory.
 
-    return v
+    Returns
+    -------
+    vecs : D x N tensor of descriptors, one column per image
+    """
+    vecs = torch.zeros(net.meta['outputdim'], len(images))
+    for idxs, chunk in iter_vectors(net, images, image_size, transform, bbxs=bbxs, ms=ms, msp=msp, print_freq=print_freq,
+                                    batch_size=batch_size, pad=pad, device=device, num_workers=num_workers, cache=cache,
+                                    draft=draft, image_cache=image_cache, service=service):
+        vecs[:, idxs.start:idxs.stop] = chunk
 
+    return vecs
 
-def extract_regional_vectors(net, images, image_size, transform, bbxs=None, ms=[1], msp=1, print_freq=10):
-    # moving network to gpu and eval mode
-    net.cuda()
+def iter_vectors(net, images, image_size, transform, bbxs=None, ms=[1], msp=1, print_freq=10, batch_size=1, pad=True,
+                 device=None, num_workers=8, cache=None, chunk_size=1024, draft=False, image_cache=None,
+                 service=None):
+    """
+    Extracts one global descriptor per image and yields them in chunks as they are produced.
+
+    The images are processed in windows of chunk_size consecutive images, batches are bucketed
+    within a window, and a chunk is yielded as soon as its window is complete. Memory therefore
+    does not grow with the number of images, and the chunks can be written to disk or added to
+    an index while the extraction goes on. Arguments are the same as for extract_vectors.
+
+    Yields
+    ------
+    idxs  : range of the image indexes of the chunk, chunks are consecutive and in order
+    chunk : D x len(idxs) tensor of descriptors
+    """
+    # moving network to device and eval mode
+    device = get_device(device)
+    net.to(device)
     net.eval()
 
-    # creating dataset loader
-    loader = torch.utils.data.DataLoader(
-        ImagesFromList(root='', images=images, imsize=image_size, bbxs=bbxs, transform=transform),
-        batch_size=1, shuffle=False, num_workers=8, pin_memory=True
-    )
-
-    # extracting vectors
-    with torch.no_grad():
-        vecs = []
-        for i, input in enumerate(loader):
-            input = input.cuda()
-
-            if len(ms) == 1:
-                vecs.append(extract_ssr(net, input))
+    # creating dataset loader, multi-scale pyramids are built by the workers
+    multiscale = not (len(ms) == 1 and ms[0] == 1)
+    exact = not pad or net.meta['pooling'] not in MASKED_POOLING or net.meta['regional']
+    if service is None:
+        dataset = ImagesFromList(root='', images=images, imsize=image_size, bbxs=bbxs, transform=transform,
+                                 ms=ms if multiscale else None, draft=draft, image_cache=image_cache)
+        indices = range(len(images))
+        view = dataset
+    else:
+        # images are loaded by index into the images of the service
+        service.check(image_size, transform, bbxs, ms if multiscale else None, draft, image_cache)
+        dataset = service.dataset
+        indices = service.indices(images)
+        view = _IndexedImages(dataset, indices)
+
+    if cache is not None:
+        settings = {'imsize': image_size, 'transform': repr(transform), 'ms': list(ms), 'msp': msp,
+                    'padded': batch_size > 1 and not exact}
+        if draft:
+            settings['draft'] = True
+        if image_cache is not None and bbxs is None:
+            settings['image_cache'] = image_cache.imsize
+        prefix = cache.prefix(net, settings)
+
+    # the batches are generated lazily, window by window, and every window and batch is also
+    # queued as an event, the loader returns the batches in the same order
+    events = collections.deque()
+    def batches():
+        for start in range(0, len(images), chunk_size):
+            idxs = range(start, min(start + chunk_size, len(images)))
+            keys, hits = None, {}
+            if cache is not None:
+                keys = cache.keys(prefix, images[idxs.start:idxs.stop],
+                                  bbxs=None if bbxs is None else bbxs[idxs.start:idxs.stop])
+                hits = cache.get(keys)
+            missing = [i for i, key in zip(idxs, keys or idxs) if key not in hits]
+            events.append(('window', idxs, keys, hits))
+
+            if batch_size > 1:
+                window = bucket_batches(view, batch_size, exact=exact, indices=missing)
             else:
-                # TODO: not implemented yet
-                # vecs.append(extract_msr(net, input, ms, msp))
-                raise NotImplementedError
-
-            if (i+1) % print_freq == 0 or (i+1) == len(images):
-                print('\r>>>> {}/{} done...'.format((i+1), len(images)), end='')
-        print('')
+                window = [[i] for i in missing]
+            for batch in window:
+                events.append(('batch', batch))
+                yield [indices[i] for i in batch]
+
+    if service is None:
+        loader = torch.utils.data.DataLoader(
+            dataset, batch_sampler=_Batches(batches), collate_fn=collate_padded, num_workers=num_workers,
+            pin_memory=(device.type == 'cuda')
+        )
+    else:
+        loader = service.loader(batches, pin_memory=(device.type == 'cuda'))
+
+    # extracting vectors, no_grad is only entered around the forward pass,
+    # it would otherwise leak into the code consuming the chunks
+    window = None
+    n = nhits = 0
+    for i, input in enumerate(loader):
+        # windows queued before the batch of this input are complete
+        event = events.popleft()
+        while event[0] == 'window':
+            if window is not None:
+                yield _window_chunk(window, cache)
+            window = _window_start(event, net.meta['outputdim'])
+            n += len(event[3])
+            nhits += len(event[3])
+            event = events.popleft()
+
+        idxs = event[1]
+        with torch.no_grad():
+            if multiscale:
+                pyramid = [_to_device(input_s, mask_s, device) for input_s, mask_s in input]
+                vecs = extract_pyramid(net, pyramid, msp).view(net.meta['outputdim'], -1)
+            else:
+                input, mask = _to_device(*input, device)
+                vecs = extract_ss(net, input, mask).view(net.meta['outputdim'], -1)
+        window['extracted'].extend([j - window['idxs'].start for j in idxs])
+        window['vecs'][:, window['extracted'][-len(idxs):]] = vecs
+
+        n += len(idxs)
+        if (i+1) % print_freq == 0 or n == len(images):
+            print('\r>>>> {}/{} done...'.format(n, len(images)), end='')
+
+    # trailing windows found completely in the cache
+    for event in events:
+        if window is not None:
+            yield _window_chunk(window, cache)
+        window = _window_start(event, net.meta['outputdim'])
+        n += len(event[3])
+        nhits += len(event[3])
+    if window is not None:
+        yield _window_chunk(window, cache)
+
+    if cache is not None:
+        print('\r>>>> {}/{} done, {} found in cache...'.format(n, len(images), nhits), end='')
+    print('')
+
+class _Batches(object):
+    # batch sampler running a generator function, every iteration starts it anew
+    def __init__(self, generator):
+        self.generator = generator
+
+    def __iter__(self):
+        return self.generator()
+
+class _IndexedImages(object):
+    # the images of a dataset at the given indexes, as seen by bucket_batches
+    def __init__(self, dataset, indices):
+        self.dataset = dataset
+        self.indices = indices
+        self.transform = dataset.transform
+
+    def image_size(self, i):
+        return self.dataset.image_size(self.indices[i])
+
+    def __len__(self):
+        return len(self.indices)
+
+class ExtractionService(object):
+    """Long-lived data loading workers for repeated extractions from the same set of images
+
+    Every extract_vectors call starts and stops its own loader workers, each of them a fork
+    of the process with all its image lists. The service starts its workers once, on the
+    dataset of all images that will ever be extracted (eg the query and database images
+    of a training set), and keeps them and their prefetch queues alive between passes.
+    Each pass (extract_vectors or iter_vectors with service=...) sends only the indexes of
+    its images to the workers. The workers are started with the first pass; with torch
+    versions without persistent loader workers, every pass starts them anew.
+
+    Args:
+        images (list): Paths of all images the service extracts from
+        image_size (int): Maximum size of longer image side, as for extract_vectors
+        transform (callable): Transform of the images, as for extract_vectors
+        ms (list, Default: [1]): Scales of multi-scale extraction
+        num_workers (int, Default: 8): Number of data loading workers
+        prefetch_factor (int, Default: 2): Number of batches loaded in advance by each worker
+        draft (bool, Default: False): Decode JPEG images at reduced resolution, see ImagesFromList
+        image_cache (ImageCache, Default: None): Cache of decoded images, see ImagesFromList
+    """
+
+    def __init__(self, images, image_size, transform, ms=[1], num_workers=8, prefetch_factor=2, draft=False,
+                 image_cache=None):
+        multiscale = not (len(ms) == 1 and ms[0] == 1)
+        self.dataset = ImagesFromList(root='', images=list(images), imsize=image_size, transform=transform,
+                                      ms=ms if multiscale else None, draft=draft, image_cache=image_cache)
+        self.index = {path: i for i, path in enumerate(self.dataset.images)}
+        self.num_workers = num_workers
+        self.prefetch_factor = prefetch_factor
+        self.sampler = _Batches(None)
+        self.persistent = None
+        self.pin_memory = None
+
+    def check(self, image_size, transform, bbxs, ms, draft, image_cache):
+        # the workers load the images as the service was created, extraction settings must agree
+        dataset = self.dataset
+        if (image_size != dataset.imsize or transform is not dataset.transform or bbxs is not None
+                or ms != dataset.ms or draft != dataset.draft or image_cache is not dataset.image_cache):
+            raise ValueError('Unsupported extraction settings for the extraction service: {}!'.format(
+                {'imsize': image_size, 'transform': transform, 'bbxs': bbxs is not None, 'ms': ms, 'draft': draft}))
+
+    def indices(self, images):
+        """Indexes of the images (paths) in the dataset of the service"""
+        try:
+            return [self.index[path] for path in images]
+        except KeyError as e:
+            raise ValueError('Unsupported image for the extraction service: {}!'.format(e.args[0]))
+
+    def loader(self, batches, pin_memory=False):
+        """Persistent DataLoader of the service, yielding the batches of generator function batches"""
+        self.sampler.generator = batches
+        if self.persistent is not None and self.pin_memory == pin_memory:
+            return self.persistent
+
+        kwargs = {}
+        if self.num_workers > 0 and 'persistent_workers' in inspect.signature(torch.utils.data.DataLoader).parameters:
+            kwargs = {'persistent_workers': True, 'prefetch_factor': self.prefetch_factor}
+        loader = torch.utils.data.DataLoader(
+            self.dataset, batch_sampler=self.sampler, collate_fn=collate_padded, num_workers=self.num_workers,
+            pin_memory=pin_memory, **kwargs
+        )
+        if kwargs:
+            self.shutdown()
+            self.persistent, self.pin_memory = loader, pin_memory
+        return loader
+
+    def shutdown(self):
+        """Stops the workers, they are started again by the next pass"""
+        if self.persistent is not None and getattr(self.persistent, '_iterator', None) is not None:
+            self.persistent._iterator._shutdown_workers()
+        self.persistent = None
+
+    def __len__(self):
+        return len(self.dataset)
 
-    return vecs
+    def __repr__(self):
+        fmt_str = self.__class__.__name__ + '\n'
+        fmt_str += '    Number of images: {}\n'.format(len(self))
+        fmt_str += '    Number of workers: {}\n'.format(self.num_workers)
+        fmt_str += '    Workers running: {}\n'.format(self.persistent is not None
+                                                      and getattr(self.persistent, '_iterator', None) is not None)
+        return fmt_str
+
+def _window_start(event, dim):
+    _, idxs, keys, hits = event
+    window = {'idxs': idxs, 'vecs': torch.zeros(dim, len(idxs)), 'keys': keys, 'extracted': []}
+    for j, key in enumerate(keys or []):
+        if key in hits:
+            window['vecs'][:, j] = torch.from_numpy(hits[key])
+    return window
+
+def _window_chunk(window, cache):
+    # newly extracted descriptors of the window go to the cache
+    if cache is not None and len(window['extracted']):
+        cache.put([window['keys'][j] for j in window['extracted']], window['vecs'][:, window['extracted']])
+    return window['idxs'], window['vecs']
+
+def _to_device(input, mask, device):
+    # no need for masking if nothing was padded
+    mask = None if mask.all() else mask.to(device, non_blocking=True)
+    return input.to(device, non_blocking=True), mask
+
+def extract_ss(net, input, mask=None):
+    return net(input, mask).cpu().data.squeeze()
+
+def extract_ms(net, input, ms, msp, mask=None):
+    pyramid = []
+    for s in ms: 
+        if s == 1:
+            pyramid.append((input, mask))
+        else:    
+            input_t = nn.functional.interpolate(input, scale_factor=s, mode='bilinear', align_corners=False)
+            mask_t = None if mask is None else LF.feature_mask(mask, input_t.shape[-2:])
+            pyramid.append((input_t, mask_t))
+
+    return extract_pyramid(net, pyramid, msp)
+
+def extract_pyramid(net, pyramid, msp):
+    """
+    Aggregates the descriptors of an image pyramid, the scales are pooled on device
+
+    Arguments
+    ---------
+    pyramid : list of (input, mask) pairs, one per scale, input #im x C x H_s x W_s
+    msp     : power used to aggregate the scales (generalized mean)
+
+    Returns
+    -------
+    v : D x #im tensor, squeezed for a single image
+    """
+    v = None
+    for input, mask in pyramid:
+        vs = net(input, mask, lw=False).pow(msp)
+        v = vs if v is None else v + vs
+
+    v = (v / len(pyramid)).pow(1./msp)
+    v = v / v.norm(dim=0, keepdim=True)
+
+    # folded learned whitening applies to the multi-scale descriptor
+    if net.lw is not None:
+        v = net.norm(net.lw(v.t())).t()
+
+    return v.cpu().data.squeeze()
+
+
+def extract_regional_vectors(net, images, image_size, transform, bbxs=None, ms=[1], msp=1, print_freq=10, batch_size=1,
+                             device=None, num_workers=8, root=None, dtype='float16', chunk_size=1024):
+    """
+    Extracts the region descriptors of every image, for networks with regional pooling.
+
+    Images of the same size are extracted together in batches of batch_size, the region
+    grid is computed once per feature map size (see LF.roipool_regions). For multi-scale
+    extraction the image pyramid is built in the data loading workers and the regions of
+    all scales are kept, msp is not used. The descriptors are collected into one ragged
+    array instead of one tensor per image; with root they are streamed into a descriptor
+    store (cirtorch.utils.store), so the memory does not grow with the number of images.
+
+    Returns
+    -------
+    rvecs : RaggedArray, rvecs[i] is the #regions x D array of image i,
+            memory mapped from the store at root if given
+    """
+    if not net.meta['regional']:
+        raise ValueError('Unsupported pooling for regional extraction: {}!'.format(net.meta['pooling']))
+
+    items = _iter_items(net, images, image_size, transform, extract_msr, bbxs=bbxs, ms=ms, print_freq=print_freq,
+                        batch_size=batch_size, device=device, num_workers=num_workers, chunk_size=chunk_size)
+    items = ((i, (item,)) for i, item in items)
+    return _collect_ragged(items, ['rvecs'], [OUTPUT_DIM[net.meta['architecture']]], [dtype], images, net.meta,
+                           root=root)[0]
 
 def extract_ssr(net, input):
     return net.pool(net.features(input), aggregate=False).squeeze(0).squeeze(-1).squeeze(-1).permute(1,0).cpu().data
 
-
-def extract_local_vectors(net, images, image_size, transform, bbxs=None, ms=[1], msp=1, print_freq=10):
-    # moving network to gpu and eval mode
-    net.cuda()
+def extract_msr(net, pyramid):
+    """
+    Region descriptors of a batch of images of the same size, for every scale of the pyramid
+
+    Returns
+    -------
+    rvecs : list of #regions x D tensors, one per image, regions of all scales concatenated
+    """
+    rvecs = [net.pool(net.features(input), aggregate=False) for input in pyramid] # #im x #reg_s x D x 1 x 1
+    rvecs = torch.cat(rvecs, dim=1).squeeze(-1).squeeze(-1).cpu()
+    return list(rvecs)
+
+def _iter_items(net, images, image_size, transform, extract, bbxs=None, ms=[1], print_freq=10, batch_size=1,
+                device=None, num_workers=8, chunk_size=1024):
+    # runs extract(net, pyramid) on batches of images of exactly the same size and yields (i, item)
+    # for every image in order, batches are bucketed within windows of chunk_size images
+
+    # moving network to device and eval mode
+    device = get_device(device)
+    net.to(device)
     net.eval()
 
-    # creating dataset loader
-    loader = torch.utils.data.DataLoader(
-        ImagesFromList(root='', images=images, imsize=image_size, bbxs=bbxs, transform=transform),
-        batch_size=1, shuffle=False, num_workers=8, pin_memory=True
-    )
+    # creating dataset loader, multi-scale pyramids are built by the workers
+    dataset = ImagesFromList(root='', images=images, imsize=image_size, bbxs=bbxs, transform=transform, ms=ms)
 
-    # extracting vectors
-    with torch.no_grad():
-        vecs = []
-        for i, input in enumerate(loader):
-            input = input.cuda()
-
-            if len(ms) == 1:
-                vecs.append(extract_ssl(net, input))
+    # the batch indexes are queued as the batches are generated, the loader returns them in the same order
+    events = collections.deque()
+    def batches():
+        for start in range(0, len(images), chunk_size):
+            idxs = range(start, min(start + chunk_size, len(images)))
+            if batch_size > 1:
+                window = bucket_batches(dataset, batch_size, exact=True, indices=idxs)
             else:
-                # TODO: not implemented yet
-                # vecs.append(extract_msl(net, input, ms, msp))
-                raise NotImplementedError
+                window = [[i] for i in idxs]
+            for batch in window:
+                events.append(batch)
+                yield batch
 
-            if (i+1) % print_freq == 0 or (i+1) == len(images):
-                print('\r>>>> {}/{} done...'.format((i+1), len(images)), end='')
-        print('')
+    loader = torch.utils.data.DataLoader(
+        dataset, batch_sampler=_Batches(batches), collate_fn=collate_padded, num_workers=num_workers,
+        pin_memory=(device.type == 'cuda')
+    )
 
-    return vecs
+    # items of a window wait until all earlier images are done
+    pending = {}
+    n = 0
+    for i, input in enumerate(loader):
+        idxs = events.popleft()
+        with torch.no_grad():
+            pyramid = [input_s.to(device, non_blocking=True) for input_s, _ in input]
+            pending.update(zip(idxs, extract(net, pyramid)))
+        while n in pending:
+            yield n, pending.pop(n)
+            n += 1
+            if n % print_freq == 0 or n == len(images):
+                print('\r>>>> {}/{} done...'.format(n, len(images)), end='')
+    print('')
+
+def _collect_ragged(items, names, dims, dtypes, images, meta, root=None):
+    # ragged arrays of the tuples of #rows x dim items, in memory or streamed into the store at root
+    if root is None:
+        lists = [[] for _ in names]
+        for _, item in items:
+            for l, array in zip(lists, item):
+                l.append(array.numpy())
+        ragged = [RaggedArray.from_list(l, dtype=dtype) for l, dtype in zip(lists, dtypes)]
+        for r, dim in zip(ragged, dims):
+            r.data = r.data.reshape(-1, dim)
+        return tuple(ragged)
+
+    with StoreWriter(root, meta=meta) as writer:
+        streams = [writer.stream_ragged(name, shape=(dim,), dtype=dtype) for name, dim, dtype in zip(names, dims, dtypes)]
+        for _, item in items:
+            for stream, array in zip(streams, item):
+                stream.append(array.numpy())
+        writer.add_strings('images', images)
+    store = Store(root)
+    return tuple(store[name] for name in names)
+
+
+def extract_local_vectors(net, images, image_size, transform, bbxs=None, ms=[1], msp=1, print_freq=10, batch_size=1,
+                          device=None, num_workers=8, root=None, dtype='float16', coords=False, chunk_size=1024):
+    """
+    Extracts the local descriptors (l2 normalized feature map locations) of every image.
+
+    Images of the same size are extracted together in batches of batch_size. For multi-scale
+    extraction the image pyramid is built in the data loading workers and the locations of
+    all scales are kept, msp is not used. The descriptors are collected into one ragged array;
+    with root they are streamed into a descriptor store (cirtorch.utils.store) and read back
+    memory mapped, so lvecs[i] is a zero-copy view and the memory does not grow with the
+    number of images.
+
+    With coords, the position of every location is returned as well: x, y of the center of its
+    feature map cell in pixels of the (resized) input image, and the scale it comes from.
+
+    Returns
+    -------
+    lvecs   : RaggedArray, lvecs[i] is the #locations x D array of image i
+    lcoords : RaggedArray, lcoords[i] is the #locations x 3 (x, y, scale) array of image i, only with coords
+    """
+    extract = lambda net, pyramid: extract_msl(net, pyramid, ms, coords=coords)
+    items = _iter_items(net, images, image_size, transform, extract, bbxs=bbxs, ms=ms, print_freq=print_freq,
+                        batch_size=batch_size, device=device, num_workers=num_workers, chunk_size=chunk_size)
+    dim = OUTPUT_DIM[net.meta['architecture']]
+    if coords:
+        return _collect_ragged(items, ['lvecs', 'lcoords'], [dim, 3], [dtype, 'float32'], images, net.meta, root=root)
+    items = ((i, (item,)) for i, item in items)
+    return _collect_ragged(items, ['lvecs'], [dim], [dtype], images, net.meta, root=root)[0]
 
 def extract_ssl(net, input):
-    return net.norm(net.features(input)).squeeze(0).view(net.meta['outputdim'], -1).cpu().data
\ No newline at end of file
+    return net.norm(net.features(input)).squeeze(0).flatten(1).cpu().data
+
+def extract_msl(net, pyramid, ms, coords=False):
+    """
+    Local descriptors of a batch of images of the same size, for every scale of the pyramid
+
+    Returns
+    -------
+    items : list with one #locations x D tensor per image, locations of all scales concatenated,
+            or one (descriptors, #locations x 3 coordinates) pair per image with coords
+    """
+    lvecs, lcoords = [], []
+    for input, s in zip(pyramid, ms):
+        o = net.norm(net.features(input)) # #im x D x h x w
+        lvecs.append(o.flatten(2).permute(0,2,1))
+        if coords:
+            # centers of the feature map cells, in pixels of the input image at scale 1
+            h, w = o.shape[-2:]
+            y = (torch.arange(h, dtype=torch.float32) + 0.5) * input.size(-2) / h / s
+            x = (torch.arange(w, dtype=torch.float32) + 0.5) * input.size(-1) / w / s
+            y, x = y.view(-1, 1).expand(h, w), x.view(1, -1).expand(h, w)
+            lcoords.append(torch.stack([x.flatten(), y.flatten(), torch.full((h*w,), float(s))], dim=1))
+
+    lvecs = list(torch.cat(lvecs, dim=1).cpu())
+    if not coords:
+        return lvecs
+    lcoords = torch.cat(lcoords, dim=0)
+    return [(v, lcoords) for v in lvecs]
@@ -0,0 +1,109 @@
+import os
+import copy
+
+import torch
+import torch.nn as nn
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+
+# --------------------------------------
+# device and threads
+# --------------------------------------
+
+def get_device(device=None):
+    """Returns the torch.device to run on, cuda if available and no device is given"""
+    if device is None:
+        device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    return torch.device(device)
+
+
+def cpu_count():
+    """Number of cpus available to this process (respects taskset / cgroup affinity)"""
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count()
+
+
+def set_threads(threads=None, interop_threads=None):
+    """
+    Sets the number of intra-op and inter-op threads used by torch on cpu.
+
+    The forward pass of ImageRetrievalNet is one chain of large ops, so intra-op threads
+    (parallelism inside a convolution) matter and inter-op threads do not; by default
+    all available cpus are used for intra-op parallelism and a single inter-op thread.
+    Keep in mind that data loading workers compete for the same cpus.
+    """
+    if threads is None:
+        threads = cpu_count()
+    if interop_threads is None:
+        interop_threads = 1
+
+    torch.set_num_threads(threads)
+    if torch.get_num_interop_threads() != interop_threads:
+        try:
+            torch.set_num_interop_threads(interop_threads)
+        except RuntimeError:
+            # can only be set once, before any inter-op parallel work has started
+            print('>> {}: inter-op threads already in use, keeping {}'
+                .format(os.path.basename(__file__), torch.get_num_interop_threads()))
+
+    return threads, torch.get_num_interop_threads()
+
+# --------------------------------------
+# graph optimizations
+# --------------------------------------
+
+def fuse_conv_bn(module):
+    """
+    Folds every BatchNorm2d that directly follows a Conv2d into the weights of that Conv2d.
+
+    Works in-place on the children of module, recursively, and replaces the folded
+    BatchNorm2d layers with nn.Identity. Only valid for inference: BN statistics have to be
+    frozen, which they are anyway for ImageRetrievalNet (see set_batchnorm_eval in training).
+    """
+    children = list(module.named_children())
+    for (name1, m1), (name2, m2) in zip(children[:-1], children[1:]):
+        if isinstance(m1, nn.Conv2d) and isinstance(m2, nn.BatchNorm2d):
+            setattr(module, name1, fuse_conv_bn_eval(m1, m2))
+            setattr(module, name2, nn.Identity())
+
+    for name, m in module.named_children():
+        fuse_conv_bn(m)
+
+    return module
+
+
+def prepare_network(net, device=None, threads=None, interop_threads=None, channels_last=False, fuse_bn=False):
+    """
+    Prepares an ImageRetrievalNet for inference on the given device.
+
+    Args:
+        net (ImageRetrievalNet): Network to be prepared
+        device (string or torch.device, Default: None): Device to run on, cuda if available when None
+        threads (int, Default: None): Number of intra-op threads on cpu, all available cpus when None
+        interop_threads (int, Default: None): Number of inter-op threads on cpu, 1 when None
+        channels_last (bool, Default: False): Run the convolutions in NHWC memory layout,
+            which is considerably faster for mkldnn on cpu and for tensor cores on gpu
+        fuse_bn (bool, Default: False): Fold batch normalization into the convolutions
+
+    Returns:
+        net (ImageRetrievalNet): Network in eval mode, on device. A copy with channels_last or
+            fuse_bn, the given network keeps its memory layout and batch normalization
+    """
+    device = get_device(device)
+
+    net.eval()
+    if channels_last or fuse_bn:
+        net = copy.deepcopy(net)
+    if fuse_bn:
+        net = fuse_conv_bn(net)
+
+    net.to(device)
+    if channels_last:
+        net.to(memory_format=torch.channels_last)
+        net.memory_format = torch.channels_last
+
+    if device.type == 'cpu':
+        threads, interop_threads = set_threads(threads, interop_threads)
+        print('>> Running on cpu with {} intra-op and {} inter-op threads'.format(threads, interop_threads))
+
+    return net
@@ -0,0 +1,154 @@
+import os
+import copy
+import collections
+
+import torch
+import torch.nn as nn
+import torch.nn.quantized.dynamic as nnqd
+import torchvision
+from torchvision.models.quantization.resnet import QuantizableBasicBlock, QuantizableBottleneck
+
+from cirtorch.networks.imageretrievalnet import extract_vectors
+
+# architectures whose features can be quantized to int8
+# (densenet and squeezenet concatenate activations, which needs its own quantization parameters)
+QUANTIZABLE = ['alexnet', 'vgg', 'resnet']
+
+# --------------------------------------
+# backbone preparation
+# --------------------------------------
+
+def _quantizable_block(block):
+    """Copy of a torchvision resnet block with the residual addition as quantizable FloatFunctional"""
+    if isinstance(block, torchvision.models.resnet.Bottleneck):
+        qblock = QuantizableBottleneck(block.conv1.in_channels, block.conv3.out_channels // block.expansion,
+                                       stride=block.stride, downsample=block.downsample)
+    elif isinstance(block, torchvision.models.resnet.BasicBlock):
+        qblock = QuantizableBasicBlock(block.conv1.in_channels, block.conv1.out_channels,
+                                       stride=block.stride, downsample=block.downsample)
+    else:
+        raise ValueError('Unsupported block for quantization: {}!'.format(block.__class__.__name__))
+    qblock.load_state_dict(block.state_dict())
+    qblock.eval()
+    return qblock
+
+
+def _fuse_sequential(features):
+    # names of consecutive Conv2d(-BatchNorm2d)(-ReLU) in a sequential, fused into one module each
+    names = []
+    children = list(features.named_children())
+    i = 0
+    while i < len(children):
+        group = [children[i][0]]
+        if isinstance(children[i][1], nn.Conv2d):
+            for cls in (nn.BatchNorm2d, nn.ReLU):
+                if i + len(group) < len(children) and isinstance(children[i+len(group)][1], cls):
+                    group.append(children[i+len(group)][0])
+        if len(group) > 1:
+            names.append(group)
+        i += len(group)
+    if names:
+        torch.quantization.fuse_modules(features, names, inplace=True)
+    return features
+
+
+def quantizable_features(net):
+    """
+    Copy of the features of an ImageRetrievalNet ready for static quantization.
+
+    Convolutions are fused with the following batch normalization and ReLU, residual
+    additions of resnets are replaced with quantizable ones, and the input is quantized
+    and the output dequantized, so the rest of the network (pooling, normalization,
+    whitening) runs in float on the dequantized feature maps.
+    """
+    architecture = net.meta['architecture']
+    if not any(architecture.startswith(a) for a in QUANTIZABLE):
+        raise ValueError('Unsupported architecture for quantization: {}!'.format(architecture))
+
+    features = copy.deepcopy(net.features).cpu().eval()
+    for name, m in features.named_children():
+        if isinstance(m, nn.Sequential):
+            # resnet layer1..layer4
+            for bname, block in m.named_children():
+                qblock = _quantizable_block(block)
+                qblock.fuse_model()
+                setattr(m, bname, qblock)
+    _fuse_sequential(features)
+
+    return nn.Sequential(collections.OrderedDict([
+        ('quant', torch.quantization.QuantStub()),
+        ('features', features),
+        ('dequant', torch.quantization.DeQuantStub()),
+    ]))
+
+# --------------------------------------
+# post-training quantization
+# --------------------------------------
+
+def quantize_network(net, images, image_size, transform, bbxs=None, backend=None, batch_size=1, num_workers=8,
+                     print_freq=10):
+    """
+    Post-training int8 quantization of an ImageRetrievalNet.
+
+    The convolutional features are quantized statically: activation ranges are calibrated on
+    the given images (a few hundred images of the target domain are enough), weights are
+    quantized per channel. The local whitening, whitening and folded learned whitening layers
+    are quantized dynamically (int8 weights, activation ranges computed on the fly). Pooling
+    and normalization stay in float. Quantized networks run on cpu only. The given network
+    is left untouched, it should not be prepared with fuse_bn, the fusion is done here.
+
+    Arguments
+    ---------
+    net        : ImageRetrievalNet in float
+    images     : list of calibration image paths
+    image_size : image size used for calibration, the same as used for extraction later on
+    transform  : transform used for calibration, the same as used for extraction later on
+    bbxs       : optional bounding boxes of the calibration images
+    backend    : quantized engine, 'fbgemm' (x86) or 'qnnpack' (arm), the current torch engine when None
+
+    Returns
+    -------
+    qnet : quantized ImageRetrievalNet, meta['quantized'] holds the backend
+    """
+    if backend is None:
+        backend = torch.backends.quantized.engine
+    if backend not in torch.backends.quantized.supported_engines:
+        raise ValueError('Unsupported quantized engine: {}!'.format(backend))
+    torch.backends.quantized.engine = backend
+
+    qnet = copy.deepcopy(net).cpu().eval()
+    qnet.memory_format = torch.contiguous_format
+
+    # static quantization of the features, observers record activation ranges during calibration
+    qnet.features = quantizable_features(net)
+    qnet.features.qconfig = torch.quantization.get_default_qconfig(backend)
+    torch.quantization.prepare(qnet.features, inplace=True)
+
+    print('>> {}: calibrating on {} images...'.format(os.path.basename(__file__), len(images)))
+    extract_vectors(qnet, images, image_size, transform, bbxs=bbxs, print_freq=print_freq, batch_size=batch_size,
+                    device='cpu', num_workers=num_workers)
+    torch.quantization.convert(qnet.features, inplace=True)
+
+    # dynamic quantization of the whitening layers, by name: convert only swaps child modules,
+    # a bare nn.Linear given as root would come back in float
+    whitening = {name for name in ('lwhiten', 'whiten', 'lw') if getattr(qnet, name) is not None}
+    if whitening:
+        torch.quantization.quantize_dynamic(qnet, whitening, dtype=torch.qint8, inplace=True)
+        for name in whitening:
+            if not isinstance(getattr(qnet, name), nnqd.Linear):
+                raise RuntimeError('Whitening layer {} was not quantized!'.format(name))
+
+    qnet.meta['quantized'] = backend
+    return qnet
+
+
+def model_size(net):
+    """Size of the parameters and buffers of a network in bytes, quantized weights included"""
+    size = 0
+    for value in net.state_dict().values():
+        if torch.is_tensor(value):
+            size += value.numel() * value.element_size()
+        elif isinstance(value, tuple):
+            # packed parameters of dynamically quantized linear layers
+            size += sum(v.numel() * v.element_size() for v in value if torch.is_tensor(v))
+    return size
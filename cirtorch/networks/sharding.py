@@ -0,0 +1,135 @@
+import os
+import json
+import math
+import hashlib
+
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+
+from cirtorch.networks.imageretrievalnet import iter_vectors
+from cirtorch.networks.inference import cpu_count, set_threads
+from cirtorch.utils.cache import network_hash
+
+
+def shard_ranges(n, num_shards):
+    """Splits n images into num_shards contiguous ranges of (almost) equal size"""
+    size = max(1, int(math.ceil(n / num_shards)))
+    return [range(s, min(s + size, n)) for s in range(0, n, size)]
+
+
+def _write_json(filename, obj):
+    # written atomically, a killed process never leaves a partial file behind
+    tmp = filename + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(obj, f)
+    os.replace(tmp, filename)
+
+
+def _read_json(filename):
+    try:
+        with open(filename) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _shard_state(root, k, info):
+    """Number of images already extracted for shard k, 0 if the shard has to start over"""
+    progress = _read_json(os.path.join(root, 'shard{:04d}.json'.format(k)))
+    if progress is None or progress['info'] != info:
+        return 0
+    return progress['done']
+
+
+def _extract_shard(root, k, net, images, info, image_size, transform, bbxs, ms, msp, batch_size, pad,
+                   device, threads, num_workers, chunk_size, print_freq, draft):
+    if torch.device(device).type == 'cpu':
+        set_threads(threads)
+
+    filename = os.path.join(root, 'shard{:04d}.npy'.format(k))
+    progress = os.path.join(root, 'shard{:04d}.json'.format(k))
+    done = _shard_state(root, k, info)
+    if done == 0 or not os.path.isfile(filename):
+        done = 0
+        vecs = np.lib.format.open_memmap(filename, mode='w+', dtype=np.float32,
+                                         shape=(len(images), net.meta['outputdim']))
+    else:
+        vecs = np.load(filename, mmap_mode='r+')
+
+    print('>> Shard {}: extracting images {}-{} on {}'.format(k, done, len(images), device))
+    rest = images[done:]
+    for idxs, chunk in iter_vectors(net, rest, image_size, transform,
+                                    bbxs=None if bbxs is None else bbxs[done:], ms=ms, msp=msp,
+                                    print_freq=print_freq, batch_size=batch_size, pad=pad, device=device,
+                                    num_workers=num_workers, chunk_size=chunk_size, draft=draft):
+        vecs[done+idxs.start:done+idxs.stop] = chunk.t().numpy()
+        # descriptors are on disk before the progress says so
+        vecs.flush()
+        _write_json(progress, {'info': info, 'done': done + idxs.stop})
+    del vecs
+
+
+def extract_sharded(net, images, image_size, transform, root, num_shards, bbxs=None, ms=[1], msp=1, batch_size=1,
+                    pad=True, devices=None, threads=None, num_workers=4, chunk_size=1024, print_freq=100, draft=False):
+    """
+    Extracts one global descriptor per image with one process per shard, resumable.
+
+    The image list is split into num_shards contiguous shards, every shard is extracted by its
+    own process with its own copy of the network, on devices[k % len(devices)] (all gpus if
+    available, cpu otherwise) and with its share of the cpu threads. Every shard writes its
+    descriptors into a memory mapped .npy file in root and records its progress after each
+    chunk of chunk_size images, so running the same call again after a crash only extracts what
+    is missing. Shards written for other images, weights or settings are started over.
+    Finally the shards are merged in the original order. Descriptors are the same as with
+    extract_vectors, up to the small differences of padded batches described there.
+
+    Returns
+    -------
+    vecs : D x N tensor of descriptors, one column per image
+    """
+    os.makedirs(root, exist_ok=True)
+    if devices is None:
+        if torch.cuda.is_available():
+            devices = ['cuda:{}'.format(i) for i in range(torch.cuda.device_count())]
+        else:
+            devices = ['cpu']
+    if threads is None:
+        threads = max(1, cpu_count() // num_shards)
+
+    ranges = shard_ranges(len(images), num_shards)
+    nethash = network_hash(net)
+    settings = {'imsize': image_size, 'transform': repr(transform), 'ms': list(ms), 'msp': msp,
+                'batch_size': batch_size, 'pad': pad}
+    if draft:
+        settings['draft'] = True
+
+    # spawn one process per unfinished shard
+    ctx = mp.get_context('spawn')
+    processes = []
+    for k, r in enumerate(ranges):
+        shard_images = images[r.start:r.stop]
+        info = {'start': r.start, 'stop': r.stop, 'network_hash': nethash, 'settings': settings,
+                'images': hashlib.sha256('\n'.join(shard_images).encode()).hexdigest()}
+        if _shard_state(root, k, info) == len(shard_images):
+            print('>> Shard {}: already extracted'.format(k))
+            continue
+        p = ctx.Process(target=_extract_shard,
+                        args=(root, k, net, shard_images, info, image_size, transform,
+                              None if bbxs is None else bbxs[r.start:r.stop], ms, msp, batch_size, pad,
+                              devices[k % len(devices)], threads, num_workers, chunk_size, print_freq, draft))
+        p.start()
+        processes.append((k, p))
+
+    for k, p in processes:
+        p.join()
+    for k, p in processes:
+        if p.exitcode != 0:
+            raise RuntimeError('Shard {} failed with exit code {}, run again to resume!'.format(k, p.exitcode))
+
+    # merge the shards in the original order
+    vecs = torch.zeros(net.meta['outputdim'], len(images))
+    for k, r in enumerate(ranges):
+        vecs[:, r.start:r.stop] = torch.from_numpy(np.load(os.path.join(root, 'shard{:04d}.npy'.format(k)))).t()
+
+    return vecs
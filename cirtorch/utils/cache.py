@@ -0,0 +1,170 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+
+import numpy as np
+import torch
+
+# maximum number of host parameters in one sqlite statement (999 in older sqlite versions)
+SQLITE_CHUNK = 500
+
+
+def network_hash(net):
+    """
+    Hash of the network weights, any change of a parameter or buffer changes the hash
+
+    Arguments
+    ---------
+    net : network (torch.nn.Module)
+
+    Returns
+    -------
+    hash : sha256 hex digest of names, shapes and values of the state dict
+    """
+    sha256 = hashlib.sha256()
+    for name, value in net.state_dict().items():
+        # packed parameters of quantized layers are tuples of tensors and other values
+        values = value if isinstance(value, tuple) else (value,)
+        for tensor in values:
+            if not torch.is_tensor(tensor):
+                sha256.update('{}:{}'.format(name, tensor).encode())
+                continue
+            tensor = tensor.detach().cpu().contiguous()
+            sha256.update('{}:{}:{}'.format(name, tensor.dtype, list(tensor.shape)).encode())
+            if tensor.is_quantized:
+                sha256.update('{}'.format(tensor.q_per_channel_scales().tolist()
+                    if tensor.qscheme() in (torch.per_channel_affine, torch.per_channel_symmetric)
+                    else (tensor.q_scale(), tensor.q_zero_point())).encode())
+                tensor = tensor.int_repr()
+            sha256.update(tensor.numpy().tobytes())
+    return sha256.hexdigest()
+
+
+class DescriptorCache(object):
+    """On-disk cache of image descriptors, addressed by image file and extraction settings
+
+    The key of a descriptor is built from the absolute image path, the modification time
+    and size of the image file, the bounding box, a hash of the network weights and the
+    extraction settings (image size, transform, multi-scale parameters). Editing an image,
+    changing the weights or any setting therefore never returns a stale descriptor.
+    Descriptors are stored in a single sqlite database, the least recently used ones are
+    evicted once the cache grows over max_size.
+
+    Args:
+        root (string): Directory holding the cache database
+        max_size (int, Default: 10 GB): Maximum size of the cached descriptors in bytes
+    """
+
+    def __init__(self, root, max_size=10*1024**3):
+        os.makedirs(root, exist_ok=True)
+        self.root = root
+        self.max_size = max_size
+        self.db = sqlite3.connect(os.path.join(root, 'descriptors.db'), timeout=60)
+        self.db.execute('CREATE TABLE IF NOT EXISTS descriptors '
+                        '(key TEXT PRIMARY KEY, vec BLOB, size INTEGER, atime REAL)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS descriptors_atime ON descriptors (atime)')
+        self.db.commit()
+
+    def prefix(self, net, settings):
+        """
+        Args:
+            net (ImageRetrievalNet): Network the descriptors are extracted with
+            settings (dict): Json serializable extraction settings
+
+        Returns:
+            prefix (string): Part of the keys shared by all images, see keys
+        """
+        return network_hash(net) + json.dumps(settings, sort_keys=True)
+
+    def keys(self, prefix, images, bbxs=None):
+        """
+        Args:
+            prefix (string): Network and settings part of the keys, see prefix
+            images (list): Image paths
+            bbxs (list, Default: None): List of (x1,y1,x2,y2) bounding boxes, one per image
+
+        Returns:
+            keys (list): One key per image
+        """
+        keys = []
+        for i, image in enumerate(images):
+            path = os.path.abspath(image)
+            try:
+                stat = os.stat(path)
+                stat = (stat.st_mtime_ns, stat.st_size)
+            except OSError:
+                # missing images are extracted as black images by the loader, never hit them
+                stat = (time.time(), os.getpid())
+            bbx = None if bbxs is None else [float(c) for c in bbxs[i]]
+            keys.append(hashlib.sha256((prefix + json.dumps([path, stat, bbx])).encode()).hexdigest())
+        return keys
+
+    def get(self, keys):
+        """
+        Args:
+            keys (list): Keys of the requested descriptors
+
+        Returns:
+            hits (dict): Descriptors (1D float32 numpy arrays) found in the cache, by key
+        """
+        hits = {}
+        for i in range(0, len(keys), SQLITE_CHUNK):
+            chunk = keys[i:i+SQLITE_CHUNK]
+            rows = self.db.execute('SELECT key, vec FROM descriptors WHERE key IN ({})'
+                                   .format(','.join('?' * len(chunk))), chunk).fetchall()
+            hits.update((key, np.frombuffer(vec, dtype=np.float32).copy()) for key, vec in rows)
+
+        # refresh access time of the hits, for the least recently used eviction
+        now = time.time()
+        self.db.executemany('UPDATE descriptors SET atime = ? WHERE key = ?', [(now, key) for key in hits])
+        self.db.commit()
+        return hits
+
+    def put(self, keys, vecs):
+        """
+        Args:
+            keys (list): Keys of the descriptors
+            vecs (Tensor): D x N descriptors, one column per key
+        """
+        vecs = vecs.detach().cpu().float().t().contiguous().numpy()
+        now = time.time()
+        self.db.executemany('INSERT OR REPLACE INTO descriptors VALUES (?, ?, ?, ?)',
+                            [(key, vec.tobytes(), vec.nbytes, now) for key, vec in zip(keys, vecs)])
+        self.db.commit()
+        self.evict()
+
+    def size(self):
+        """Size of the cached descriptors in bytes"""
+        return self.db.execute('SELECT COALESCE(SUM(size), 0) FROM descriptors').fetchone()[0]
+
+    def evict(self):
+        """Removes the least recently used descriptors until the cache fits into max_size"""
+        excess = self.size() - self.max_size
+        if excess <= 0:
+            return
+
+        evicted = []
+        for key, size in self.db.execute('SELECT key, size FROM descriptors ORDER BY atime'):
+            evicted.append((key,))
+            excess -= size
+            if excess <= 0:
+                break
+        self.db.executemany('DELETE FROM descriptors WHERE key = ?', evicted)
+        self.db.commit()
+
+    def clear(self):
+        self.db.execute('DELETE FROM descriptors')
+        self.db.commit()
+        self.db.execute('VACUUM')
+
+    def __len__(self):
+        return self.db.execute('SELECT COUNT(*) FROM descriptors').fetchone()[0]
+
+    def __repr__(self):
+        fmt_str = self.__class__.__name__ + '\n'
+        fmt_str += '    Root Location: {}\n'.format(self.root)
+        fmt_str += '    Number of descriptors: {}\n'.format(self.__len__())
+        fmt_str += '    Size: {:.1f} MB of {:.1f} MB\n'.format(self.size() / 1024**2, self.max_size / 1024**2)
+        return fmt_str
@@ -22,6 +22,9 @@ from cirtorch.datasets.genericdataset import ImagesFromList
 from cirtorch.utils.download import download_train, download_test
 from cirtorch.utils.whiten import whitenlearn, whitenapply
 from cirtorch.utils.evaluate import mapk, recall
+from cirtorch.utils.cache import DescriptorCache
+from cirtorch.utils.store import load_or_extract_vectors, extraction_settings
+from cirtorch.utils.index import exact_search, score_heatmap
 from cirtorch.utils.general import get_data_root, htime
 
 PRETRAINED = {
@@ -66,6 +69,19 @@ parser.add_argument('--whitening', '-w', metavar='WHITENING', default=None, choi
 parser.add_argument('--generate-plot', default=False, type=bool, metavar='PLOT',
                     help='Generates a plot over embedding distance and geographical distance')
 
+# descriptor cache
+parser.add_argument('--cache-dir', metavar='DIR', default=None,
+                    help='directory of the on-disk descriptor cache, disabled if not given (default: None)')
+parser.add_argument('--cache-size', default=10, type=float, metavar='GB',
+                    help='maximum size of the descriptor cache in GB (default: 10)')
+
+# binary descriptor store
+parser.add_argument('--descriptors', metavar='DIR', default=None,
+                    help='directory of the binary descriptor stores, descriptors are read from it if they were stored' +
+                        ' for the same network and images, otherwise extracted and written to it (default: None)')
+parser.add_argument('--descriptors-dtype', metavar='DTYPE', default='float32', choices=['float32', 'float16'],
+                    help="data type of the stored descriptors: 'float32' | 'float16' (default: 'float32')")
+
 # GPU ID
 parser.add_argument('--gpu-id', '-g', default='0', metavar='N',
                     help="gpu id used for testing (default: '0')")
@@ -190,7 +206,8 @@ def main():
     )
     qidxs, pidxs = test_dataset.get_loaders()
 
-    opt = {'batch_size': 1, 'shuffle': False, 'num_workers': 8, 'pin_memory': True}
+    # descriptor cache, only descriptors of new or changed images are extracted
+    cache = DescriptorCache(args.cache_dir, max_size=int(args.cache_size * 1024**3)) if args.cache_dir else None
 
     # evaluate on test datasets
     datasets = datasets_names
@@ -199,26 +216,23 @@ def main():
         
         print('>> {}: Extracting...'.format(dataset))
         
-        # Step 1: Extract Database Images - dbLoader
+        # Step 1: Extract Database Images
         print('>> {}: Extracting Database Images...'.format(dataset))
-        dbLoader = torch.utils.data.DataLoader(
-            ImagesFromList(root='', images=[test_dataset.dbImages[i] for i in range(len(test_dataset.dbImages))], imsize=imsize, transform=transform),
-            **opt)        
-        poolvecs = torch.zeros(net.meta['outputdim'], len(test_dataset.dbImages)).cuda()
-        for i, input in enumerate(dbLoader):
-            poolvecs[:, i] = net(input.cuda()).data.squeeze()
-
-        # Step 2: Extract Query Images - qLoader
+        settings = extraction_settings(imsize, transform, ms=ms, msp=msp)
+        poolvecs = load_or_extract_vectors(
+            args.descriptors and os.path.join(args.descriptors, 'db'), net, test_dataset.dbImages,
+            lambda: extract_vectors(net, test_dataset.dbImages, imsize, transform, ms=ms, msp=msp, cache=cache),
+            dtype=args.descriptors_dtype, settings=settings).cuda()
+
+        # Step 2: Extract Query Images
         print('>> {}: Extracting Query Images...'.format(dataset))
-        qLoader = torch.utils.data.DataLoader(
-                ImagesFromList(root='', images=[test_dataset.qImages[i] for i in qidxs], imsize=imsize, transform=transform),
-                **opt)
-        
         get_all_layers(net)
 
-        qvecs = torch.zeros(net.meta['outputdim'], len(qidxs)).cuda()
-        for i, input in enumerate(qLoader):
-            qvecs[:, i] = net(input.cuda()).data.squeeze()
+        qimages = [test_dataset.qImages[i] for i in qidxs]
+        qvecs = load_or_extract_vectors(
+            args.descriptors and os.path.join(args.descriptors, 'query'), net, qimages,
+            lambda: extract_vectors(net, qimages, imsize, transform, ms=ms, msp=msp, cache=cache),
+            dtype=args.descriptors_dtype, settings=settings).cuda()
         
         print('Visualization keys: ', len(visualisation.keys()))
         for i, tensor in enumerate(visualisation.keys()):
@@ -231,21 +245,12 @@ def main():
         querycoordinates = torch.tensor([test_dataset.gpsInfo[test_dataset.qImages[i][-26:-4]] for i in qidxs], dtype=torch.float)
         poolcoordinates = torch.tensor([test_dataset.gpsInfo[test_dataset.dbImages[i][-26:-4]] for i in range(len(test_dataset.dbImages))], dtype=torch.float)
 
-        # GPS: Compute distances
-        distances = torch.norm(querycoordinates[:, None] - poolcoordinates, dim=2)
-            
-        # GPS: Sort distances
-        distances, indicies = torch.sort(distances, dim=1, descending=False)
-        
-        # Step 3: Ranks 
-        scores = torch.mm(poolvecs.t(), qvecs)
-        #scores, ranks = torch.sort(scores, dim=0, descending=True) # Euclidan distance is 1 - Score 
+        # GPS: 10 nearest database images of every query
+        distances, indicies = exact_search(poolcoordinates.t(), querycoordinates.t(), 10, metric='l2')
         
-        #ranks = ranks.cpu().numpy()
-        #ranks = np.transpose(ranks)
-
-        scores = scores.cpu().numpy()
-        scores = np.transpose(scores)
+        # Step 3: Scores, computed below for the geographically nearest database images only
+        # (Euclidan distance is 1 - Score)
+        poolvecs, qvecs = poolvecs.cpu(), qvecs.cpu()
 
         if not args.generate_plot:
             print('>>> {}: Generating Correlation Data'.format(dataset))
@@ -261,9 +266,9 @@ def main():
                 emb = []
                 pictures = [test_dataset.qImages[qidxs[q]].split('/')[-1][:-4]]
                 angles = []
-                while distances[q, positive] < 50 and positive < 10:
+                while positive < distances.shape[1] and distances[q, positive] < 50:
                     index = indicies[q, positive]
-                    emb.append(scores[q, index].item())
+                    emb.append(torch.dot(poolvecs[:, index], qvecs[:, q]).item())
                     gps.append(distances[q, positive])
                     pictures.append(test_dataset.dbImages[index])
                     
@@ -292,27 +297,28 @@ def main():
             gpsinfo = test_dataset.gpsInfo
             angleInfo = test_dataset.angleInfo
 
-            scores = np.ones(np.shape(scores)) - scores
+            # heatmaps averaged over blocks of images, computed tile by tile
+            scores = 1 - score_heatmap(poolvecs, qvecs)
             plt.imshow(scores, interpolation='nearest')
             plt.colorbar()
             plt.savefig('plots/q_scores_heatmap')
             plt.clf() 
             
-            scores = torch.mm(poolvecs.t(), poolvecs)
-            scores = scores.cpu().numpy()
-            scores = np.ones(np.shape(scores)) - scores
+            scores = 1 - score_heatmap(poolvecs, poolvecs)
             plt.imshow(scores, interpolation='nearest')
             plt.colorbar()
             plt.savefig('plots/pool_scores_heatmap')
             plt.clf()
 
-            distances = torch.norm(querycoordinates[:, None] - poolcoordinates, dim=2)
+            distances = score_heatmap(poolcoordinates.t(), querycoordinates.t(), metric='l2')
             plt.imshow(distances, interpolation='nearest')
             plt.colorbar()
             plt.savefig('plots/gps_distances_heatmap')
             plt.clf() 
 
-            indicator = torch.where(distances > 25, torch.zeros(distances.size()), torch.ones(distances.size()))
+            # fraction of pairs within 25 m
+            indicator = score_heatmap(poolcoordinates.t(), querycoordinates.t(), metric='l2',
+                                      transform=lambda d: (d <= 25).float())
             plt.imshow(indicator, interpolation='nearest')
             plt.colorbar()
             plt.savefig('plots/gps_indicator')
@@ -0,0 +1,249 @@
+import os
+import json
+
+import numpy as np
+import torch
+
+from cirtorch.utils.index import index_factory, load_index, quantization_error
+from cirtorch.utils.store import StoreWriter, Store, is_store, append_store
+
+# relative increase of the quantization error of the added descriptors that triggers re-clustering
+DRIFT_THRESHOLD = 0.2
+
+# maximum number of descriptors an index is trained on
+TRAIN_SAMPLE = 262144
+
+# number of descriptors added at once when an index is rebuilt
+ADD_CHUNK = 65536
+
+
+def _held_out(n):
+    # every tenth of n sampled training descriptors is held out, none of fewer than 10
+    held = np.zeros(n, dtype=bool)
+    held[::10] = n >= 10
+    return held
+
+
+class Database(object):
+    """Growing database of images, with descriptors and coordinates on disk and an approximate index
+
+    Images get stable int64 ids (0, 1, 2... in the order they are added) that are never reused.
+    Adding images appends their descriptors, ids, paths and coordinates to the descriptor store
+    root/store and adds them to the index, without extracting the database again. Removing images
+    appends their ids to the removed ids of the store and drops them from the index, their rows
+    stay in the store.
+
+    The extraction settings given to the first add, eg the network hash and extraction_settings,
+    are stored with the database, images extracted with other settings are rejected.
+
+    The index is trained on the first images added, at least as many as the index needs for
+    training besides the held out tenth. It is re-trained on all images of the
+    database (re-clustering) only when it drifts: when the quantization error of the images added
+    since the last training exceeds the error of held out training images by more than the drift
+    threshold, eg after new areas were captured. Binary indexes are never re-trained. The index
+    is written to root/index after every update and read into memory when the database is opened,
+    a database without index (eg its training failed) trains one on the next add.
+
+    Args:
+        root (string): Directory of the database, created by the first add
+        spec (string, Default: None): Index specification of a new database, see index_factory
+        extract (function, Default: None): Function from a list of N image paths to their D x N
+            descriptors, used by add when no descriptors are given
+        drift (float, Default: DRIFT_THRESHOLD): Relative increase of the quantization error that
+            triggers re-clustering
+    """
+
+    def __init__(self, root, spec=None, extract=None, drift=DRIFT_THRESHOLD):
+        self.root = root
+        self.extract = extract
+        self.drift_threshold = drift
+        self.store_root = os.path.join(root, 'store')
+        self.index_root = os.path.join(root, 'index')
+        if is_store(self.store_root):
+            store = Store(self.store_root)
+            self.spec = store.meta['spec']
+            self.removed = np.array(store['removed'], dtype=np.int64)
+            # updates rewrite the index files, they cannot be memory mapped
+            self.index = load_index(self.index_root, mmap=False) if is_store(self.index_root) else None
+        elif spec is None:
+            raise RuntimeError('No database found in {}, and no index specification given!'.format(root))
+        else:
+            self.spec = spec
+            self.removed = np.zeros(0, dtype=np.int64)
+            self.index = None
+
+    @property
+    def meta(self):
+        return Store(self.store_root).meta if is_store(self.store_root) else {}
+
+    @property
+    def ntotal(self):
+        """Number of images in the database, without the removed ones"""
+        return 0 if self.index is None else self.index.ntotal
+
+    def __len__(self):
+        return self.ntotal
+
+    @property
+    def drift(self):
+        """Relative increase of the quantization error of the images added since the last training"""
+        meta = self.meta
+        if not meta.get('added_count') or not meta.get('train_error'):
+            return 0.0
+        return meta['added_error'] / meta['added_count'] / meta['train_error'] - 1
+
+    def check_settings(self, settings):
+        """Raises a ValueError if the images of the database were extracted with other settings"""
+        if settings is None:
+            return
+        settings = json.loads(json.dumps(settings, sort_keys=True))
+        stored = self.meta.get('settings', settings)
+        if stored != settings:
+            raise ValueError('Unsupported extraction settings for database {} extracted with {}: {}!'.format(
+                self.root, stored, settings))
+
+    def add(self, images, coordinates=None, vecs=None, settings=None):
+        """
+        Adds images to the database
+
+        Arguments
+        ---------
+        images      : list of N image paths
+        coordinates : N x 2 easting and northing of the images, NaN when None
+        vecs        : D x N descriptors of the images, extracted with extract when None
+        settings    : json serializable settings the descriptors are extracted with, stored by
+                      the first add and compared by the following ones, not checked when None
+
+        Returns
+        -------
+        ids : N int64 ids of the images
+        """
+        self.check_settings(settings)
+        if vecs is None:
+            if self.extract is None:
+                raise RuntimeError('Database has no extract function, descriptors have to be given!')
+            vecs = self.extract(images)
+        if torch.is_tensor(vecs):
+            vecs = vecs.detach().cpu().numpy()
+        rows = np.ascontiguousarray(np.asarray(vecs, dtype=np.float32).T)
+        n = len(rows)
+        if len(images) != n:
+            raise ValueError('Number of images {} does not match the number of descriptors {}!'.format(len(images), n))
+        if coordinates is None:
+            coordinates = np.full((n, 2), np.nan)
+        coordinates = np.asarray(coordinates, dtype=np.float64).reshape(n, 2)
+
+        meta = self.meta
+        start = meta.get('next_id', 0)
+        ids = np.arange(start, start + n, dtype=np.int64)
+        if self.index is None:
+            # checked before anything is written, the index is trained on all live images
+            nsample = min(start - len(self.removed) + n, TRAIN_SAMPLE)
+            ntrain = nsample - _held_out(nsample).sum()
+            min_train = index_factory(self.spec, rows.shape[1]).min_train
+            if ntrain < min_train:
+                raise ValueError('Unsupported number of training images for index {} (at least {}): {}!'.format(
+                    self.spec, min_train, ntrain))
+
+        # descriptors and ids on disk first, the index is derived from them
+        if not is_store(self.store_root):
+            first = {'spec': self.spec, 'next_id': start + n}
+            if settings is not None:
+                first['settings'] = settings
+            with StoreWriter(self.store_root, meta=first) as writer:
+                writer.add('vecs', rows, dtype='float32')
+                writer.add('ids', ids, dtype='int64')
+                writer.add_strings('images', images)
+                writer.add('coordinates', coordinates, dtype='float64')
+                writer.add('removed', np.zeros(0, dtype=np.int64))
+        else:
+            append_store(self.store_root, {'vecs': rows, 'ids': ids, 'images': np.array(images, dtype=np.str_),
+                                           'coordinates': coordinates}, meta={'next_id': start + n})
+
+        if self.index is None:
+            self.recluster()
+            return ids
+
+        self.index.add(rows.T, ids)
+        error = quantization_error(self.index, rows.T)
+        if error is not None:
+            append_store(self.store_root, {}, meta={'added_error': meta.get('added_error', 0) + error * n,
+                                                    'added_count': meta.get('added_count', 0) + n})
+        if self.drift > self.drift_threshold:
+            print('>> Index drift {:.3f} exceeds {}, re-clustering...'.format(self.drift, self.drift_threshold))
+            self.recluster()
+        else:
+            self.index.save(self.index_root)
+        return ids
+
+    def remove(self, ids):
+        """Removes the images of ids from the database, returns the number of removed images"""
+        ids = np.setdiff1d(np.asarray(ids, dtype=np.int64), self.removed)
+        ids = ids[ids < self.meta.get('next_id', 0)]
+        if len(ids) == 0:
+            return 0
+        append_store(self.store_root, {'removed': ids})
+        self.removed = np.concatenate([self.removed, ids])
+        removed = self.index.remove(ids)
+        self.index.save(self.index_root)
+        return removed
+
+    def recluster(self, seed=0):
+        """Trains a new index on a sample of the images of the database and adds all of them to it"""
+        store = Store(self.store_root)
+        vecs, ids = store['vecs'], store['ids']
+        live = np.where(~np.isin(ids, self.removed))[0]
+        if len(live) > TRAIN_SAMPLE:
+            sample = np.sort(np.random.RandomState(seed).choice(live, TRAIN_SAMPLE, replace=False))
+        else:
+            sample = live
+        # the reference error of the drift is measured on a held out tenth of the sample, the error
+        # of the training descriptors themselves is too optimistic for fine quantizers
+        held = _held_out(len(sample))
+        train, heldout = np.asarray(vecs[sample[~held]]).T, np.asarray(vecs[sample[held]]).T
+
+        print('>> Training index {} on {} of {} images...'.format(self.spec, len(train.T), len(live)))
+        index = index_factory(self.spec, vecs.shape[1]).train(train)
+        for i in range(0, len(live), ADD_CHUNK):
+            index.add(np.asarray(vecs[live[i:i+ADD_CHUNK]]).T, ids[live[i:i+ADD_CHUNK]])
+        self.index = index
+
+        append_store(self.store_root, {}, meta={'train_error': quantization_error(index, heldout if held.any() else train),
+                                                'added_error': 0, 'added_count': 0})
+        self.index.save(self.index_root)
+
+    def search(self, qvecs, k, **kwargs):
+        """k highest scoring images of every query, ranks are ids, see the search of the index"""
+        if self.index is None:
+            raise RuntimeError('Database {} is empty!'.format(self.root))
+        return self.index.search(qvecs, k, **kwargs)
+
+    def lookup(self, ids):
+        """
+        Image paths and coordinates of ids, '' and NaN for unknown or removed ids
+
+        Returns
+        -------
+        images      : list of image paths
+        coordinates : N x 2 easting and northing
+        """
+        ids = np.asarray(ids, dtype=np.int64).ravel()
+        store = Store(self.store_root)
+        stored = store['ids']
+        # ids are stored in increasing order
+        pos = np.minimum(np.searchsorted(stored, ids), max(len(stored) - 1, 0))
+        found = (len(stored) > 0) & (stored[pos] == ids) & ~np.isin(ids, self.removed)
+        paths, coords = store['images'], store['coordinates']
+        images = [str(paths[p]) if f else '' for p, f in zip(pos, found)]
+        coordinates = np.where(found[:, None], coords[pos], np.nan)
+        return images, coordinates
+
+    def __repr__(self):
+        meta = self.meta
+        fmt_str = self.__class__.__name__ + '\n'
+        fmt_str += '    Root Location: {}\n'.format(self.root)
+        fmt_str += '    Index: {}\n'.format(self.spec)
+        fmt_str += '    Number of images: {}\n'.format(self.ntotal)
+        fmt_str += '    Removed images: {}\n'.format(len(self.removed))
+        fmt_str += '    Drift: {:.3f} of {} images added since training\n'.format(self.drift, meta.get('added_count', 0))
+        return fmt_str
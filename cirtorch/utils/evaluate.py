@@ -49,7 +49,9 @@ def compute_map(ranks, gnd, kappas=[]):
                  computes mean precision at kappas (pr), precision at kappas (prs) for each query
         
          Notes:
-         1) ranks starts from 0, ranks.shape = db_size X #queries
+         1) ranks starts from 0, ranks.shape = db_size X #queries, or k X #queries for the
+            top k results only (eg of exact_search or an index, transposed), positive images
+            not among them count as not retrieved, ids of -1 (no result) are ignored
          2) The junk results (e.g., the query itself) should be declared in the gnd stuct array
          3) If there are no positive images for some query, that query is excluded from the evaluation
     """
@@ -101,7 +103,8 @@ def compute_map(ranks, gnd, kappas=[]):
         # compute precision @ k
         pos += 1 # get it to 1-based
         for j in np.arange(len(kappas)):
-            kq = min(max(pos), kappas[j]); 
+            # with truncated ranks the last positive may not be ranked at all
+            kq = min(max(pos), kappas[j]) if len(pos) == len(qgnd) else kappas[j]
             prs[i, j] = (pos <= kq).sum() / kq
         pr = pr + prs[i, :]
 
@@ -159,6 +162,12 @@ def recall(ranks, pidxs, qidxs, ks):
     return recall_at_k
 """
 def recall(ranks, pidx, ks):
+	"""
+	Fraction of queries with a positive among their first k results, for every k in ks
+
+	ranks is #queries x #results, eg the top k results of exact_search, positives ranked after
+	them count as not retrieved, ids of -1 (no result) never count as positive
+	"""
 
 	recall_at_k = np.zeros(len(ks))
 	for qidx in range(ranks.shape[0]):
@@ -187,4 +196,5 @@ def apk(pidx, rank, k):
     return score / min(len(pidx), k)
 
 def mapk(ranks, pidxs, k):
+    """mean average precision of the first k results, ranks is #queries x #results as in recall"""
     return np.mean([apk(a,p,k) for a,p in zip(pidxs, ranks)])
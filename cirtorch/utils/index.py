@@ -0,0 +1,1179 @@
+import re
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+from sklearn.neighbors import NearestNeighbors
+
+from cirtorch.utils.cache import network_hash
+from cirtorch.utils.store import StoreWriter, Store, is_store
+from cirtorch.utils.whiten import pcawhitenlearn, whitenapply
+
+# maximum number of training points per centroid, more points are subsampled
+MAX_POINTS_PER_CENTROID = 256
+
+# number of rows assigned to centroids at once
+ASSIGN_CHUNK = 65536
+
+# maximum number of queries of a score tile
+QUERY_CHUNK = 1024
+
+# minimum number of database columns of a score tile
+TILE_COLUMNS = 4096
+
+# default memory budget of the score tiles in bytes
+SCORE_MEMORY = 256 * 1024**2
+
+# alternations of k-means and rotation when learning an OPQ rotation, and k-means iterations in each
+OPQ_ITER = 10
+OPQ_KMEANS_ITER = 4
+
+# maximum number of descriptors the projection of a binary index is learned from
+PCA_TRAIN_POINTS = 65536
+
+# candidates of the hamming search re-ranked per result of a binary index
+SHORTLIST_PER_RESULT = 10
+
+# number of set bits of every byte
+POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+# --------------------------------------
+# helpers
+# --------------------------------------
+
+def _rows(vecs):
+    # D x N descriptors (torch tensor or numpy array) as contiguous N x D float32 numpy rows
+    if torch.is_tensor(vecs):
+        vecs = vecs.detach().cpu().numpy()
+    return np.ascontiguousarray(np.asarray(vecs, dtype=np.float32).T)
+
+
+def vectors_hash(vecs):
+    """sha256 hex digest of D x N descriptors, identifies the descriptors an index was built from"""
+    rows = _rows(vecs)
+    sha256 = hashlib.sha256()
+    sha256.update('{}'.format(list(rows.shape)).encode())
+    sha256.update(rows.tobytes())
+    return sha256.hexdigest()
+
+
+def assign(x, centroids):
+    """
+    Nearest centroid (L2) of every row
+
+    Arguments
+    ---------
+    x         : N x D numpy rows
+    centroids : K x D numpy centroids
+
+    Returns
+    -------
+    labels : N int64 index of the nearest centroid
+    """
+    c = torch.from_numpy(np.array(centroids, dtype=np.float32))
+    cnorm = (c * c).sum(1)
+    labels = np.zeros(len(x), dtype=np.int64)
+    for i in range(0, len(x), ASSIGN_CHUNK):
+        xi = torch.from_numpy(np.ascontiguousarray(x[i:i+ASSIGN_CHUNK], dtype=np.float32))
+        # argmin ||x - c||^2 = argmin ||c||^2 - 2 x.c
+        labels[i:i+ASSIGN_CHUNK] = torch.addmm(cnorm, xi, c.t(), alpha=-2).argmin(1).numpy()
+    return labels
+
+
+def kmeans(x, k, niter=20, seed=0, init=None):
+    """
+    Lloyd's k-means, empty clusters are restarted on random points
+
+    Arguments
+    ---------
+    x     : N x D numpy rows, at most MAX_POINTS_PER_CENTROID*k random rows are used
+    k     : number of centroids
+    niter : number of iterations
+    init  : k x D initial centroids, k random rows when None
+
+    Returns
+    -------
+    centroids : k x D float32 numpy centroids
+    """
+    if len(x) < k:
+        raise ValueError('Unsupported number of centroids for {} training points: {}!'.format(len(x), k))
+    rng = np.random.RandomState(seed)
+    if len(x) > MAX_POINTS_PER_CENTROID * k:
+        x = x[np.sort(rng.choice(len(x), MAX_POINTS_PER_CENTROID * k, replace=False))]
+    x = np.ascontiguousarray(x, dtype=np.float32)
+    xt = torch.from_numpy(x)
+
+    if init is None:
+        centroids = x[rng.choice(len(x), k, replace=False)].copy()
+    else:
+        centroids = np.array(init, dtype=np.float32)
+    for _ in range(niter):
+        labels = assign(x, centroids)
+        counts = np.bincount(labels, minlength=k)
+        sums = torch.zeros(k, x.shape[1]).index_add_(0, torch.from_numpy(labels), xt).numpy()
+        empty = counts == 0
+        centroids[~empty] = sums[~empty] / counts[~empty, None]
+        centroids[empty] = x[rng.choice(len(x), empty.sum(), replace=False)]
+    return centroids
+
+# --------------------------------------
+# blocked exact scoring
+# --------------------------------------
+
+def _split(n, parts):
+    # parts contiguous (start, end) ranges covering range(n)
+    bounds = np.linspace(0, n, max(1, min(parts, n)) + 1).astype(np.int64)
+    return [(int(a), int(b)) for a, b in zip(bounds[:-1], bounds[1:]) if b > a]
+
+
+def _tile_shape(nq, n, width, memory):
+    # queries x database columns of a score tile, the tile and width merge columns per query within memory bytes
+    tq = int(min(nq, QUERY_CHUNK, max(1, memory // (4 * 2 * max(width, TILE_COLUMNS)))))
+    tn = int(min(n, max(width, memory // (4 * tq) - width)))
+    return tq, tn
+
+
+def _scores(q, vecs, metric):
+    # Nq x N scores of queries (rows) against database (columns)
+    if metric == 'ip':
+        return torch.mm(q, vecs)
+    # differences instead of the expanded product, precise for large coordinates
+    return torch.cdist(q, vecs.t(), compute_mode='donot_use_mm_for_euclid_dist')
+
+
+def _run(tasks, threads):
+    # tasks run concurrently, torch releases the GIL in the scoring
+    if threads <= 1 or len(tasks) <= 1:
+        return [task() for task in tasks]
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        return list(pool.map(lambda task: task(), tasks))
+
+
+def exact_search(vecs, qvecs, k, metric='ip', memory=SCORE_MEMORY, threads=None):
+    """
+    k nearest database descriptors of every query, by brute force
+
+    The query x database score matrix is never held in memory: queries and database are tiled,
+    the k best of every tile are selected (partial selection with topk) and merged into the
+    running top k of its queries. Tiles are sized so that all tiles scored at the same time fit
+    into memory bytes, so the peak memory does not grow with the database. On cpu the tiles are
+    scored concurrently by threads workers, each on its own block of queries and slab of the
+    database; on gpu they are scored one after another on the device of vecs.
+
+    Arguments
+    ---------
+    vecs    : D x N database descriptors, torch tensor or numpy array
+    qvecs   : D x Nq query descriptors
+    k       : number of results per query, at most N
+    metric  : 'ip' for the highest inner products (scores of L2 normalized descriptors),
+              'l2' for the smallest euclidean distances (eg of gps coordinates)
+    memory  : memory budget of the score tiles in bytes
+    threads : number of tiles scored concurrently on cpu, torch.get_num_threads() when None
+
+    Returns
+    -------
+    scores : Nq x k scores (inner products or distances), best first
+    ranks  : Nq x k database columns of the results
+    (numpy arrays for numpy input, tensors on the device of vecs otherwise)
+    """
+    if metric not in ('ip', 'l2'):
+        raise ValueError('Unsupported metric: {}!'.format(metric))
+    is_numpy = not torch.is_tensor(vecs)
+    vecs = torch.as_tensor(vecs)
+    qvecs = torch.as_tensor(qvecs).to(device=vecs.device, dtype=vecs.dtype)
+    largest = metric == 'ip'
+    (d, n), nq = vecs.shape, qvecs.shape[1]
+    k = min(k, n)
+    threads = 1 if vecs.is_cuda else (threads or torch.get_num_threads())
+    if nq == 0 or n == 0:
+        scores = torch.zeros(nq, k, dtype=vecs.dtype, device=vecs.device)
+        ranks = torch.zeros(nq, k, dtype=torch.int64, device=vecs.device)
+        return (scores.numpy(), ranks.numpy()) if is_numpy else (scores, ranks)
+
+    # blocks of queries, and slabs of the database when there are fewer blocks than threads
+    qblocks = _split(nq, threads)
+    slabs = _split(n, min(max(1, threads // len(qblocks)), max(1, n // max(k, TILE_COLUMNS))))
+    budget = memory // min(threads, len(qblocks) * len(slabs))
+
+    def search(qb, sb):
+        q = qvecs[:, qb[0]:qb[1]].t()
+        tq, tn = _tile_shape(len(q), sb[1] - sb[0], k, budget)
+        scores, ranks = [], []
+        for i in range(0, len(q), tq):
+            top_s = torch.zeros(min(tq, len(q) - i), 0, dtype=vecs.dtype, device=vecs.device)
+            top_r = torch.zeros(top_s.shape, dtype=torch.int64, device=vecs.device)
+            for j in range(sb[0], sb[1], tn):
+                s = _scores(q[i:i+tq], vecs[:, j:min(j+tn, sb[1])], metric)
+                s, r = s.topk(min(k, s.shape[1]), dim=1, largest=largest)
+                # merge the best of the tile with the best so far
+                top_s, best = torch.cat([top_s, s], dim=1).topk(min(k, top_s.shape[1] + s.shape[1]), dim=1,
+                                                                 largest=largest)
+                top_r = torch.cat([top_r, r + j], dim=1).gather(1, best)
+            scores.append(top_s)
+            ranks.append(top_r)
+        return torch.cat(scores), torch.cat(ranks)
+
+    results = _run([lambda qb=qb, sb=sb: search(qb, sb) for qb in qblocks for sb in slabs], threads)
+
+    # merge the slabs of every block of queries
+    scores, ranks = [], []
+    for b in range(len(qblocks)):
+        s = torch.cat([results[b*len(slabs) + i][0] for i in range(len(slabs))], dim=1)
+        r = torch.cat([results[b*len(slabs) + i][1] for i in range(len(slabs))], dim=1)
+        s, best = s.topk(k, dim=1, largest=largest)
+        scores.append(s)
+        ranks.append(r.gather(1, best))
+    scores, ranks = torch.cat(scores), torch.cat(ranks)
+
+    if is_numpy:
+        return scores.numpy(), ranks.numpy()
+    return scores, ranks
+
+
+def score_heatmap(vecs, qvecs, bins=512, metric='ip', transform=None, memory=SCORE_MEMORY):
+    """
+    Query x database score matrix averaged over blocks of at most bins x bins cells, for plotting
+
+    The scores are computed tile by tile within memory bytes and summed into their cells, so
+    the full matrix is never held in memory. With at most bins queries and database images the
+    heatmap is the score matrix itself.
+
+    Arguments
+    ---------
+    vecs      : D x N database descriptors, torch tensor or numpy array
+    qvecs     : D x Nq query descriptors
+    metric    : 'ip' for inner products, 'l2' for euclidean distances, as in exact_search
+    transform : optional function applied to the scores of a tile before averaging,
+                eg lambda d: (d <= 25).float() for the fraction of pairs closer than 25 m
+
+    Returns
+    -------
+    heatmap : min(Nq, bins) x min(N, bins) numpy array
+    """
+    if metric not in ('ip', 'l2'):
+        raise ValueError('Unsupported metric: {}!'.format(metric))
+    vecs = torch.as_tensor(vecs)
+    qvecs = torch.as_tensor(qvecs).to(device=vecs.device, dtype=vecs.dtype)
+    n, nq = vecs.shape[1], qvecs.shape[1]
+
+    # cell of every query and database image
+    qcells = torch.arange(nq, device=vecs.device) * min(nq, bins) // nq
+    cells = torch.arange(n, device=vecs.device) * min(n, bins) // n
+    heatmap = torch.zeros(min(nq, bins), min(n, bins), dtype=torch.float64, device=vecs.device)
+
+    # a tile is also summed in double precision
+    tq, tn = _tile_shape(nq, n, 0, memory // 3)
+    for i in range(0, nq, tq):
+        for j in range(0, n, tn):
+            s = _scores(qvecs[:, i:i+tq].t(), vecs[:, j:j+tn], metric)
+            if transform is not None:
+                s = transform(s)
+            rows = torch.zeros(s.shape[0], heatmap.shape[1], dtype=torch.float64, device=vecs.device)
+            rows.index_add_(1, cells[j:j+tn], s.double())
+            heatmap.index_add_(0, qcells[i:i+tq], rows)
+
+    counts = torch.bincount(qcells).double()[:, None] * torch.bincount(cells).double()[None, :]
+    return (heatmap / counts).cpu().numpy()
+
+# --------------------------------------
+# product quantization
+# --------------------------------------
+
+class ProductQuantizer(object):
+    """Product quantizer of N x D rows, optionally preceded by a learned rotation (OPQ)
+
+    A row is split into m sub-vectors of d/m dimensions, each encoded by the index of its nearest
+    sub-centroid, one byte for nbits=8: a 2048-d float32 descriptor of 8 KB is encoded in m bytes.
+    With opq the rows are first rotated by an orthogonal matrix R that balances the variance of
+    the sub-vectors, learned by alternating k-means of the rotated rows with the solution of the
+    orthogonal Procrustes problem between the rows and their reconstructions. R is orthogonal,
+    inner products are kept: q.x = (qR).(xR).
+
+    Args:
+        d (int): Dimension of the rows
+        m (int): Number of sub-quantizers, has to divide d
+        nbits (int, Default: 8): Bits per sub-quantizer code, at most 8
+        opq (bool, Default: False): Learn a rotation of the rows before quantizing them
+    """
+
+    def __init__(self, d, m, nbits=8, opq=False):
+        if d % m != 0:
+            raise ValueError('Unsupported number of sub-quantizers for dimension {}: {}!'.format(d, m))
+        if not 1 <= nbits <= 8:
+            raise ValueError('Unsupported number of bits per code: {}!'.format(nbits))
+        self.d = d
+        self.m = m
+        self.nbits = nbits
+        self.opq = opq
+        self.rotation = None # d x d, rows are encoded as x.R
+        self.codebooks = None # m x 2**nbits x d/m
+
+    @property
+    def is_trained(self):
+        return self.codebooks is not None
+
+    @property
+    def nbytes(self):
+        return self.codebooks.nbytes + (0 if self.rotation is None else self.rotation.nbytes)
+
+    def _subvectors(self, x):
+        # N x D rows as N x m x D/m sub-vectors
+        return x.reshape(len(x), self.m, self.d // self.m)
+
+    def _train_codebooks(self, x, niter, seed, init=None):
+        x = self._subvectors(x)
+        return np.stack([kmeans(x[:, j], 2**self.nbits, niter=niter, seed=seed+j,
+                                init=None if init is None else init[j]) for j in range(self.m)])
+
+    def _quantize(self, x):
+        # codes of rotated rows
+        x = self._subvectors(x)
+        codes = np.zeros((len(x), self.m), dtype=np.uint8)
+        for j in range(self.m):
+            codes[:, j] = assign(x[:, j], self.codebooks[j])
+        return codes
+
+    def _reconstruct(self, codes):
+        # rotated rows of codes
+        return np.concatenate([self.codebooks[j][codes[:, j]] for j in range(self.m)], axis=1)
+
+    def rotate(self, x):
+        """N x D rows in the space of the sub-quantizers"""
+        x = np.ascontiguousarray(x, dtype=np.float32)
+        return x if self.rotation is None else x.dot(self.rotation)
+
+    def train(self, x, niter=20, seed=0):
+        """Learns the rotation and the codebooks from N x D rows, at most 256 rows per sub-centroid are used"""
+        x = np.ascontiguousarray(x, dtype=np.float32)
+        codebooks = None
+        if self.opq:
+            rng = np.random.RandomState(seed)
+            if len(x) > MAX_POINTS_PER_CENTROID * 2**self.nbits:
+                x = x[np.sort(rng.choice(len(x), MAX_POINTS_PER_CENTROID * 2**self.nbits, replace=False))]
+            self.rotation = np.eye(self.d, dtype=np.float32)
+            for _ in range(OPQ_ITER):
+                xr = x.dot(self.rotation)
+                self.codebooks = codebooks = self._train_codebooks(xr, OPQ_KMEANS_ITER, seed, init=codebooks)
+                y = self._reconstruct(self._quantize(xr))
+                # R = argmin ||xR - y|| over orthogonal matrices
+                u, _, vt = np.linalg.svd(x.T.dot(y).astype(np.float64))
+                self.rotation = u.dot(vt).astype(np.float32)
+        self.codebooks = self._train_codebooks(self.rotate(x), niter, seed, init=codebooks)
+        return self
+
+    def encode(self, x):
+        """N x m codes (uint8) of N x D rows"""
+        return self._quantize(self.rotate(x))
+
+    def decode(self, codes):
+        """N x D rows reconstructed from N x m codes"""
+        y = self._reconstruct(np.asarray(codes))
+        return y if self.rotation is None else y.dot(self.rotation.T)
+
+    def lookup_tables(self, q):
+        """Nq x m x 2**nbits tables of sub-query . sub-centroid products of Nq x D query rows"""
+        return np.einsum('nmd,mkd->nmk', self._subvectors(self.rotate(q)), self.codebooks)
+
+
+def adc_scores(lut, codes):
+    """
+    Asymmetric inner products of queries with encoded descriptors, the sum of m table lookups
+
+    Arguments
+    ---------
+    lut   : Nq x m x 2**nbits lookup tables of the queries, see ProductQuantizer.lookup_tables
+    codes : N x m codes of the descriptors
+
+    Returns
+    -------
+    scores : Nq x N float32 numpy scores
+    """
+    scores = np.zeros((len(lut), len(codes)), dtype=np.float32)
+    for j in range(lut.shape[1]):
+        scores += np.take(lut[:, j], codes[:, j], axis=1)
+    return scores
+
+
+def _merge_topk(top_scores, top_ids, scores, ids):
+    # best of the results so far and of the scores of ids, unordered, as wide as top_scores
+    k = top_scores.shape[1]
+    scores = np.concatenate([top_scores, scores], axis=1)
+    cand = np.concatenate([top_ids, np.broadcast_to(ids, (len(scores), len(ids)))], axis=1)
+    best = np.argpartition(-scores, k - 1, axis=1)[:, :k] if scores.shape[1] > k \
+        else np.arange(scores.shape[1])[None].repeat(len(scores), 0)
+    return np.take_along_axis(scores, best, axis=1), np.take_along_axis(cand, best, axis=1)
+
+
+def _sort_topk(top_scores, top_ids):
+    # results best first
+    best = np.argsort(-top_scores, axis=1, kind='stable')
+    return np.take_along_axis(top_scores, best, axis=1), np.take_along_axis(top_ids, best, axis=1)
+
+
+def _check_ids(ids, n, ntotal):
+    # N int64 ids, ntotal...ntotal+N-1 when None
+    if ids is None:
+        return np.arange(ntotal, ntotal + n, dtype=np.int64)
+    ids = np.asarray(ids, dtype=np.int64)
+    if len(ids) != n:
+        raise ValueError('Number of ids {} does not match the number of descriptors {}!'.format(len(ids), n))
+    return ids
+
+
+class PQIndex(object):
+    """Approximate nearest neighbour index: product quantized descriptors, searched exhaustively
+
+    Every descriptor is stored as its m byte code of a ProductQuantizer, eg 2048-d descriptors
+    in 64 bytes with m=64 instead of 8 KB. The float descriptors are never needed for searching:
+    the query is not quantized, its score against a code is the sum of m lookups in its table of
+    sub-query . sub-centroid products computed once per query. Queries x codes are scored in tiles
+    within memory bytes, as in exact_search.
+
+    Descriptors are D x N, as everywhere in cirtorch, and every descriptor has an int64 id,
+    its column in the database by default. Saved as a descriptor store (cirtorch.utils.store),
+    the codes of a loaded index are memory mapped.
+
+    Args:
+        d (int): Dimension of the descriptors
+        m (int): Number of sub-quantizers, has to divide d
+        nbits (int, Default: 8): Bits per sub-quantizer code, at most 8
+        opq (bool, Default: False): Learn a rotation of the descriptors before quantizing them
+    """
+
+    def __init__(self, d, m, nbits=8, opq=False):
+        self.pq = ProductQuantizer(d, m, nbits=nbits, opq=opq)
+        self.d = d
+        self.m = m
+        self.nbits = nbits
+        self.opq = opq
+        self.codes = np.zeros((0, m), dtype=np.uint8)
+        self.ids = np.zeros(0, dtype=np.int64)
+
+    @property
+    def is_trained(self):
+        return self.pq.is_trained
+
+    @property
+    def code_size(self):
+        return self.m
+
+    @property
+    def min_train(self):
+        """Minimum number of training descriptors"""
+        return 2**self.nbits
+
+    @property
+    def ntotal(self):
+        return len(self.ids)
+
+    @property
+    def nbytes(self):
+        """Memory of the index in bytes: codes, ids, codebooks and rotation"""
+        return self.codes.nbytes + self.ids.nbytes + self.pq.nbytes
+
+    def __len__(self):
+        return self.ntotal
+
+    def train(self, vecs, niter=20, seed=0):
+        """Learns the quantizer from D x N descriptors"""
+        self.pq.train(_rows(vecs), niter=niter, seed=seed)
+        return self
+
+    def add(self, vecs, ids=None):
+        """
+        Adds D x N descriptors to the index
+
+        Arguments
+        ---------
+        vecs : D x N descriptors
+        ids  : N int64 ids, ntotal...ntotal+N-1 when None
+        """
+        if not self.is_trained:
+            raise RuntimeError('Index has to be trained before adding descriptors!')
+        x = _rows(vecs)
+        ids = _check_ids(ids, len(x), self.ntotal)
+        self.codes = np.concatenate([self.codes, self.pq.encode(x)])
+        self.ids = np.concatenate([self.ids, ids])
+        return self
+
+    def remove(self, ids):
+        """Removes the descriptors of ids from the index, returns the number of removed descriptors"""
+        keep = ~np.isin(self.ids, np.asarray(ids, dtype=np.int64))
+        self.codes, self.ids = self.codes[keep], self.ids[keep]
+        return int((~keep).sum())
+
+    def search(self, qvecs, k, nprobe=None, memory=SCORE_MEMORY):
+        """
+        k highest scoring (inner product) descriptors of every query
+
+        Arguments
+        ---------
+        qvecs  : D x Nq query descriptors
+        k      : number of results per query
+        nprobe : unused, all codes are visited, for the interface of IVFPQIndex
+        memory : memory budget of the score tiles in bytes
+
+        Returns
+        -------
+        scores : Nq x k approximate scores, best first, as exact_search
+        ranks  : Nq x k ids of the results, -1 when the index holds fewer than k descriptors
+        """
+        if not self.is_trained:
+            raise RuntimeError('Index has to be trained before searching!')
+        q = _rows(qvecs)
+        nq, n = len(q), self.ntotal
+        lut = self.pq.lookup_tables(q)
+
+        top_scores = np.full((nq, k), -np.inf, dtype=np.float32)
+        top_ids = np.full((nq, k), -1, dtype=np.int64)
+
+        # a tile is gathered, summed and merged, three tiles in memory
+        tq, tn = _tile_shape(nq, max(n, 1), k, memory // 3)
+        for i in range(0, nq, tq):
+            for j in range(0, n, tn):
+                scores = adc_scores(lut[i:i+tq], self.codes[j:j+tn])
+                top_scores[i:i+tq], top_ids[i:i+tq] = _merge_topk(top_scores[i:i+tq], top_ids[i:i+tq],
+                                                                  scores, self.ids[j:j+tn])
+        return _sort_topk(top_scores, top_ids)
+
+    def save(self, root, meta=None):
+        """Writes the index into a descriptor store at root, meta is kept in its manifest"""
+        if not self.is_trained:
+            raise RuntimeError('Index has to be trained before saving!')
+        meta = dict(meta or {}, index='pq', d=self.d, m=self.m, nbits=self.nbits, opq=self.opq)
+        with StoreWriter(root, meta=meta) as writer:
+            writer.add('codebooks', self.pq.codebooks)
+            if self.opq:
+                writer.add('rotation', self.pq.rotation)
+            writer.add('codes', self.codes, dtype='uint8')
+            writer.add('ids', self.ids, dtype='int64')
+
+    @classmethod
+    def load(cls, root, mmap=True):
+        """
+        Reads an index written by save, the codes are memory mapped unless mmap is False.
+        Adding descriptors afterwards copies the codes into memory.
+        """
+        store = Store(root, mmap_mode='r' if mmap else None)
+        meta = store.meta
+        if meta.get('index') != 'pq':
+            raise RuntimeError('No PQ index found in {}!'.format(root))
+        index = cls(meta['d'], meta['m'], nbits=meta['nbits'], opq=meta['opq'])
+        index.pq.codebooks = np.asarray(store['codebooks'])
+        if index.opq:
+            index.pq.rotation = np.asarray(store['rotation'])
+        index.codes = store['codes']
+        index.ids = store['ids']
+        index.meta = meta
+        return index
+
+    def __repr__(self):
+        fmt_str = self.__class__.__name__ + '\n'
+        fmt_str += '    Dimension: {}\n'.format(self.d)
+        fmt_str += '    Sub-quantizers: {} x {} bits{}\n'.format(self.m, self.nbits, ', rotated' if self.opq else '')
+        fmt_str += '    Number of descriptors: {}\n'.format(self.ntotal)
+        return fmt_str
+
+# --------------------------------------
+# binary codes
+# --------------------------------------
+
+def binarize(vecs, m, P, nbits):
+    """
+    Binary codes of descriptors: signs of their first nbits whitened dimensions, packed into uint64 words
+
+    Arguments
+    ---------
+    vecs  : D x N descriptors, torch tensor or numpy array
+    m, P  : mean and projection of the whitening, see cirtorch.utils.whiten
+    nbits : number of bits, a multiple of 64, at most the number of rows of P
+
+    Returns
+    -------
+    codes : N x nbits/64 uint64 numpy codes
+    """
+    x = _rows(vecs).T
+    bits = whitenapply(x, m, P, dimensions=nbits) > 0
+    return np.ascontiguousarray(np.packbits(bits.T, axis=1)).view(np.uint64)
+
+
+def hamming(qcodes, codes):
+    """Nq x N hamming distances (uint16) between Nq x W and N x W uint64 codes"""
+    dist = np.zeros((len(qcodes), len(codes)), dtype=np.uint16)
+    x = np.empty((len(qcodes), len(codes)), dtype=np.uint64)
+    # word by word, the xor of a word of all pairs is reused
+    for j in range(codes.shape[1]):
+        np.bitwise_xor(qcodes[:, j, None], np.ascontiguousarray(codes[:, j])[None], out=x)
+        if hasattr(np, 'bitwise_count'):
+            dist += np.bitwise_count(x)
+        else:
+            # popcount of the bytes with older numpy
+            dist += POPCOUNT[x.view(np.uint8).reshape(x.shape + (8,))].sum(2, dtype=np.uint16)
+    return dist
+
+
+class BinaryIndex(object):
+    """Approximate nearest neighbour index: hamming search of binary codes, re-ranked by inner product
+
+    Descriptors are PCA whitened (pcawhitenlearn of cirtorch.utils.whiten on a sample of the
+    database) and binarized by the signs of their first nbits dimensions, 32 times smaller than
+    float32 descriptors of nbits dimensions. Queries are binarized the same way, the codes are
+    scanned with xor and popcount for a shortlist of the nearest in hamming distance, which is
+    re-ranked by the inner products of the float descriptors. The float descriptors are only
+    read for the shortlist: saved as a descriptor store (cirtorch.utils.store), they are memory
+    mapped with the codes, and only the pages of the shortlisted descriptors are loaded.
+
+    Descriptors are D x N, as everywhere in cirtorch, and every descriptor has an int64 id,
+    its column in the database by default.
+
+    Args:
+        d (int): Dimension of the descriptors
+        nbits (int): Number of bits per code, a multiple of 64, at most d
+    """
+
+    def __init__(self, d, nbits):
+        if nbits % 64 != 0 or not 0 < nbits <= d:
+            raise ValueError('Unsupported number of bits for dimension {}: {}!'.format(d, nbits))
+        self.d = d
+        self.nbits = nbits
+        self.mean = None # d x 1
+        self.projection = None # nbits x d
+        self.codes = np.zeros((0, nbits // 64), dtype=np.uint64)
+        self.ids = np.zeros(0, dtype=np.int64)
+        self.vecs = np.zeros((0, d), dtype=np.float32) # N x d rows, for re-ranking
+
+    @property
+    def is_trained(self):
+        return self.projection is not None
+
+    @property
+    def code_size(self):
+        return self.nbits // 8
+
+    @property
+    def min_train(self):
+        """Minimum number of training descriptors"""
+        return self.d + 1
+
+    @property
+    def ntotal(self):
+        return len(self.ids)
+
+    @property
+    def nbytes(self):
+        """Memory of the index in bytes: codes, ids and projection, without the descriptors for re-ranking"""
+        return self.codes.nbytes + self.ids.nbytes + self.mean.nbytes + self.projection.nbytes
+
+    def __len__(self):
+        return self.ntotal
+
+    def train(self, vecs, seed=0):
+        """Learns the whitening from D x N descriptors, at most PCA_TRAIN_POINTS random descriptors are used"""
+        x = _rows(vecs)
+        if len(x) > PCA_TRAIN_POINTS:
+            x = x[np.sort(np.random.RandomState(seed).choice(len(x), PCA_TRAIN_POINTS, replace=False))]
+        if len(x) <= self.d:
+            raise ValueError('Unsupported number of training descriptors for dimension {}: {}!'.format(self.d, len(x)))
+        m, P = pcawhitenlearn(x.T.astype(np.float64))
+        self.mean = m.astype(np.float32)
+        self.projection = np.real(P[:self.nbits]).astype(np.float32)
+        return self
+
+    def add(self, vecs, ids=None):
+        """
+        Adds D x N descriptors to the index
+
+        Arguments
+        ---------
+        vecs : D x N descriptors
+        ids  : N int64 ids, ntotal...ntotal+N-1 when None
+        """
+        if not self.is_trained:
+            raise RuntimeError('Index has to be trained before adding descriptors!')
+        x = _rows(vecs)
+        ids = _check_ids(ids, len(x), self.ntotal)
+        self.codes = np.concatenate([self.codes, binarize(x.T, self.mean, self.projection, self.nbits)])
+        self.ids = np.concatenate([self.ids, ids])
+        self.vecs = np.concatenate([self.vecs, x])
+        return self
+
+    def remove(self, ids):
+        """Removes the descriptors of ids from the index, returns the number of removed descriptors"""
+        keep = ~np.isin(self.ids, np.asarray(ids, dtype=np.int64))
+        self.codes, self.ids, self.vecs = self.codes[keep], self.ids[keep], self.vecs[keep]
+        return int((~keep).sum())
+
+    def search(self, qvecs, k, nprobe=None, shortlist=None, memory=SCORE_MEMORY):
+        """
+        k highest scoring (inner product) descriptors of every query
+
+        Arguments
+        ---------
+        qvecs     : D x Nq query descriptors
+        k         : number of results per query
+        nprobe    : unused, all codes are visited, for the interface of IVFPQIndex
+        shortlist : number of descriptors nearest in hamming distance re-ranked per query,
+                    SHORTLIST_PER_RESULT*k when None
+        memory    : memory budget of the hamming tiles and of the re-ranked descriptors in bytes
+
+        Returns
+        -------
+        scores : Nq x k exact scores of the re-ranked descriptors, best first
+        ranks  : Nq x k ids of the results, -1 when the index holds fewer than k descriptors
+        """
+        if not self.is_trained:
+            raise RuntimeError('Index has to be trained before searching!')
+        q = _rows(qvecs)
+        nq, n = len(q), self.ntotal
+        r = min(max(k, shortlist or SHORTLIST_PER_RESULT * k), n)
+        qcodes = binarize(q.T, self.mean, self.projection, self.nbits)
+
+        # shortlist: nearest codes, scored by negative hamming distances, tiles of uint64 xors
+        top_scores = np.full((nq, r), -np.inf, dtype=np.float32)
+        top_pos = np.full((nq, r), -1, dtype=np.int64)
+        tq, tn = _tile_shape(nq, max(n, 1), r, memory // 4)
+        for i in range(0, nq, tq):
+            for j in range(0, n, tn):
+                scores = -hamming(qcodes[i:i+tq], self.codes[j:j+tn]).astype(np.float32)
+                top_scores[i:i+tq], top_pos[i:i+tq] = _merge_topk(top_scores[i:i+tq], top_pos[i:i+tq],
+                                                                  scores, np.arange(j, min(j+tn, n)))
+
+        # re-rank the shortlist by the float descriptors, in blocks of queries within memory
+        scores = np.full((nq, k), -np.inf, dtype=np.float32)
+        ranks = np.full((nq, k), -1, dtype=np.int64)
+        tq = int(max(1, memory // (4 * max(r, 1) * self.d)))
+        for i in range(0, nq, tq):
+            pos = top_pos[i:i+tq]
+            s = np.einsum('nrd,nd->nr', self.vecs[pos.ravel()].reshape(len(pos), r, self.d), q[i:i+tq])
+            best = np.argpartition(-s, k - 1, axis=1)[:, :k] if r > k else np.arange(r)[None].repeat(len(pos), 0)
+            scores[i:i+tq, :best.shape[1]] = np.take_along_axis(s, best, axis=1)
+            ranks[i:i+tq, :best.shape[1]] = self.ids[np.take_along_axis(pos, best, axis=1)]
+        return _sort_topk(scores, ranks)
+
+    def save(self, root, meta=None):
+        """Writes the index and the descriptors for re-ranking into a descriptor store at root"""
+        if not self.is_trained:
+            raise RuntimeError('Index has to be trained before saving!')
+        meta = dict(meta or {}, index='binary', d=self.d, nbits=self.nbits)
+        with StoreWriter(root, meta=meta) as writer:
+            writer.add('mean', self.mean)
+            writer.add('projection', self.projection)
+            writer.add('codes', self.codes, dtype='uint64')
+            writer.add('ids', self.ids, dtype='int64')
+            writer.add('vecs', self.vecs, dtype='float32')
+
+    @classmethod
+    def load(cls, root, mmap=True):
+        """
+        Reads an index written by save, codes and descriptors are memory mapped unless mmap is False.
+        Adding descriptors afterwards copies them into memory.
+        """
+        store = Store(root, mmap_mode='r' if mmap else None)
+        meta = store.meta
+        if meta.get('index') != 'binary':
+            raise RuntimeError('No binary index found in {}!'.format(root))
+        index = cls(meta['d'], meta['nbits'])
+        index.mean = np.asarray(store['mean'])
+        index.projection = np.asarray(store['projection'])
+        index.codes = store['codes']
+        index.ids = store['ids']
+        index.vecs = store['vecs']
+        index.meta = meta
+        return index
+
+    def __repr__(self):
+        fmt_str = self.__class__.__name__ + '\n'
+        fmt_str += '    Dimension: {}\n'.format(self.d)
+        fmt_str += '    Bits: {}\n'.format(self.nbits)
+        fmt_str += '    Number of descriptors: {}\n'.format(self.ntotal)
+        return fmt_str
+
+# --------------------------------------
+# inverted file with product quantization
+# --------------------------------------
+
+class IVFPQIndex(object):
+    """Approximate nearest neighbour index: inverted file over a coarse quantizer, product quantized residuals
+
+    Every descriptor x is assigned to its nearest coarse centroid c, the residual x - c is split
+    into m sub-vectors, each encoded by the index of its nearest sub-centroid (one byte for
+    nbits=8). Descriptors are searched by inner product, as the brute force search of the test
+    scripts: only the nprobe lists nearest to the query are visited, and the score q.c + q.(x-c)
+    is computed asymmetrically, the query is not quantized and q.(x-c) is the sum of m lookups
+    in a table of sub-query . sub-centroid products computed once per query.
+
+    Descriptors are D x N, as everywhere in cirtorch, and every descriptor has an int64 id,
+    its column in the database by default. Saved as a descriptor store (cirtorch.utils.store),
+    the inverted lists are ragged arrays, so a loaded index is memory mapped.
+
+    Args:
+        d (int): Dimension of the descriptors
+        nlist (int): Number of inverted lists (coarse centroids)
+        m (int): Number of sub-quantizers, has to divide d
+        nbits (int, Default: 8): Bits per sub-quantizer code, at most 8
+    """
+
+    def __init__(self, d, nlist, m, nbits=8):
+        self.pq = ProductQuantizer(d, m, nbits=nbits)
+        self.d = d
+        self.nlist = nlist
+        self.m = m
+        self.nbits = nbits
+        self.centroids = None # nlist x d
+        self.codes = [np.zeros((0, m), dtype=np.uint8) for _ in range(nlist)]
+        self.ids = [np.zeros(0, dtype=np.int64) for _ in range(nlist)]
+
+    @property
+    def is_trained(self):
+        return self.centroids is not None
+
+    @property
+    def code_size(self):
+        return self.m
+
+    @property
+    def min_train(self):
+        """Minimum number of training descriptors"""
+        return max(self.nlist, 2**self.nbits)
+
+    @property
+    def ntotal(self):
+        return int(sum(len(ids) for ids in self.ids))
+
+    @property
+    def nbytes(self):
+        """Memory of the index in bytes: codes, ids, coarse centroids and codebooks"""
+        return int(sum(codes.nbytes for codes in self.codes) + sum(ids.nbytes for ids in self.ids)) \
+            + self.centroids.nbytes + self.pq.nbytes
+
+    def __len__(self):
+        return self.ntotal
+
+    def train(self, vecs, niter=20, seed=0):
+        """Learns the coarse centroids and the codebooks of the residuals from D x N descriptors"""
+        x = _rows(vecs)
+        self.centroids = kmeans(x, self.nlist, niter=niter, seed=seed)
+        self.pq.train(x - self.centroids[assign(x, self.centroids)], niter=niter, seed=seed+1)
+        return self
+
+    def encode(self, x, labels):
+        """m codes (uint8) of the residuals of N x D rows x to their coarse centroids labels"""
+        return self.pq.encode(x - self.centroids[labels])
+
+    def add(self, vecs, ids=None):
+        """
+        Adds D x N descriptors to the index
+
+        Arguments
+        ---------
+        vecs : D x N descriptors
+        ids  : N int64 ids, ntotal...ntotal+N-1 when None
+        """
+        if not self.is_trained:
+            raise RuntimeError('Index has to be trained before adding descriptors!')
+        x = _rows(vecs)
+        ids = _check_ids(ids, len(x), self.ntotal)
+
+        labels = assign(x, self.centroids)
+        codes = self.encode(x, labels)
+        for l in np.unique(labels):
+            members = labels == l
+            self.codes[l] = np.concatenate([self.codes[l], codes[members]])
+            self.ids[l] = np.concatenate([self.ids[l], ids[members]])
+        return self
+
+    def remove(self, ids):
+        """Removes the descriptors of ids from the index, returns the number of removed descriptors"""
+        ids = np.asarray(ids, dtype=np.int64)
+        removed = 0
+        for l in range(self.nlist):
+            keep = ~np.isin(self.ids[l], ids)
+            if not keep.all():
+                self.codes[l], self.ids[l] = self.codes[l][keep], self.ids[l][keep]
+                removed += int((~keep).sum())
+        return removed
+
+    def search(self, qvecs, k, nprobe=1):
+        """
+        k highest scoring (inner product) descriptors of every query
+
+        Arguments
+        ---------
+        qvecs  : D x Nq query descriptors
+        k      : number of results per query
+        nprobe : number of inverted lists visited per query
+
+        Returns
+        -------
+        scores : Nq x k approximate scores, best first, as exact_search
+        ranks  : Nq x k ids of the results, -1 when fewer than k descriptors were visited
+        """
+        if not self.is_trained:
+            raise RuntimeError('Index has to be trained before searching!')
+        q = _rows(qvecs)
+        nq, nprobe = len(q), min(nprobe, self.nlist)
+
+        # nearest lists of every query, and the lookup tables of sub-query . sub-centroid products
+        qc = q.dot(self.centroids.T) # Nq x nlist
+        dist = (self.centroids * self.centroids).sum(1) - 2 * qc
+        probe = np.argpartition(dist, nprobe - 1, axis=1)[:, :nprobe] if nprobe < self.nlist \
+            else np.tile(np.arange(self.nlist), (nq, 1))
+        lut = self.pq.lookup_tables(q) # Nq x m x 2**nbits
+
+        top_scores = np.full((nq, k), -np.inf, dtype=np.float32)
+        top_ids = np.full((nq, k), -1, dtype=np.int64)
+
+        # visit list by list, all queries probing a list are scored together
+        flat = probe.ravel()
+        order = np.argsort(flat, kind='stable')
+        bounds = np.searchsorted(flat[order], np.arange(self.nlist + 1))
+        for l in range(self.nlist):
+            codes, ids = self.codes[l], self.ids[l]
+            if bounds[l] == bounds[l+1] or len(ids) == 0:
+                continue
+            qs = order[bounds[l]:bounds[l+1]] // nprobe
+            scores = qc[qs, l][:, None] + adc_scores(lut[qs], codes)
+            top_scores[qs], top_ids[qs] = _merge_topk(top_scores[qs], top_ids[qs], scores, ids)
+
+        return _sort_topk(top_scores, top_ids)
+
+    def save(self, root, meta=None):
+        """Writes the index into a descriptor store at root, meta is kept in its manifest"""
+        if not self.is_trained:
+            raise RuntimeError('Index has to be trained before saving!')
+        meta = dict(meta or {}, index='ivfpq', d=self.d, nlist=self.nlist, m=self.m, nbits=self.nbits)
+        with StoreWriter(root, meta=meta) as writer:
+            writer.add('centroids', self.centroids)
+            writer.add('codebooks', self.pq.codebooks)
+            writer.add_ragged('codes', self.codes, dtype='uint8')
+            writer.add_ragged('ids', self.ids, dtype='int64')
+
+    @classmethod
+    def load(cls, root, mmap=True):
+        """
+        Reads an index written by save, the inverted lists are memory mapped unless mmap is False.
+        Lists descriptors are added to afterwards are copied into memory.
+        """
+        store = Store(root, mmap_mode='r' if mmap else None)
+        meta = store.meta
+        if meta.get('index') != 'ivfpq':
+            raise RuntimeError('No IVFPQ index found in {}!'.format(root))
+        index = cls(meta['d'], meta['nlist'], meta['m'], nbits=meta['nbits'])
+        index.centroids = np.asarray(store['centroids'])
+        index.pq.codebooks = np.asarray(store['codebooks'])
+        codes, ids = store['codes'], store['ids']
+        data = codes.data.reshape(-1, index.m)
+        index.codes = [data[codes.offsets[l]:codes.offsets[l+1]] for l in range(index.nlist)]
+        index.ids = [ids[l] for l in range(index.nlist)]
+        index.meta = meta
+        return index
+
+    def __repr__(self):
+        fmt_str = self.__class__.__name__ + '\n'
+        fmt_str += '    Dimension: {}\n'.format(self.d)
+        fmt_str += '    Inverted lists: {}\n'.format(self.nlist)
+        fmt_str += '    Sub-quantizers: {} x {} bits\n'.format(self.m, self.nbits)
+        fmt_str += '    Number of descriptors: {}\n'.format(self.ntotal)
+        return fmt_str
+
+# --------------------------------------
+# geo-constrained search
+# --------------------------------------
+
+class GeoIndex(object):
+    """Spatial index over the UTM coordinates of the database images, restricts the search to a location prior
+
+    A query comes with a prior of its location, an approximate easting/northing, and a radius.
+    The database images within the radius of the prior are found in a KD-tree over their
+    coordinates, and only their descriptors are scored against the query, so the cost of a query
+    grows with the density of the database around it instead of its size.
+
+    Args:
+        coordinates (array): N x 2 easting and northing of the database images, in meters
+    """
+
+    def __init__(self, coordinates):
+        self.coordinates = np.asarray(coordinates, dtype=np.float64).reshape(-1, 2)
+        self.tree = NearestNeighbors(algorithm='kd_tree').fit(self.coordinates)
+
+    @property
+    def ntotal(self):
+        return len(self.coordinates)
+
+    def __len__(self):
+        return self.ntotal
+
+    def candidates(self, priors, radius):
+        """
+        Database images within radius meters of every prior
+
+        Arguments
+        ---------
+        priors : Nq x 2 approximate easting and northing of the queries
+        radius : radius of the priors in meters
+
+        Returns
+        -------
+        candidates : list of Nq int64 arrays of database columns, sorted
+        """
+        priors = np.asarray(priors, dtype=np.float64).reshape(-1, 2)
+        _, candidates = self.tree.radius_neighbors(priors, radius, sort_results=False)
+        return [np.sort(c).astype(np.int64) for c in candidates]
+
+    def search(self, vecs, qvecs, k, priors, radius):
+        """
+        k highest scoring (inner product) database images within radius of the prior of every query
+
+        Arguments
+        ---------
+        vecs   : D x N database descriptors, torch tensor or numpy array
+        qvecs  : D x Nq query descriptors
+        k      : number of results per query
+        priors : Nq x 2 approximate easting and northing of the queries
+        radius : radius of the priors in meters
+
+        Returns
+        -------
+        scores : Nq x k scores, best first, as exact_search
+        ranks  : Nq x k database columns of the results, -1 when fewer than k images are within radius
+        (numpy arrays)
+        """
+        vecs = torch.as_tensor(vecs)
+        qvecs = torch.as_tensor(qvecs).to(device=vecs.device, dtype=vecs.dtype)
+        nq = qvecs.shape[1]
+        candidates = self.candidates(priors, radius)
+        if len(candidates) != nq:
+            raise ValueError('Number of priors {} does not match the number of queries {}!'.format(len(candidates), nq))
+
+        scores = np.full((nq, k), -np.inf, dtype=np.float32)
+        ranks = np.full((nq, k), -1, dtype=np.int64)
+        for i, c in enumerate(candidates):
+            if len(c) == 0:
+                continue
+            s = torch.mv(vecs[:, torch.from_numpy(c).to(vecs.device)].t(), qvecs[:, i])
+            s, best = s.topk(min(k, len(c)))
+            scores[i, :len(best)] = s.cpu().numpy()
+            ranks[i, :len(best)] = c[best.cpu().numpy()]
+        return scores, ranks
+
+# --------------------------------------
+# index specification
+# --------------------------------------
+
+INDEXES = {'pq': PQIndex, 'ivfpq': IVFPQIndex, 'binary': BinaryIndex}
+
+
+def index_factory(spec, d):
+    """
+    Untrained index from its specification
+
+    Arguments
+    ---------
+    spec : 'pqM', 'opq-pqM' or 'ivfNLIST-pqM', optionally followed by 'xNBITS', eg
+           'opq-pq64' for 64 sub-quantizers of 8 bits after a learned rotation, searched exhaustively,
+           'ivf1024-pq32' for 1024 inverted lists and 32 sub-quantizers of 8 bits,
+           or 'binNBITS', eg 'bin512' for binary codes of 512 bits re-ranked by the descriptors
+    d    : dimension of the descriptors
+    """
+    match = re.match(r'^bin(\d+)$', spec)
+    if match is not None:
+        return BinaryIndex(d, int(match.group(1)))
+    match = re.match(r'^(?:ivf(\d+)-|(opq)-)?pq(\d+)(?:x(\d+))?$', spec)
+    if match is None:
+        raise ValueError('Unsupported index: {}!'.format(spec))
+    nlist, opq, m, nbits = match.groups()
+    if nlist is not None:
+        return IVFPQIndex(d, int(nlist), int(m), nbits=int(nbits or 8))
+    return PQIndex(d, int(m), nbits=int(nbits or 8), opq=opq is not None)
+
+
+def load_index(root, mmap=True):
+    """Reads the index written to root by the save method of any index"""
+    name = Store(root).meta.get('index')
+    if name not in INDEXES:
+        raise RuntimeError('No index found in {}!'.format(root))
+    return INDEXES[name].load(root, mmap=mmap)
+
+
+def quantization_error(index, vecs):
+    """
+    Mean squared distance of D x N descriptors to their quantization by a trained index: their
+    coarse centroid for IVFPQIndex, their reconstruction from the codes for PQIndex, None for
+    BinaryIndex
+    """
+    x = _rows(vecs)
+    if isinstance(index, IVFPQIndex):
+        return float(((x - index.centroids[assign(x, index.centroids)]) ** 2).sum(1).mean())
+    if isinstance(index, PQIndex):
+        return float(((x - index.pq.decode(index.pq.encode(x))) ** 2).sum(1).mean())
+    return None
+
+
+def descriptors_key(net, images, **params):
+    """
+    Identifies descriptors by what they are extracted from, without extracting them
+
+    Arguments
+    ---------
+    net    : network the descriptors are extracted with
+    images : list of image paths
+    params : extraction settings, all that change the descriptors, see extraction_settings
+
+    Returns
+    -------
+    key : sha256 hex digest of the network weights, images and parameters
+    """
+    sha256 = hashlib.sha256()
+    sha256.update(network_hash(net).encode())
+    sha256.update(repr(sorted(params.items())).encode())
+    for image in images:
+        sha256.update(image.encode())
+        sha256.update(b'\0')
+    return sha256.hexdigest()
+
+
+def load_or_build_index(root, spec, vecs, key=None):
+    """
+    Opens the index at root if it was built with spec from the same descriptors, otherwise
+    trains a new index on the descriptors, adds them and writes it to root
+
+    Arguments
+    ---------
+    root : directory of the index, None to always build it in memory
+    spec : index specification, see index_factory
+    vecs : D x N database descriptors, their ids are their columns, or a function returning
+           them, called only if the index is built
+    key  : string identifying the descriptors, eg descriptors_key(net, images), so that a
+           stored index is opened without the descriptors; vectors_hash(vecs) when None
+
+    Returns
+    -------
+    index : PQIndex, IVFPQIndex or BinaryIndex
+    """
+    if key is None:
+        vecs = vecs() if callable(vecs) else vecs
+        key = vectors_hash(vecs)
+    if root is not None and is_store(root):
+        meta = Store(root).meta
+        if meta.get('spec') == spec and meta.get('key') == key:
+            print('>> Using index {} from {}'.format(spec, root))
+            return load_index(root)
+
+    vecs = vecs() if callable(vecs) else vecs
+    print('>> Building index {} of {} descriptors...'.format(spec, vecs.shape[1]))
+    index = index_factory(spec, vecs.shape[0]).train(vecs)
+    index.add(vecs)
+    if root is not None:
+        index.save(root, meta={'spec': spec, 'key': key})
+    return index
+
+
+def print_index_memory(name, index):
+    """Prints the memory of an index next to the memory of the float32 descriptors it encodes"""
+    # the code and an int64 id per descriptor, the rest is shared by all descriptors
+    per_descriptor = index.code_size + 8
+    print('>> {}: {} descriptors in {:.1f} MB, {} bytes per descriptor and {:.1f} MB of quantizers'
+          ' (float32 descriptors: {:.1f} MB, {} bytes per descriptor)'.format(
+        name, index.ntotal, index.nbytes / 1024**2, per_descriptor,
+        (index.nbytes - per_descriptor * index.ntotal) / 1024**2, index.ntotal * index.d * 4 / 1024**2, index.d * 4))
@@ -1,3 +1,5 @@
+import os
+
 import torch
 from torchvision import transforms
 from torch.autograd import Variable
@@ -19,6 +21,9 @@ from cirtorch.datasets.genericdataset import ImagesFromList
 from cirtorch.networks.imageretrievalnet import init_network, extract_vectors
 from cirtorch.datasets.traindataset import TuplesDataset
 from cirtorch.datasets.datahelpers import collate_tuples, cid2filename
+from cirtorch.utils.cache import DescriptorCache
+from cirtorch.utils.store import load_or_extract_vectors, extraction_settings
+from cirtorch.utils.index import exact_search
 
 torch.manual_seed(1)
 
@@ -36,6 +41,9 @@ place_model_path = 'data/exp_outputs1/mapillary_resnet50_gem_contrastive_m0.70_a
 correlation_model_path = 'data/localcorrelationnet/model_2048_128_0.01_Epoch_199.pth'
 multiscale = '[1]'
 imsize = 320
+cache_dir = 'data/cache'
+cache_size = 10 * 1024**3
+descriptors_dir = 'data/descriptors'
 
 posDistThr = 25
 negDistThr = 25
@@ -155,43 +163,31 @@ test_dataset = TuplesDataset(
 )
 qidxs, pidxs = test_dataset.get_loaders()
 
-opt = {'batch_size': 1, 'shuffle': False, 'num_workers': 8, 'pin_memory': True}
+# descriptor cache, only descriptors of new or changed images are extracted
+cache = DescriptorCache(cache_dir, max_size=cache_size)
 
 start = time.time()
 
-# Step 1: Extract Database Images - dbLoader
+# Step 1: Extract Database Images, the place descriptors are cached
 print('>> {}: Extracting Database Images...')
-dbLoader = torch.utils.data.DataLoader(
-    ImagesFromList(root='', images=[test_dataset.dbImages[i] for i in range(
-        len(test_dataset.dbImages))], imsize=imsize, transform=transform),
-    **opt)
-
-poolvecs = torch.zeros(OUTPUT_DIM, len(test_dataset.dbImages)).cuda()
-
-for i, input in enumerate(dbLoader):
-    poolvecs[:, i] = correlationnet(placenet(input.cuda()).data.squeeze())
-
-# Step 2: Extract Query Images - qLoader
+settings = extraction_settings(imsize, transform)
+poolvecs = load_or_extract_vectors(
+    os.path.join(descriptors_dir, 'db'), placenet, test_dataset.dbImages,
+    lambda: extract_vectors(placenet, test_dataset.dbImages, imsize, transform, cache=cache), settings=settings)
+with torch.no_grad():
+    poolvecs = correlationnet(poolvecs.t().cuda()).t()
+
+# Step 2: Extract Query Images
 print('>> {}: Extracting Query Images...')
-qLoader = torch.utils.data.DataLoader(
-    ImagesFromList(root='', images=[
-        test_dataset.qImages[i] for i in qidxs], imsize=imsize, transform=transform),
-    **opt)
-
-qvecs = torch.zeros(OUTPUT_DIM, len(qidxs)).cuda()
-
-for i, input in enumerate(qLoader):
-    qvecs[:, i] = correlationnet(placenet(input.cuda()).data.squeeze())
-
-# Step 3: Ranks
-#scores = torch.mm(poolvecs.t(), qvecs)
-D, N = qvecs.size()
-D, PoolN = poolvecs.size()
-scores = torch.zeros((N, PoolN))
-for im in range(N):
-    a = torch.norm(poolvecs.t() - qvecs[:, im], dim=1)
-    scores[im, :] = torch.norm(poolvecs.t() - qvecs[:, im], dim=1)
-scores = scores.cpu()#.numpy()
+qimages = [test_dataset.qImages[i] for i in qidxs]
+qvecs = load_or_extract_vectors(
+    os.path.join(descriptors_dir, 'query'), placenet, qimages,
+    lambda: extract_vectors(placenet, qimages, imsize, transform, cache=cache), settings=settings)
+with torch.no_grad():
+    qvecs = correlationnet(qvecs.t().cuda()).t()
+
+# Step 3: Embedding distances, computed below for the geographically nearest database images only
+poolvecs, qvecs = poolvecs.cpu(), qvecs.cpu()
 
 # GPS: get query and pool coordinates
 querycoordinates = torch.tensor(
@@ -199,10 +195,8 @@ querycoordinates = torch.tensor(
 poolcoordinates = torch.tensor([test_dataset.gpsInfo[test_dataset.dbImages[i][-26:-4]]
                                 for i in range(len(test_dataset.dbImages))], dtype=torch.float)
 
-# GPS: Compute distances
-distances = torch.norm(querycoordinates[:, None] - poolcoordinates, dim=2)
-# GPS: Sort distances
-distances, indicies = torch.sort(distances, dim=1, descending=False)
+# GPS: 10 nearest database images of every query
+distances, indicies = exact_search(poolcoordinates.t(), querycoordinates.t(), 10, metric='l2')
 
 print('>>> {}: Generating Correlation Data')
 gpsinfo = test_dataset.gpsInfo
@@ -217,9 +211,9 @@ for q in range(len(qidxs)):
     emb = []
     pictures = [test_dataset.qImages[qidxs[q]].split('/')[-1][:-4]]
     angles = []
-    while distances[q, positive] < 50 and positive < 10:
+    while positive < distances.shape[1] and distances[q, positive] < 50:
         index = indicies[q, positive]
-        emb.append(scores[q, index].item())
+        emb.append(torch.norm(poolvecs[:, index] - qvecs[:, q]).item())
         gps.append(distances[q, positive])
         pictures.append(test_dataset.dbImages[index])
 
@@ -0,0 +1,216 @@
+import numpy as np
+import torch
+import scipy.sparse as sparse
+
+from cirtorch.utils.index import exact_search, vectors_hash, SCORE_MEMORY
+from cirtorch.utils.store import StoreWriter, Store, is_store
+
+# --------------------------------------
+# helpers
+# --------------------------------------
+
+def _numpy(vecs):
+    # torch tensor or numpy array as float32 numpy array
+    if torch.is_tensor(vecs):
+        vecs = vecs.detach().cpu().numpy()
+    return np.asarray(vecs, dtype=np.float32)
+
+# --------------------------------------
+# query expansion
+# --------------------------------------
+
+def query_expansion(vecs, qvecs, ranks, n, alpha=0):
+    """
+    Alpha query expansion: every query is replaced by the weighted sum of itself and its n top
+    ranked database descriptors, weighted by their score to the query to the power alpha.
+    With alpha=0 all weights are 1, the average query expansion.
+
+    Arguments
+    ---------
+    vecs  : D x N database descriptors
+    qvecs : D x Nq query descriptors
+    ranks : Nq x K database columns ranked for every query, eg by exact_search, -1 for no result
+    n     : number of expanded database descriptors, at most K
+    alpha : weight exponent
+
+    Returns
+    -------
+    qvecs : D x Nq expanded, L2 normalized query descriptors (numpy)
+    """
+    vecs, qvecs = _numpy(vecs), _numpy(qvecs)
+    top = np.asarray(ranks)[:, :n]
+    neighbours = vecs[:, np.maximum(top, 0)] # D x Nq x n
+    weights = np.maximum(np.einsum('dqn,dq->qn', neighbours, qvecs), 0) ** alpha
+    weights[top < 0] = 0
+    expanded = qvecs + np.einsum('dqn,qn->dq', neighbours, weights)
+    return expanded / (np.linalg.norm(expanded, axis=0, keepdims=True) + 1e-6)
+
+# --------------------------------------
+# nearest neighbour graph
+# --------------------------------------
+
+def knn_graph(vecs, k, root=None):
+    """
+    Sparse graph of the mutual k nearest neighbours of the database descriptors
+
+    The neighbours are found by exact_search of the database against itself, in tiles, the
+    N x N similarity matrix is never formed. They are cached in a descriptor store at root,
+    read back if they were computed for the same descriptors and k.
+
+    Arguments
+    ---------
+    vecs : D x N database descriptors
+    k    : number of neighbours of every descriptor
+    root : directory of the cached neighbours, None to always compute them
+
+    Returns
+    -------
+    graph : N x N scipy.sparse csr matrix, the inner product of i and j (clipped at 0) if they are
+            among each other's k nearest neighbours, 0 otherwise and on the diagonal
+    """
+    n = vecs.shape[1]
+    vhash = vectors_hash(vecs)
+    meta = Store(root).meta if root is not None and is_store(root) else {}
+    if meta.get('vectors_hash') == vhash and meta.get('k') == k:
+        print('>> Using nearest neighbour graph from {}'.format(root))
+        store = Store(root, mmap_mode=None)
+        scores, ranks = store['scores'], store['ranks']
+    else:
+        print('>> Computing {} nearest neighbours of {} descriptors...'.format(k, n))
+        # the descriptor itself is its nearest neighbour
+        scores, ranks = exact_search(_numpy(vecs), _numpy(vecs), k + 1)
+        if root is not None:
+            with StoreWriter(root, meta={'graph': 'knn', 'k': k, 'vectors_hash': vhash}) as writer:
+                writer.add('scores', scores, dtype='float32')
+                writer.add('ranks', ranks, dtype='int64')
+
+    rows = np.repeat(np.arange(n), ranks.shape[1])
+    graph = sparse.csr_matrix((np.maximum(scores.ravel(), 0), (rows, ranks.ravel())), shape=(n, n))
+    graph.setdiag(0)
+    graph = graph.minimum(graph.T).tocsr()
+    graph.eliminate_zeros()
+    return graph
+
+# --------------------------------------
+# diffusion
+# --------------------------------------
+
+def conjugate_gradient(A, B, tol=1e-6, maxiter=20):
+    """
+    Solves A X = B for symmetric positive definite A, all columns of B at once
+
+    Arguments
+    ---------
+    A       : N x N scipy.sparse matrix
+    B       : N x M numpy right hand sides
+    tol     : relative residual norm a column is solved at
+    maxiter : maximum number of iterations
+
+    Returns
+    -------
+    X : N x M numpy solutions
+    """
+    X = np.zeros_like(B)
+    R = B.copy()
+    P = R.copy()
+    rs = (R * R).sum(0)
+    bound = (tol ** 2) * rs
+    for _ in range(maxiter):
+        if np.all(rs <= bound):
+            break
+        AP = A.dot(P)
+        pap = (P * AP).sum(0)
+        # solved columns, and columns of zeros, are left as they are
+        a = np.where(pap > 0, rs / np.where(pap > 0, pap, 1), 0)
+        X += a * P
+        R -= a * AP
+        rs_new = (R * R).sum(0)
+        P = R + np.where(rs > 0, rs_new / np.where(rs > 0, rs, 1), 0) * P
+        rs = rs_new
+    return X
+
+
+class Diffusion(object):
+    """Re-ranking by diffusion on the nearest neighbour graph of the database
+
+    The scores of a query spread over the mutual k nearest neighbour graph of the database: with
+    S the symmetrically normalized graph of the inner products to the power gamma, the ranking
+    scores f solve (I - alpha S) f = y, where y holds the scores of the kq database descriptors
+    nearest to the query. The system is sparse, solved by conjugate gradient for a block of
+    queries at once, the N x N matrices are never dense.
+
+    Args:
+        vecs (array): D x N database descriptors
+        k (int, Default: 50): Number of neighbours of the graph
+        gamma (float, Default: 3): Exponent of the inner products
+        alpha (float, Default: 0.99): Weight of the propagation, smaller than 1
+        root (string, Default: None): Directory of the cached neighbours, see knn_graph
+    """
+
+    def __init__(self, vecs, k=50, gamma=3, alpha=0.99, root=None):
+        if not 0 < alpha < 1:
+            raise ValueError('Unsupported diffusion alpha: {}!'.format(alpha))
+        self.vecs = vecs
+        self.k = k
+        self.gamma = gamma
+        self.alpha = alpha
+
+        graph = knn_graph(vecs, k, root=root).power(gamma)
+        degree = np.asarray(graph.sum(1)).ravel()
+        dinv = sparse.diags(np.where(degree > 0, 1 / np.sqrt(np.where(degree > 0, degree, 1)), 0))
+        self.operator = (sparse.identity(graph.shape[0], format='csr') - alpha * dinv.dot(graph).dot(dinv)).tocsr()
+
+    def search(self, qvecs, topk, kq=10, tol=1e-6, maxiter=20, memory=SCORE_MEMORY, candidates=None):
+        """
+        topk database descriptors of every query, ranked by diffusion
+
+        Arguments
+        ---------
+        qvecs      : D x Nq query descriptors
+        topk       : number of results per query
+        kq         : number of database descriptors the diffusion of a query starts from
+        tol        : relative residual norm of the conjugate gradient
+        maxiter    : maximum number of conjugate gradient iterations
+        memory     : memory budget of a block of queries in bytes, four N x block arrays
+        candidates : list of Nq arrays of the database columns every query is restricted to,
+                     eg GeoIndex.candidates, all columns when None
+
+        Returns
+        -------
+        scores : Nq x topk diffusion scores, best first
+        ranks  : Nq x topk database columns of the results, -1 when fewer than topk candidates
+        """
+        n, nq = self.vecs.shape[1], qvecs.shape[1]
+        topk = min(topk, n)
+        s, r = exact_search(_numpy(self.vecs), _numpy(qvecs), kq)
+
+        scores = np.zeros((nq, topk), dtype=np.float32)
+        ranks = np.zeros((nq, topk), dtype=np.int64)
+        block = int(max(1, memory // (4 * 4 * n)))
+        for i in range(0, nq, block):
+            b = min(block, nq - i)
+            y = np.zeros((n, b), dtype=np.float32)
+            y[r[i:i+b].T, np.arange(b)] = np.maximum(s[i:i+b].T, 0) ** self.gamma
+            f = conjugate_gradient(self.operator, y, tol=tol, maxiter=maxiter).T # b x N
+            if candidates is not None:
+                # the diffusion spreads over the whole graph, only candidates are ranked
+                allowed = np.zeros((b, n), dtype=bool)
+                for j, c in enumerate(candidates[i:i+b]):
+                    allowed[j, c] = True
+                f = np.where(allowed, f, -np.inf)
+            best = np.argpartition(-f, topk - 1, axis=1)[:, :topk] if topk < n else np.tile(np.arange(n), (b, 1))
+            fbest = np.take_along_axis(f, best, axis=1)
+            order = np.argsort(-fbest, axis=1, kind='stable')
+            scores[i:i+b] = np.take_along_axis(fbest, order, axis=1)
+            ranks[i:i+b] = np.take_along_axis(best, order, axis=1)
+        ranks[np.isneginf(scores)] = -1
+        return scores, ranks
+
+    def __repr__(self):
+        fmt_str = self.__class__.__name__ + '\n'
+        fmt_str += '    Number of descriptors: {}\n'.format(self.vecs.shape[1])
+        fmt_str += '    Neighbours: {}\n'.format(self.k)
+        fmt_str += '    Gamma: {}\n'.format(self.gamma)
+        fmt_str += '    Alpha: {}\n'.format(self.alpha)
+        fmt_str += '    Graph edges: {}\n'.format((self.operator.nnz - self.operator.shape[0]) // 2)
+        return fmt_str
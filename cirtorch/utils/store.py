@@ -0,0 +1,472 @@
+import os
+import json
+import struct
+
+import numpy as np
+import torch
+
+from cirtorch.utils.cache import network_hash
+
+MANIFEST = 'manifest.json'
+VERSION = 1
+
+# fixed size of the .npy header, large enough for any 2D shape, so it can be rewritten in place
+NPY_HEADER_SIZE = 128
+
+# number of rows written at once when storing a whole array
+CHUNK_SIZE = 4096
+
+
+# --------------------------------------
+# streaming .npy files
+# --------------------------------------
+
+def _npy_header(dtype, shape):
+    header = "{{'descr': '{}', 'fortran_order': False, 'shape': {}, }}".format(
+        np.lib.format.dtype_to_descr(np.dtype(dtype)), repr(tuple(shape)))
+    length = NPY_HEADER_SIZE - 10
+    if len(header) + 1 > length:
+        raise ValueError('Shape {} does not fit into the .npy header!'.format(shape))
+    header = header.ljust(length - 1) + '\n'
+    return b'\x93NUMPY\x01\x00' + struct.pack('<H', length) + header.encode('latin1')
+
+
+class NpyWriter(object):
+    """Writes a .npy file row block by row block, without knowing the number of rows in advance
+
+    The file is a regular .npy file that can be read with np.load, including mmap_mode.
+
+    Args:
+        filename (string): Path of the .npy file
+        shape (tuple): Shape of one row, eg (D,) for N x D descriptors
+        dtype (string or np.dtype): Data type stored in the file, rows are converted to it
+        rows (int, Default: None): Number of rows of an existing file written by NpyWriter,
+            rows are appended to it, None creates a new file
+    """
+
+    def __init__(self, filename, shape=(), dtype='float32', rows=None):
+        self.filename = filename
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        if rows is None:
+            self.rows = 0
+            self.f = open(filename, 'wb')
+            self.f.write(_npy_header(self.dtype, (0,) + self.shape))
+        else:
+            self.rows = rows
+            self.f = open(filename, 'r+b')
+            self.f.seek(NPY_HEADER_SIZE + rows * int(np.prod(self.shape)) * self.dtype.itemsize)
+            self.f.truncate()
+
+    def append(self, rows):
+        """Appends a block of rows, array of shape #rows x shape"""
+        rows = np.ascontiguousarray(rows, dtype=self.dtype)
+        if rows.shape[1:] != self.shape:
+            raise ValueError('Rows of shape {} do not match {}!'.format(rows.shape[1:], self.shape))
+        self.f.write(rows.tobytes())
+        self.rows += rows.shape[0]
+
+    def close(self):
+        if self.f is None:
+            return
+        # rewrite the header with the final number of rows
+        self.f.seek(0)
+        self.f.write(_npy_header(self.dtype, (self.rows,) + self.shape))
+        self.f.close()
+        self.f = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+# --------------------------------------
+# ragged arrays
+# --------------------------------------
+
+class RaggedArray(object):
+    """List of arrays of different lengths stored in one flat array (CSR layout)
+
+    Item i is data[offsets[i]:offsets[i+1]], a view into data, so nothing is copied
+    when data and offsets are memory mapped.
+
+    Args:
+        data (np.ndarray): Concatenated items, of shape #total x ...
+        offsets (np.ndarray): Start of every item in data, plus the total length, #items+1
+    """
+
+    def __init__(self, data, offsets):
+        self.data = data
+        self.offsets = offsets
+
+    @classmethod
+    def from_list(cls, items, dtype=None):
+        items = [np.asarray(item, dtype=dtype) for item in items]
+        offsets = np.zeros(len(items) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(item) for item in items])
+        if len(items) and offsets[-1] > 0:
+            data = np.concatenate([item for item in items if len(item)])
+        else:
+            data = np.zeros(0, dtype=dtype)
+        return cls(data, offsets)
+
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    def __getitem__(self, index):
+        return self.data[self.offsets[index]:self.offsets[index+1]]
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+class RaggedWriter(object):
+    """Writes a ragged array item by item, the data is streamed to disk, the offsets kept in memory
+
+    Created by StoreWriter.stream_ragged, the offsets are written when the store is closed.
+
+    Args:
+        writer (NpyWriter): Writer of the concatenated items
+    """
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.offsets = [0]
+
+    def append(self, item):
+        """Appends one item, array of shape #rows x shape"""
+        self.writer.append(item)
+        self.offsets.append(self.offsets[-1] + len(item))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+
+# --------------------------------------
+# descriptor store
+# --------------------------------------
+
+def json_meta(meta):
+    # keep the json serializable part of the network meta (eg drop the learned whitening)
+    out = {}
+    for key, value in (meta or {}).items():
+        try:
+            json.dumps(value)
+            out[key] = value
+        except TypeError:
+            pass
+    return out
+
+
+def _write_manifest(root, manifest):
+    tmp = os.path.join(root, MANIFEST + '.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp, os.path.join(root, MANIFEST))
+
+
+class StoreWriter(object):
+    """Writes a descriptor store: a directory of .npy files described by a JSON manifest
+
+    Args:
+        root (string): Directory of the store, created if it does not exist
+        meta (dict, Default: None): Network meta, its json serializable entries are kept in the manifest
+    """
+
+    def __init__(self, root, meta=None):
+        os.makedirs(root, exist_ok=True)
+        if is_store(root):
+            # the store is rewritten, it is incomplete until the new manifest exists
+            os.remove(os.path.join(root, MANIFEST))
+        self.root = root
+        self.manifest = {'version': VERSION, 'meta': json_meta(meta), 'arrays': {}, 'ragged': {}}
+        self.writers = {}
+        self.ragged_writers = {}
+
+    def stream(self, name, shape=(), dtype='float32'):
+        """Returns an NpyWriter for array name, rows are appended as they are produced"""
+        writer = NpyWriter(os.path.join(self.root, name + '.npy'), shape=shape, dtype=dtype)
+        self.writers[name] = writer
+        return writer
+
+    def add(self, name, array, dtype=None):
+        """Writes a whole array, in chunks of rows"""
+        array = np.asarray(array)
+        if array.ndim == 0:
+            array = array.reshape(1)
+        writer = self.stream(name, shape=array.shape[1:], dtype=dtype or array.dtype)
+        for i in range(0, len(array), CHUNK_SIZE):
+            writer.append(array[i:i+CHUNK_SIZE])
+
+    def add_strings(self, name, strings):
+        """Writes a list of strings, eg image paths, as a fixed width unicode array"""
+        self.add(name, np.array(list(strings), dtype=np.str_))
+
+    def add_ragged(self, name, items, dtype='int64'):
+        """Writes a list of arrays of different lengths, eg the positives of every query, in CSR layout"""
+        ragged = RaggedArray.from_list(items, dtype=dtype)
+        self.add(name + '.data', ragged.data)
+        self.add(name + '.offsets', ragged.offsets)
+        self.manifest['ragged'][name] = {'data': name + '.data', 'offsets': name + '.offsets'}
+
+    def stream_ragged(self, name, shape=(), dtype='float32'):
+        """Returns a RaggedWriter for ragged array name, items are appended as they are produced"""
+        writer = RaggedWriter(self.stream(name + '.data', shape=shape, dtype=dtype))
+        self.ragged_writers[name] = writer
+        return writer
+
+    def close(self):
+        for name, writer in self.ragged_writers.items():
+            self.add(name + '.offsets', np.asarray(writer.offsets, dtype=np.int64))
+            self.manifest['ragged'][name] = {'data': name + '.data', 'offsets': name + '.offsets'}
+        self.ragged_writers = {}
+        for name, writer in self.writers.items():
+            writer.close()
+            self.manifest['arrays'][name] = {
+                'file': os.path.basename(writer.filename),
+                'dtype': writer.dtype.str,
+                'shape': [writer.rows] + list(writer.shape),
+            }
+        # the manifest is written last, a store without manifest is incomplete
+        _write_manifest(self.root, self.manifest)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class Store(object):
+    """Reads a descriptor store written by StoreWriter
+
+    Arrays are memory mapped read-only, ragged arrays are returned as RaggedArray.
+    Descriptors are stored one row per image, N x D, so store['vecs'].T is the usual D x N.
+
+    Args:
+        root (string): Directory of the store
+        mmap_mode (string, Default: 'r'): Passed to np.load, None loads the arrays into memory
+    """
+
+    def __init__(self, root, mmap_mode='r'):
+        if not is_store(root):
+            raise RuntimeError('No descriptor store found in {}!'.format(root))
+        with open(os.path.join(root, MANIFEST)) as f:
+            self.manifest = json.load(f)
+        if self.manifest['version'] > VERSION:
+            raise RuntimeError('Unsupported descriptor store version: {}!'.format(self.manifest['version']))
+        self.root = root
+        self.mmap_mode = mmap_mode
+
+    @property
+    def meta(self):
+        return self.manifest['meta']
+
+    def keys(self):
+        ragged = [a for r in self.manifest['ragged'].values() for a in r.values()]
+        return [k for k in self.manifest['arrays'] if k not in ragged] + list(self.manifest['ragged'])
+
+    def array(self, name):
+        info = self.manifest['arrays'][name]
+        # empty files cannot be memory mapped
+        mmap_mode = self.mmap_mode if np.prod(info['shape']) > 0 else None
+        array = np.load(os.path.join(self.root, info['file']), mmap_mode=mmap_mode)
+        # rows of an interrupted append_store are not in the manifest
+        return array[:info['shape'][0]] if len(array) > info['shape'][0] else array
+
+    def __getitem__(self, name):
+        if name in self.manifest['ragged']:
+            info = self.manifest['ragged'][name]
+            return RaggedArray(self.array(info['data']), self.array(info['offsets']))
+        if name not in self.manifest['arrays']:
+            raise KeyError(name)
+        return self.array(name)
+
+    def __contains__(self, name):
+        return name in self.manifest['arrays'] or name in self.manifest['ragged']
+
+    def __repr__(self):
+        fmt_str = self.__class__.__name__ + '\n'
+        fmt_str += '    Root Location: {}\n'.format(self.root)
+        for name in self.keys():
+            if name in self.manifest['ragged']:
+                info = self.manifest['arrays'][self.manifest['ragged'][name]['offsets']]
+                fmt_str += '    {}: ragged, {} items\n'.format(name, info['shape'][0] - 1)
+            else:
+                info = self.manifest['arrays'][name]
+                fmt_str += '    {}: {} {}\n'.format(name, info['dtype'], tuple(info['shape']))
+        return fmt_str
+
+
+def is_store(root):
+    return os.path.isfile(os.path.join(root, MANIFEST))
+
+
+def _header_size(filename):
+    # size of the header of a .npy file of format version 1
+    with open(filename, 'rb') as f:
+        prefix = f.read(10)
+    return 10 + struct.unpack('<H', prefix[8:10])[0]
+
+
+def append_store(root, arrays, meta=None):
+    """
+    Appends rows to arrays of an existing store, eg the descriptors of new images
+
+    The rows are written in place at the end of the .npy files, an array is only rewritten
+    if its rows do not fit its data type, eg longer image paths, or its file was not written
+    by NpyWriter. The manifest is written last, with the new shapes, so the store keeps its
+    previous content if appending is interrupted.
+
+    Arguments
+    ---------
+    root   : directory of the store
+    arrays : dict of array name: rows to append, of shape #rows x shape of the stored rows
+    meta   : dict of entries added to or replaced in the meta of the manifest
+    """
+    manifest = Store(root).manifest
+    for name, rows in arrays.items():
+        if name not in manifest['arrays']:
+            raise RuntimeError('No array {} in descriptor store {}!'.format(name, root))
+        info = manifest['arrays'][name]
+        filename = os.path.join(root, info['file'])
+        dtype, shape = np.dtype(info['dtype']), tuple(info['shape'])
+        rows = np.asarray(rows)
+        if rows.shape[1:] != shape[1:]:
+            raise ValueError('Rows of shape {} do not match {}!'.format(rows.shape[1:], shape[1:]))
+
+        if rows.dtype.kind in 'US':
+            fits = np.can_cast(rows.dtype, dtype, casting='safe')
+        elif np.can_cast(rows.dtype, dtype, casting='same_kind'):
+            fits = True
+        else:
+            raise ValueError('Rows of type {} do not match {}!'.format(rows.dtype, dtype))
+
+        if fits and _header_size(filename) == NPY_HEADER_SIZE:
+            writer = NpyWriter(filename, shape=shape[1:], dtype=dtype, rows=shape[0])
+            writer.append(rows)
+        else:
+            # rewritten with a wider type, next to the old file until it is complete
+            # rows of an interrupted append past the manifest shape are dropped
+            old = np.load(filename, mmap_mode='r')[:shape[0]]
+            writer = NpyWriter(filename + '.tmp', shape=shape[1:], dtype=np.promote_types(dtype, rows.dtype))
+            for i in range(0, len(old), CHUNK_SIZE):
+                writer.append(old[i:i+CHUNK_SIZE])
+            writer.append(rows)
+        writer.close()
+        if writer.filename != filename:
+            os.replace(writer.filename, filename)
+        info['dtype'] = writer.dtype.str
+        info['shape'] = [writer.rows] + list(writer.shape)
+
+    manifest['meta'].update(json_meta(meta))
+    _write_manifest(root, manifest)
+
+
+def _same_images(store, images):
+    return np.array_equal(store['images'], np.array(list(images), dtype=np.str_))
+
+
+def extraction_settings(imsize, transform, ms=[1], msp=1, draft=False, **params):
+    """
+    Settings descriptors are extracted with, besides the network weights, as a json serializable
+    dict. Descriptors (or an index built from them) are only reused for the same settings, see
+    load_or_extract_vectors and descriptors_key
+
+    Arguments
+    ---------
+    imsize    : maximum size of longer image side
+    transform : transform of the images, compared by its repr
+    ms        : scales of the multi-scale extraction
+    msp       : power of the multi-scale pooling
+    draft     : whether images are decoded at reduced resolution
+    params    : further settings changing the descriptors, eg dtype='float16'
+
+    Returns
+    -------
+    settings : dict, the same as read back from a manifest
+    """
+    settings = dict(params, imsize=imsize, transform=repr(transform), ms=[float(s) for s in ms], msp=float(msp),
+                    draft=bool(draft))
+    return json.loads(json.dumps(settings, sort_keys=True))
+
+
+def save_vectors(root, vecs, images, meta=None, dtype='float32'):
+    """
+    Writes D x N descriptors of images into a descriptor store
+
+    Arguments
+    ---------
+    root   : directory of the store
+    vecs   : D x N descriptors (torch tensor or numpy array), one column per image
+    images : list of N image paths
+    meta   : network meta stored in the manifest
+    dtype  : 'float32' or 'float16'
+    """
+    if hasattr(vecs, 'cpu'):
+        vecs = vecs.cpu().numpy()
+    with StoreWriter(root, meta=meta) as writer:
+        writer.add('vecs', vecs.T, dtype=dtype)
+        writer.add_strings('images', images)
+
+
+def load_vectors(root, images=None):
+    """
+    Reads descriptors written by save_vectors
+
+    Arguments
+    ---------
+    root   : directory of the store
+    images : if given, the list of image paths the descriptors are expected for
+
+    Returns
+    -------
+    vecs : N x D memory mapped descriptors, vecs.T is D x N
+    """
+    store = Store(root)
+    if images is not None:
+        if not _same_images(store, images):
+            raise RuntimeError('Descriptor store {} holds descriptors of different images!'.format(root))
+    return store['vecs']
+
+
+def load_or_extract_vectors(root, net, images, extract, dtype='float32', settings=None):
+    """
+    Reads the descriptors of images from the store at root if it was written for the same
+    images, network weights and extraction settings, otherwise extracts them and writes them
+    into the store
+
+    Arguments
+    ---------
+    root     : directory of the store, None to always extract
+    net      : network the descriptors are extracted with
+    images   : list of N image paths
+    extract  : function without arguments returning the D x N descriptors
+    dtype    : 'float32' or 'float16', data type of the stored descriptors
+    settings : extraction settings of extract, see extraction_settings
+
+    Returns
+    -------
+    vecs : D x N tensor of descriptors
+    """
+    if root is None:
+        return extract()
+
+    nethash = network_hash(net)
+    settings = json.loads(json.dumps(dict(settings or {}, dtype=dtype), sort_keys=True))
+    if is_store(root):
+        store = Store(root)
+        if (store.meta.get('network_hash') == nethash and store.meta.get('settings') == settings
+                and _same_images(store, images)):
+            print('>>>> loading descriptors from {}'.format(root))
+            return torch.from_numpy(np.array(store['vecs'], dtype=np.float32).T)
+
+    vecs = extract()
+    save_vectors(root, vecs, images, meta=dict(net.meta, network_hash=nethash, settings=settings), dtype=dtype)
+    return vecs